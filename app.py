@@ -1,5 +1,6 @@
 import random
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response, abort
+import hmac
 import os
 import copy
 import datetime
@@ -10,7 +11,18 @@ from werkzeug.utils import secure_filename # For secure filenames, though we don
 
 # Import agent simulation functions and operations
 import research_agent
+import blob_store
 import budget_operations
+import budget_export
+import model_scheduler
+import conversation_memory
+import deadlines
+import plan_store
+import portfolio
+import profiler
+import research_prefetch
+import static_assets
+import traffic_capture
 
 app = Flask(__name__)
 
@@ -42,6 +54,21 @@ app.config['SESSION_COOKIE_SAMESITE'] = 'Lax' # Basic CSRF protection
 # Initialize the Flask-Session extension
 server_session = Session(app)
 
+# Sampling profiler: PROFILE_SAMPLE_RATE of requests or 'X-Profile: 1'; /admin/profile when PROFILER_ADMIN_TOKEN is set
+profiler.init_app(app)
+
+# Fair scheduling of model calls: each request's calls are attributed to its browser session
+model_scheduler.init_app(app)
+
+# Fingerprinted CSS/JS under /assets and gzip/brotli compression of large responses
+static_assets.init_app(app)
+
+# Portfolio analytics index, updated incrementally on every plan write
+portfolio.init_app(app)
+
+# Opt-in request/model-response recording for replay (TRAFFIC_CAPTURE_DIR)
+traffic_capture.init_app(app)
+
 # --- Constants ---
 MAX_UPLOAD_SIZE = 100 * 1024 # 100 KB limit for uploaded file content in session
 ALLOWED_EXTENSIONS = {'csv', 'json', 'txt'}
@@ -57,39 +84,14 @@ def inject_now():
     """Injects the current UTC datetime into the template context."""
     return {'now': datetime.datetime.utcnow()}
 
-# --- Helper Function for Currency Detection ---
-def detect_currency_symbol(text):
-    """Detects common currency symbols or keywords in text."""
-    if not text: return '$' # Default if text is empty
-    text_lower = text.lower()
-    # Order matters - check specific symbols first
-    if '£' in text: return '£'
-    if '€' in text: return '€'
-    if '¥' in text: return '¥'
-    if '₹' in text: return '₹'
-    if '$' in text:
-        # Distinguish between USD, CAD, AUD etc. if needed by checking keywords
-        if 'cad' in text_lower or 'canadian' in text_lower: return 'CAD $' # Example
-        if 'aud' in text_lower or 'australian' in text_lower: return 'AUD $' # Example
-        return '$' # Default $
-    # Check keywords
-    if 'pound' in text_lower or 'gbp' in text_lower: return '£'
-    if 'euro' in text_lower or 'eur' in text_lower: return '€'
-    if 'yen' in text_lower or 'jpy' in text_lower: return '¥'
-    if 'rupee' in text_lower or 'inr' in text_lower: return '₹'
-    if 'dollar' in text_lower: return '$' # Default $ if just "dollar"
-    # Fallback: If user entered something like 'USD', return it directly
-    if len(text.strip()) <= 4: # Assume short codes are intended symbols/codes
-         return text.strip().upper()
-    # Default
-    return '$'
-
-
 # --- Flask Routes ---
 
 @app.route('/')
 def index():
     """Step 1: Display the initial goal input form."""
+    research_prefetch.cancel_draft(session.get('research_draft_id')) # Abandoned questions page
+    if session.get('plan_id'):
+        plan_store.delete(session['plan_id']) # Unreachable once the session is cleared (plan_store also expires idle plans)
     session.clear() # Start fresh for each new plan
     return render_template('index.html')
 
@@ -123,11 +125,12 @@ def start_planning():
 
     # --- Store Goal and Currency ---
     session['project_goal'] = goal
-    session['currency_symbol'] = detect_currency_symbol(currency_input) if currency_input else '$' # Use helper or default
+    session['currency_symbol'] = budget_operations.detect_currency_symbol(currency_input) if currency_input else '$' # Use helper or default
 
     # --- Handle File Upload ---
+    # Stored once in the content-addressed blob store; the session keeps only the id
     historical_data_content = None
-    session.pop('historical_data', None) # Clear previous data
+    session.pop('historical_data_id', None) # Clear previous data
     if budget_file and budget_file.filename != '':
         # Secure filename is less critical since we read content, not save the file with user input name
         # filename = secure_filename(budget_file.filename)
@@ -138,13 +141,14 @@ def start_planning():
                 file_content_bytes = budget_file.read(MAX_UPLOAD_SIZE + 1) # Read slightly more to check if limit exceeded
                 if len(file_content_bytes) > MAX_UPLOAD_SIZE:
                     flash(f"Warning: Uploaded file '{filename}' exceeded size limit ({MAX_UPLOAD_SIZE/1024:.0f}KB) and was truncated.", "warning")
-                    historical_data_content = file_content_bytes[:MAX_UPLOAD_SIZE].decode('utf-8', errors='ignore')
-                else:
-                    historical_data_content = file_content_bytes.decode('utf-8', errors='ignore')
-
-                if historical_data_content:
-                    session['historical_data'] = historical_data_content
-                    print(f"Orchestrator: Stored historical data from file '{filename}' ({len(historical_data_content)} bytes).")
+                    file_content_bytes = file_content_bytes[:MAX_UPLOAD_SIZE]
+                historical_data_id = blob_store.put(file_content_bytes)
+
+                if historical_data_id:
+                    session['historical_data_id'] = historical_data_id
+                    historical_data_content = blob_store.derived(historical_data_id, research_agent.HISTORY_PROMPT_ARTIFACT,
+                                                                 research_agent.history_prompt_text)
+                    print(f"Orchestrator: Stored historical data from file '{filename}' as blob {historical_data_id[:12]} ({len(file_content_bytes)} bytes).")
                     flash(f"Successfully processed data from '{filename}'.", "success")
                 else:
                     flash(f"Uploaded file '{filename}' appears to be empty or could not be read as text.", "warning")
@@ -160,6 +164,10 @@ def start_planning():
     print(f"Orchestrator: Received Budget: {session['currency_symbol']}{budget_amount:.2f}")
 
 
+    # --- Speculative Research Draft (runs while the user answers the questions) ---
+    research_prefetch.cancel_draft(session.pop('research_draft_id', None))
+    session['research_draft_id'] = research_prefetch.start_draft(goal, historical_data_content)
+
     # --- Task Planning Agent for Questions (excluding budget amount) ---
     print("Orchestrator: Tasking Planning Agent for clarifying questions...")
     questions = research_agent.get_clarifying_questions(goal) # AI should no longer ask for budget
@@ -175,6 +183,7 @@ def start_planning():
     else:
         error_msg = questions[0] if (questions and isinstance(questions, list)) else "AI failed to generate questions."
         flash(f"Error during planning phase: {error_msg}", "danger")
+        research_prefetch.cancel_draft(session.pop('research_draft_id', None))
         # Clear potentially stored session data if failing here? Optional.
         # session.pop('project_goal', None) ... etc
         return redirect(url_for('index'))
@@ -187,7 +196,16 @@ def generate_plan():
     questions = session.get('questions')
     budget_amount = session.get('estimated_budget_amount')
     currency_symbol = session.get('currency_symbol', '$')
-    historical_data = session.get('historical_data', None) # Get historical data
+    # Uploaded history: prompt-ready text and parsed table, computed once per file content (blob_store)
+    historical_data_id = session.get('historical_data_id')
+    historical_data, history_table = None, None
+    if historical_data_id:
+        try:
+            historical_data = blob_store.derived(historical_data_id, research_agent.HISTORY_PROMPT_ARTIFACT, research_agent.history_prompt_text)
+            history_table = blob_store.derived(historical_data_id, budget_operations.HISTORY_TABLE_ARTIFACT,
+                                               budget_operations.parse_history_table)
+        except blob_store.BlobNotFound:
+            print(f"Orchestrator: Uploaded history blob {historical_data_id[:12]} is missing, continuing without it.")
 
     if not goal or not questions or budget_amount is None:
         flash("Session expired or invalid request (missing goal, questions, or budget). Please start over.", "warning")
@@ -208,13 +226,63 @@ def generate_plan():
     session['answers'] = answers
     print(f"Orchestrator: Collected answers.")
 
+    # The plan's state lives in plan_store (versioned), not in the session; the session only keeps its id
+    plan = {
+        'goal': goal,
+        'answers': answers,
+        'estimated_budget_amount': budget_amount,
+        'currency_symbol': currency_symbol,
+        'historical_data_id': historical_data_id, # Reference into blob_store, not the content
+        'created_at': datetime.datetime.utcnow().isoformat(),
+    }
+
 
     # --- Agent Workflow ---
-    # 2. Task Research Agent (Pass historical data)
+    # Every stage runs under the plan's latency budget (deadlines.PLAN_SLA_SECONDS). A stage that
+    # overruns keeps running in the background and is written into the stored plan when it lands.
+    deadline = deadlines.Deadline()
+    background = {} # stage -> future still running after its deadline
+
+    # 2. Task Research Agent (Pass historical data) - reuses/refines the draft prefetched at /start
     print("Orchestrator: Tasking Research Agent...")
-    research_summary = research_agent.run_research(goal, answers, historical_data) # <-- Pass historical_data
-    session['research_summary'] = research_summary # Store even if None or blocked
-    if not research_summary or "Error during AI call" in research_summary:
+    partial = {}
+    research_future = deadlines.submit(research_prefetch.research_from_draft, session.pop('research_draft_id', None),
+                                       goal, answers, historical_data, partial=partial)
+
+    # With usable uploaded history, show a provisional budget scaled from it right away; the model
+    # stages then all run in the background and the AI proposal replaces the draft when it lands.
+    local_draft = budget_operations.draft_budget_from_table(history_table, budget_amount)
+    if local_draft:
+        print(f"Orchestrator: Drafted a provisional budget from uploaded history ({len(local_draft)} categories).")
+        plan.update(research_summary=None, research_digest=None, research_pending=True,
+                    initial_budget={}, is_percentage_based=False, initial_total=0.0,
+                    draft_budget=local_draft, current_budget=copy.deepcopy(local_draft),
+                    budget_explanation=None, proposal_pending=True, explanation_pending=True,
+                    pending_modification=None, ai_conversation=[],
+                    reallocation_log=["Initial budget plan generation started.",
+                                      "Provisional budget drafted from your uploaded history."])
+        flash("Showing a provisional budget based on your uploaded history. The AI proposal will replace it when it is ready.", "info")
+        context = {'goal': goal, 'answers': answers, 'budget_amount': budget_amount, 'currency_symbol': currency_symbol,
+                   'historical_data': historical_data}
+        plan_id = _store_new_plan(plan, {}, context)
+        # Chained rather than submitted: a stage worker must not sit blocked on another stage's future
+        deadlines.when_done(research_future, _complete_from_draft, plan_id, context, run_on_failure=True)
+        return redirect(url_for('display_plan'))
+
+    research_done, research_summary = deadlines.wait(research_future, deadline.stage_timeout('research'), 'research')
+    if not research_done:
+        background['research'] = research_future
+        research_summary = partial.get('research') # Unrefined draft, if it finished
+        plan['research_pending'] = True
+        flash("Research is taking longer than usual. The plan below uses " + ("the preliminary research" if research_summary else "the information available") + " and the research will be added when it finishes.", "info")
+    plan['research_summary'] = research_summary # Store even if None or blocked
+    research_ok = False
+    if not research_summary:
+        if research_done:
+            flash("AI research summary could not be generated or failed.", "warning")
+            print(f"Orchestrator: Research Agent failed/error: {research_summary}")
+        research_summary = "Research summary was not available."
+    elif "Error during AI call" in research_summary or "generation failed" in research_summary:
         flash("AI research summary could not be generated or failed.", "warning")
         print(f"Orchestrator: Research Agent failed/error: {research_summary}")
         research_summary = "Research summary was not available."
@@ -222,110 +290,285 @@ def generate_plan():
          flash("AI research summary was blocked by safety filters.", "warning")
          print("Orchestrator: Research Agent blocked.")
          research_summary = "Research summary blocked by safety filters." # Store message
+    else:
+        research_ok = True
+
+    # Condense the research once; the proposal, explanation and every later Q&A/edit prompt use the digest.
+    # If the digest overruns, prompts get the research truncated; without research, a cached digest for the same
+    # goal, answers and history (never another user's digest for a matching goal).
+    research_digest = None
+    if research_ok:
+        digest_future = deadlines.submit(research_agent.digest_research, research_summary, goal,
+                                         research_agent.inputs_key(goal, answers, historical_data))
+        digest_done, research_digest = deadlines.wait(digest_future, deadline.stage_timeout('digest'), 'digest')
+        if not digest_done:
+            background['digest'] = digest_future
+    else:
+        research_digest = research_agent.cached_digest_for_inputs(research_agent.inputs_key(goal, answers, historical_data))
+        if research_digest:
+            print("Orchestrator: Using a cached research digest for these inputs.")
+    plan['research_digest'] = research_digest
+    research_notes = research_agent.research_context(research_summary if research_ok else None, research_digest)
+    context = {'goal': goal, 'answers': answers, 'budget_amount': budget_amount, 'currency_symbol': currency_symbol,
+               'research_notes': research_notes, 'historical_data': historical_data}
 
 
     # 3. Task Budget Allocation Agent (Pass historical data)
     print("Orchestrator: Tasking Budget Allocation Agent...")
-    proposed_budget_raw = research_agent.generate_budget_proposal(
-        goal, budget_amount, currency_symbol, answers, research_summary, historical_data # <-- Pass historical_data
+    proposal_future = deadlines.submit(research_agent.generate_budget_proposal,
+        goal, budget_amount, currency_symbol, answers, research_notes, historical_data # <-- Pass historical_data
     )
+    proposal_done, proposed_budget_raw = deadlines.wait(proposal_future, deadline.stage_timeout('proposal'), 'proposal')
+    plan['ai_conversation'] = []
+    plan['reallocation_log'] = ["Initial budget plan generation started."]
+    plan['pending_modification'] = None # Clear any pending mod
+
+    if not proposal_done:
+        # Render now with a placeholder; the proposal (then the explanation) is stored when it arrives
+        plan.update(initial_budget={}, current_budget={}, is_percentage_based=False, initial_total=0.0,
+                    budget_explanation=None, proposal_pending=True, explanation_pending=True)
+        plan['reallocation_log'].append("AI budget proposal is taking longer than usual; it will appear when ready.")
+        flash("The AI budget proposal is taking longer than usual. This page will update when it is ready.", "info")
+        plan_id = _store_new_plan(plan, background, context)
+        deadlines.when_done(proposal_future, _complete_proposal, plan_id, context)
+        return redirect(url_for('display_plan'))
+
+    notices = []
+    proposal_ok = _apply_proposal(plan, proposed_budget_raw, budget_amount, notices)
+    for notice in notices:
+        flash(notice['message'], notice['category'])
+    if not proposal_ok:
+        _store_new_plan(plan, background, context)
+        return redirect(url_for('display_plan')) # Go to display page to show error
+
+
+    # 4. Task Reasoning & Explanation Agent (Pass historical data) - gets whatever time is left
+    print("Orchestrator: Tasking Reasoning & Explanation Agent...")
+    explanation_future = deadlines.submit(research_agent.generate_explanation,
+        plan['initial_budget'], goal, answers, research_notes, historical_data # <-- Pass historical_data
+    )
+    explanation_done, explanation = deadlines.wait(explanation_future, deadline.stage_timeout('explanation'), 'explanation')
+    if explanation_done:
+        plan['budget_explanation'] = _explanation_text(explanation, notices)
+        for notice in notices:
+            flash(notice['message'], notice['category'])
+    else:
+        background['explanation'] = explanation_future
+        plan['budget_explanation'] = None
+        plan['explanation_pending'] = True
+
+
+    # 5. Set Final State (Now always amount-based if no error)
+    print(f"Orchestrator: Amount-based budget generated. Total: {currency_symbol}{plan['initial_total']:.2f}")
+    conversation_memory.append(plan, {'ai': f"Amount-based budget (in {currency_symbol}) generated. " + ("Explanation provided." if explanation_done else "The explanation will appear shortly.") + " Ready for interaction."})
+    plan['reallocation_log'].append("Budget plan generation complete.")
+
+    _store_new_plan(plan, background, context)
+    print(f"Orchestrator: Initial plan generation complete in {deadline.elapsed():.1f}s.")
+    return redirect(url_for('display_plan'))
+
+
+# --- Plan Generation Helpers ---
+# Shared by /generate and the background completions of stages that overran their deadline.
+
+def _apply_proposal(plan, proposed_budget_raw, budget_amount, notices):
+    """Parses the AI proposal into the plan (initial/current budget, totals, log). Returns False on error."""
+    currency_symbol = plan.get('currency_symbol', '$')
     parsed_budget, is_percentage, initial_total = budget_operations.parse_budget_proposal(proposed_budget_raw)
-    session['initial_budget'] = parsed_budget # Store parsed (might be error dict)
+    plan['initial_budget'] = parsed_budget # Store parsed (might be error dict)
     # We now force amount-based, so is_percentage should be False unless error
-    session['is_percentage_based'] = is_percentage
-    session['ai_conversation'] = []
-    session['reallocation_log'] = ["Initial budget plan generation started."]
-    session.pop('pending_modification', None) # Clear any pending mod
+    plan['is_percentage_based'] = is_percentage
 
     # Handle Allocation/Parsing Errors
     if "Error" in parsed_budget:
         error_msg = parsed_budget['Error']
-        flash(f"Failed to process budget proposal from AI: {error_msg}", "danger")
+        _notice(notices, f"Failed to process budget proposal from AI: {error_msg}", "danger")
         print(f"Orchestrator: Budget Allocation/Parsing failed: {error_msg}")
-        session['current_budget'] = {}
-        session['budget_explanation'] = None
-        session['is_percentage_based'] = True # Treat as error state
-        session['ai_conversation'].append({'ai': f"Error processing initial budget: {error_msg}"})
-        session['reallocation_log'].append(f"Budget generation failed: {error_msg}")
-        return redirect(url_for('display_plan')) # Go to display page to show error
+        plan['current_budget'] = {}
+        plan['budget_explanation'] = None
+        plan['is_percentage_based'] = True # Treat as error state
+        conversation_memory.append(plan, {'ai': f"Error processing initial budget: {error_msg}"})
+        plan['reallocation_log'].append(f"Budget generation failed: {error_msg}")
+        return False
 
     # Validate returned total vs expected (optional sanity check)
     if abs(initial_total - budget_amount) > max(1.0, budget_amount * 0.01): # Allow 1% or $1 tolerance
         warn_msg = f"AI proposal total ({currency_symbol}{initial_total:,.2f}) differs significantly from provided estimate ({currency_symbol}{budget_amount:,.2f}). Using AI's calculated total."
-        flash(warn_msg, "warning")
+        _notice(notices, warn_msg, "warning")
         print(f"Orchestrator Warning: {warn_msg}")
         log_msg = f"AI total ({currency_symbol}{initial_total:,.2f}) differs from estimate ({currency_symbol}{budget_amount:,.2f})."
-        session['reallocation_log'].append(log_msg)
-    session['initial_total'] = initial_total # Store AI's calculated total
-
-
-    # 4. Task Reasoning & Explanation Agent (Pass historical data)
-    print("Orchestrator: Tasking Reasoning & Explanation Agent...")
-    explanation = research_agent.generate_explanation(
-        parsed_budget, goal, answers, research_summary, historical_data # <-- Pass historical_data
-    )
-    # Handle explanation errors/blocks
+        plan['reallocation_log'].append(log_msg)
+    plan['initial_total'] = initial_total # Store AI's calculated total
+    plan['reallocation_log'].append("AI proposed initial budget.")
+    plan['current_budget'] = copy.deepcopy(parsed_budget) # Set current budget
+    return True
+
+def _explanation_text(explanation, notices):
+    """Handle explanation errors/blocks; returns the text to store."""
     if not explanation or "Error during AI call" in (explanation or ""):
-         flash("Could not generate an explanation for the budget.", "warning")
+         _notice(notices, "Could not generate an explanation for the budget.", "warning")
          print(f"Orchestrator: Explanation Agent failed/error: {explanation}")
-         explanation = "Explanation not available."
-    elif "blocked by safety filters" in explanation:
-         flash("AI budget explanation was blocked by safety filters.", "warning")
+         return "Explanation not available."
+    if "blocked by safety filters" in explanation:
+         _notice(notices, "AI budget explanation was blocked by safety filters.", "warning")
          print("Orchestrator: Explanation Agent blocked.")
-         explanation = "Budget explanation blocked by safety filters." # Store message
-    session['budget_explanation'] = explanation
-
-
-    # 5. Set Final State (Now always amount-based if no error)
-    session['reallocation_log'].append("AI proposed initial budget.")
-    session['current_budget'] = copy.deepcopy(parsed_budget) # Set current budget
-    print(f"Orchestrator: Amount-based budget generated. Total: {currency_symbol}{initial_total:.2f}")
-    session['ai_conversation'].append({'ai': f"Amount-based budget (in {currency_symbol}) generated. Explanation provided. Ready for interaction."})
-    session['reallocation_log'].append("Budget plan generation complete.")
+         return "Budget explanation blocked by safety filters." # Store message
+    return explanation
+
+def _store_new_plan(plan, background, context):
+    """Creates the stored plan and hooks up the stages still running in the background."""
+    plan_id = plan_store.create(plan)
+    session['plan_id'] = plan_id
+    if 'research' in background:
+        deadlines.when_done(background['research'], _complete_research, plan_id, context)
+    if 'digest' in background:
+        deadlines.when_done(background['digest'], _complete_digest, plan_id, plan['research_summary'])
+    if 'explanation' in background:
+        deadlines.when_done(background['explanation'], _complete_explanation, plan_id)
+    return plan_id
+
+def _complete_research(research_summary, plan_id, context):
+    """Late research: stores it and its digest so later Q&A and edits use the full research. Returns (usable, digest)."""
+    usable = bool(research_summary) and not any(marker in research_summary for marker in ("generation failed", "Error during AI call", "blocked by safety filters"))
+    key = research_agent.inputs_key(context['goal'], context['answers'], context['historical_data'])
+    digest = research_agent.digest_research(research_summary, context['goal'], key) if usable else None
+    def commit(state):
+        state['research_pending'] = False
+        if usable:
+            state['research_summary'] = research_summary
+            if digest:
+                state['research_digest'] = digest
+            state.setdefault('reallocation_log', []).append("Full research finished and was added to the plan.")
+    plan_store.update(plan_id, commit)
+    print(f"Orchestrator: Late research stored for plan {plan_id[:8]} (usable: {bool(usable)}).")
+    return usable, digest
+
+def _complete_digest(digest, plan_id, research_summary):
+    if not digest:
+        return
+    def commit(state):
+        if state.get('research_summary') == research_summary: # Not superseded by late full research
+            state['research_digest'] = digest
+    plan_store.update(plan_id, commit)
+
+def _complete_from_draft(research_summary, plan_id, context):
+    """Plans shown from a local draft: once research lands (None if it failed), the digest, proposal and explanation."""
+    usable, digest = _complete_research(research_summary, plan_id, context)
+    if not usable:
+        digest = research_agent.cached_digest_for_inputs(
+            research_agent.inputs_key(context['goal'], context['answers'], context['historical_data']))
+    context = dict(context, research_notes=research_agent.research_context(research_summary if usable else None, digest))
+    print("Orchestrator: Tasking Budget Allocation Agent (replacing the provisional draft)...")
+    proposed_budget_raw = research_agent.generate_budget_proposal(
+        context['goal'], context['budget_amount'], context['currency_symbol'], context['answers'],
+        context['research_notes'], context['historical_data'])
+    _complete_proposal(proposed_budget_raw, plan_id, context)
+
+def _complete_proposal(proposed_budget_raw, plan_id, context):
+    """Late proposal: stores it, then generates the explanation in this background thread."""
+    def commit(state):
+        notices = []
+        state['proposal_pending'] = False
+        draft = state.get('draft_budget')
+        edited_draft = copy.deepcopy(state.get('current_budget')) if draft and state.get('current_budget') != draft else None
+        ok = _apply_proposal(state, proposed_budget_raw, context['budget_amount'], notices)
+        state['explanation_pending'] = ok
+        if ok and draft:
+            state['reallocation_log'].append("AI proposal replaced the provisional draft budget.")
+        if ok and edited_draft:
+            # Changes made to the provisional budget are carried over onto the AI proposal
+            merged, conflicts = budget_operations.merge_budget_delta(draft, edited_draft, state['current_budget'])
+            if conflicts:
+                state['reallocation_log'].append(f"Your changes to the provisional budget were not carried over (would make {', '.join(conflicts)} negative).")
+            else:
+                state['current_budget'] = merged
+                state['reallocation_log'].append("Your changes to the provisional budget were carried over to the AI proposal.")
+        if not ok and draft:
+            state['current_budget'] = edited_draft or copy.deepcopy(draft) # Keep working from the draft
+            state['is_percentage_based'] = False
+        if ok:
+            # The user may have chatted with the draft meanwhile, so this goes through the capped append
+            conversation_memory.append(state, {'ai': f"Amount-based budget (in {state.get('currency_symbol', '$')}) generated. Ready for interaction."})
+        state['reallocation_log'].extend(n['message'] for n in notices if n['category'] == 'warning')
+        state['reallocation_log'].append("Budget plan generation complete.")
+        return ok
+    ok, state, _ = plan_store.update(plan_id, commit)
+    print(f"Orchestrator: Late proposal stored for plan {plan_id[:8]} (ok: {ok}).")
+    if ok:
+        explanation = research_agent.generate_explanation(state['initial_budget'], context['goal'], context['answers'],
+                                                          context['research_notes'], context['historical_data'])
+        _complete_explanation(explanation, plan_id)
+
+def _complete_explanation(explanation, plan_id):
+    def commit(state):
+        state['budget_explanation'] = _explanation_text(explanation, [])
+        state['explanation_pending'] = False
+    plan_store.update(plan_id, commit)
+    print(f"Orchestrator: Explanation stored for plan {plan_id[:8]}.")
+
+
+
+# --- Plan View Helpers ---
+def _load_plan():
+    """Returns (plan_id, state) for this browser session's plan, or (None, None)."""
+    plan_id = session.get('plan_id')
+    if not plan_id:
+        return None, None
+    try:
+        state, _ = plan_store.load(plan_id)
+    except plan_store.PlanNotFound:
+        return None, None
+    return plan_id, state
 
+def _budget_total(budget):
+    """Sum of numeric values in a budget dict (0.0 if empty/invalid)."""
+    return sum(v for v in budget.values() if isinstance(v, (int, float))) if budget else 0.0
 
-    print("Orchestrator: Initial plan generation complete.")
-    return redirect(url_for('display_plan'))
+def _chart_data(current_budget, initial_budget, is_percentage):
+    """Returns (labels, values) for Chart.js, largest first, or (None, None)."""
+    initial_budget_has_error = isinstance(initial_budget, dict) and "Error" in initial_budget
+    current_budget_has_error = isinstance(current_budget, dict) and "Error" in current_budget
+    # Ensure chart data is generated only for valid, numeric budgets
+    if is_percentage or not current_budget or current_budget_has_error or initial_budget_has_error:
+        return None, None
+    chart_data = {k: v for k, v in current_budget.items() if isinstance(v, (int, float)) and v > 0.005}
+    if not chart_data:
+        return None, None
+    sorted_chart_data = dict(sorted(chart_data.items(), key=lambda item: item[1], reverse=True))
+    return list(sorted_chart_data.keys()), list(sorted_chart_data.values())
 
 
 @app.route('/plan')
 def display_plan():
     """Step 3 & 4: Display the generated plan and controls."""
-    goal = session.get('project_goal')
-    if not goal:
+    plan_id, plan = _load_plan()
+    if not plan:
         flash("Please start by defining your project goal.", "warning")
         return redirect(url_for('index'))
 
-    # Retrieve data from session
-    research = session.get('research_summary', "N/A")
-    initial_budget = session.get('initial_budget', {})
-    current_budget = session.get('current_budget', {})
+    # Retrieve data from the stored plan
+    goal = plan.get('goal')
+    research = plan.get('research_summary', "N/A")
+    initial_budget = plan.get('initial_budget', {})
+    current_budget = plan.get('current_budget', {})
     # is_percentage should reliably be False if generated successfully now
-    is_percentage = session.get('is_percentage_based', False)
-    log = session.get('reallocation_log', ["Log not available."])
-    initial_total = session.get('initial_total', 0.0)
-    ai_conversation = session.get('ai_conversation', [])
-    pending_modification = session.get('pending_modification')
-    explanation = session.get('budget_explanation')
-    currency_symbol = session.get('currency_symbol', '$') # Get currency symbol
-
-
-    current_total = sum(v for v in current_budget.values() if isinstance(v, (int, float))) if current_budget else 0.0
-
-    # Prepare data for Chart.js
-    chart_labels = None
-    chart_values = None
+    is_percentage = plan.get('is_percentage_based', False)
+    log = plan.get('reallocation_log', ["Log not available."])
+    initial_total = plan.get('initial_total', 0.0)
+    ai_conversation = plan.get('ai_conversation', [])
+    pending_modification = plan.get('pending_modification')
+    explanation = plan.get('budget_explanation')
+    currency_symbol = plan.get('currency_symbol', '$') # Get currency symbol
+
+    current_total = _budget_total(current_budget)
     initial_budget_has_error = isinstance(initial_budget, dict) and "Error" in initial_budget
     current_budget_has_error = isinstance(current_budget, dict) and "Error" in current_budget
-
-    # Ensure chart data is generated only for valid, numeric budgets
-    if not is_percentage and current_budget and not current_budget_has_error and not initial_budget_has_error:
-        chart_data = {k: v for k, v in current_budget.items() if isinstance(v, (int, float)) and v > 0.005}
-        if chart_data:
-            sorted_chart_data = dict(sorted(chart_data.items(), key=lambda item: item[1], reverse=True))
-            chart_labels = list(sorted_chart_data.keys())
-            chart_values = list(sorted_chart_data.values())
-
+    chart_labels, chart_values = _chart_data(current_budget, initial_budget, is_percentage)
+    # A provisional budget drafted from uploaded history; once the AI proposal replaces it, show what changed
+    draft_budget = plan.get('draft_budget')
+    draft_diff = None
+    if draft_budget and not plan.get('proposal_pending') and initial_budget and not initial_budget_has_error and not is_percentage:
+        draft_diff = budget_operations.budget_diff(draft_budget, initial_budget)
 
     return render_template('budget_plan.html',
                            goal=goal,
@@ -343,48 +586,63 @@ def display_plan():
                            ai_conversation=ai_conversation,
                            pending_modification=pending_modification,
                            budget_explanation=explanation,
+                           # Stages that overran the generation deadline and are still being filled in
+                           proposal_pending=plan.get('proposal_pending', False),
+                           explanation_pending=plan.get('explanation_pending', False),
+                           research_pending=plan.get('research_pending', False),
+                           draft_budget=draft_budget,
+                           draft_diff=draft_diff,
                            currency_symbol=currency_symbol # Pass symbol
                            )
 
-# --- AI Interaction Route ---
-@app.route('/interact_ai', methods=['POST'])
-def interact_ai():
-    """Orchestrator for AI Chat Interactions"""
-    print("Orchestrator: Starting AI interaction...")
-    user_request = request.form.get('ai_request', '').strip()
-    # Load state
-    current_budget = session.get('current_budget', {})
-    initial_budget = session.get('initial_budget', {})
-    is_percentage = session.get('is_percentage_based', False) # Assume False if generated correctly
-    conversation = session.get('ai_conversation', [])
-    log = session.get('reallocation_log', [])
-    goal = session.get('project_goal')
-    answers = session.get('answers', {})
-    currency = session.get('currency_symbol', '$')
-    current_budget_has_error = isinstance(current_budget, dict) and "Error" in current_budget
 
-    session.pop('pending_modification', None) # Clear previous pending
+# --- Plan Actions ---
+# Each action returns a list of {'message', 'category'} notices. The form routes
+# flash them and redirect; the /api/v1 routes return them as JSON.
+# State changes go through plan_store.update(), a compare-and-swap loop: if another
+# request wrote the plan in between, the mutation is re-run on the fresh state, so
+# slow AI calls and quick manual events can overlap without losing updates.
 
-    if not user_request:
-        flash("Please enter a question or modification request.", "warning")
-        return redirect(url_for('display_plan'))
+def _notice(notices, message, category):
+    notices.append({'message': message, 'category': category})
 
-    conversation.append({'user': user_request})
+def _run_interact_ai(plan_id, user_request):
+    """Orchestrator for AI Chat Interactions"""
+    print("Orchestrator: Starting AI interaction...")
+    notices = []
+    if not user_request:
+        _notice(notices, "Please enter a question or modification request.", "warning")
+        return notices
+
+    # Work from a snapshot; the (slow) AI call happens outside any write
+    plan, _ = plan_store.load(plan_id)
+    current_budget = plan.get('current_budget', {})
+    initial_budget = plan.get('initial_budget', {})
+    is_percentage = plan.get('is_percentage_based', False) # Assume False if generated correctly
+    goal = plan.get('goal')
+    answers = plan.get('answers', {})
+    currency = plan.get('currency_symbol', '$')
+    current_budget_has_error = isinstance(current_budget, dict) and "Error" in current_budget
     print(f"Orchestrator: Received user request: {user_request}")
 
     modification_keywords = ['change', 'modify', 'update', 'set', 'increase', 'decrease', 'add', 'remove', 'allocate', 'adjust', 'revise']
     is_modification = any(keyword in user_request.lower() for keyword in modification_keywords)
 
-    ai_context = {'goal': goal, 'answers': answers}
+    ai_context = {
+        'goal': goal,
+        'answers': answers,
+        'research': research_agent.research_context(plan.get('research_summary'), plan.get('research_digest')),
+        'conversation': conversation_memory.format_for_prompt(plan),
+    }
     ai_response = "Sorry, I encountered an unexpected issue processing your request."
+    pending_modification = None
 
     if is_modification:
         print("Orchestrator: Identified as modification request.")
         if is_percentage or not current_budget or current_budget_has_error:
              error_msg = "Budget is percentage-based." if is_percentage else current_budget.get("Error", "No numerical budget found.")
              ai_response = f"Cannot modify budget: {error_msg}"
-             flash(ai_response, "danger" if current_budget_has_error else "warning")
-             conversation.append({'ai': ai_response}) # Add AI response to conversation
+             _notice(notices, ai_response, "danger" if current_budget_has_error else "warning")
         else:
             print("Orchestrator: Tasking Modification Agent...")
             modified_budget_raw = research_agent.modify_budget_proposal(user_request, current_budget, ai_context)
@@ -393,21 +651,18 @@ def interact_ai():
             if "Error" in new_parsed_budget:
                 error_detail = new_parsed_budget['Error']
                 ai_response = f"Sorry, I couldn't generate a valid modification proposal. Error: {error_detail}"
-                flash(f"AI failed to generate modification: {error_detail}", "danger")
+                _notice(notices, f"AI failed to generate modification: {error_detail}", "danger")
                 print(f"Orchestrator: Modification Agent failed: {error_detail}")
-                conversation.append({'ai': ai_response})
             elif new_is_percentage: # Should not happen now
                  ai_response = "Sorry, the modification unexpectedly resulted in a percentage budget."
-                 flash("AI modification failed: Unexpected percentage budget.", "danger")
+                 _notice(notices, "AI modification failed: Unexpected percentage budget.", "danger")
                  print("Orchestrator: Modification Agent Error: Returned % budget.")
-                 conversation.append({'ai': ai_response})
             else:
                 # VALID PROPOSAL: Store for user approval
-                session['pending_modification'] = new_parsed_budget
+                pending_modification = new_parsed_budget
                 ai_response = f"OK, I have prepared a proposed modification (in {currency}). Please review the changes shown below. Do you want to apply them?"
-                flash("AI has proposed changes. Review and Approve/Reject.", "info")
+                _notice(notices, "AI has proposed changes. Review and Approve/Reject.", "info")
                 print("Orchestrator: Modification Agent succeeded. Proposal pending.")
-                conversation.append({'ai': ai_response})
 
     else:
         # --- Handle Question ---
@@ -422,177 +677,347 @@ def interact_ai():
 
         if not budget_for_qna:
              ai_response = "No valid budget data is available to answer questions about."
-             conversation.append({'ai': ai_response})
         else:
             ai_qna_response = research_agent.answer_budget_question(user_request, budget_for_qna, ai_context)
             ai_response = ai_qna_response if ai_qna_response else "Sorry, I couldn't get an answer from the AI."
             if "blocked by safety filters" in ai_response or "Error during AI call" in ai_response :
-                 flash(f"AI interaction failed: {ai_response}", "warning")
-            conversation.append({'ai': ai_response})
+                 _notice(notices, f"AI interaction failed: {ai_response}", "warning")
         print("Orchestrator: Q&A Agent finished.")
 
-    # Save updated conversation state
-    session['ai_conversation'] = conversation
+    def commit(state):
+        conversation_memory.append(state, {'user': user_request}, {'ai': ai_response})
+        # Replaces any previous pending proposal; remember the budget it was computed against
+        state['pending_modification'] = pending_modification
+        state['pending_base'] = current_budget if pending_modification else None
+    _, new_state, _ = plan_store.update(plan_id, commit)
+    conversation_memory.maybe_refresh(plan_id, new_state) # Background; never delays this response
     print("Orchestrator: Interaction complete.")
-    return redirect(url_for('display_plan'))
+    return notices
 
 
-# --- Apply Modification Route ---
-@app.route('/apply_modification/<action>', methods=['POST'])
-def apply_modification(action):
+def _run_apply_modification(plan_id, action):
     """Handles user approval/rejection of AI modification proposal."""
-    pending_mod = session.get('pending_modification')
-    log = session.get('reallocation_log', [])
-    conversation = session.get('ai_conversation', [])
-    currency = session.get('currency_symbol', '$')
-
-    if not pending_mod:
-        flash("No pending modification found.", "warning")
-        return redirect(url_for('display_plan'))
-
-    if action == 'approve':
-        if isinstance(pending_mod.get("Error", None), str):
-             flash(f"Cannot approve modification due to error: {pending_mod['Error']}", "danger")
+    def apply(state):
+        notices = []
+        pending_mod = state.get('pending_modification')
+        log = state.setdefault('reallocation_log', [])
+        currency = state.get('currency_symbol', '$')
+
+        if not pending_mod:
+            _notice(notices, "No pending modification found.", "warning")
+            return notices
+
+        if action == 'approve':
+            current_budget = state.get('current_budget', {})
+            base_budget = state.get('pending_base')
+            budget_to_apply = pending_mod
+            conflicts = []
+            if isinstance(pending_mod.get("Error", None), str):
+                 _notice(notices, f"Cannot approve modification due to error: {pending_mod['Error']}", "danger")
+                 budget_to_apply = None
+            elif base_budget is not None and base_budget != current_budget:
+                 # The budget moved on (e.g. an event ran while the AI was thinking): replay the AI's changes on top
+                 budget_to_apply, conflicts = budget_operations.merge_budget_delta(base_budget, pending_mod, current_budget)
+                 if conflicts:
+                      log.append(f"AI modification not applied: budget changed meanwhile and it would overdraw {', '.join(conflicts)}.")
+                      _notice(notices, "The budget changed since the AI proposed this, and the change no longer fits. Please ask again.", "warning")
+                      budget_to_apply = None
+                 else:
+                      log.append("AI modification merged with changes made since it was proposed.")
+
+            if budget_to_apply is not None:
+                 # Optional: Validate total hasn't drastically changed
+                 current_total_before = _budget_total(current_budget)
+                 new_total_proposed = _budget_total(budget_to_apply)
+                 # Allow slightly more tolerance for complex reallocations by AI
+                 if abs(current_total_before - new_total_proposed) > max(0.05, current_total_before * 0.001): # 5 cents or 0.1%
+                      log_msg = f"AI Mod Applied Note: Budget total changed from {currency}{current_total_before:,.2f} to {currency}{new_total_proposed:,.2f}."
+                      log.append(log_msg)
+                      print(f"Warning: {log_msg}")
+                      _notice(notices, f"Note: Budget total changed to {currency}{new_total_proposed:,.2f}.", "info")
+
+                 state['current_budget'] = budget_to_apply # Apply change
+                 log.append("Budget modification proposed by AI was approved and applied.")
+                 conversation_memory.append(state, {'ai': "OK, I've applied the approved changes."})
+                 _notice(notices, "Approved changes applied.", "success")
+                 print("Orchestrator: Modification approved.")
+        elif action == 'reject':
+            log.append("Budget modification proposed by AI was rejected.")
+            conversation_memory.append(state, {'ai': "OK, the proposed changes were discarded."})
+            _notice(notices, "Proposed changes rejected.", "info")
+            print("Orchestrator: Modification rejected.")
         else:
-             # Optional: Validate total hasn't drastically changed
-             current_total_before = sum(v for v in session.get('current_budget', {}).values() if isinstance(v, (int, float)))
-             new_total_proposed = sum(v for v in pending_mod.values() if isinstance(v, (int, float)))
-             # Allow slightly more tolerance for complex reallocations by AI
-             if abs(current_total_before - new_total_proposed) > max(0.05, current_total_before * 0.001): # 5 cents or 0.1%
-                  log_msg = f"AI Mod Applied Note: Budget total changed from {currency}{current_total_before:,.2f} to {currency}{new_total_proposed:,.2f}."
-                  log.append(log_msg)
-                  print(f"Warning: {log_msg}")
-                  flash(f"Note: Budget total changed to {currency}{new_total_proposed:,.2f}.", "info")
-
-             session['current_budget'] = pending_mod # Apply change
-             log.append("Budget modification proposed by AI was approved and applied.")
-             conversation.append({'ai': "OK, I've applied the approved changes."})
-             flash("Approved changes applied.", "success")
-             print("Orchestrator: Modification approved.")
-    elif action == 'reject':
-        log.append("Budget modification proposed by AI was rejected.")
-        conversation.append({'ai': "OK, the proposed changes were discarded."})
-        flash("Proposed changes rejected.", "info")
-        print("Orchestrator: Modification rejected.")
-    else:
-        flash("Invalid action.", "danger")
-        log.append(f"Invalid modification action: {action}")
-
+            _notice(notices, "Invalid action.", "danger")
+            log.append(f"Invalid modification action: {action}")
 
-    # Clear the pending modification in all cases after action
-    session.pop('pending_modification', None)
+        # Clear the pending modification in all cases after action
+        state['pending_modification'] = None
+        state['pending_base'] = None
+        return notices
 
-    # Save updated log and conversation
-    session['reallocation_log'] = log
-    session['ai_conversation'] = conversation
-
-    return redirect(url_for('display_plan'))
+    notices, _, _ = plan_store.update(plan_id, apply)
+    return notices
 
 
-# --- Reallocation Routes ---
+def _cancel_pending(state, notices, reason):
+    if state.get('pending_modification'):
+         state['pending_modification'] = None
+         state['pending_base'] = None
+         state['reallocation_log'].append(f"Pending AI modification cancelled due to {reason}.")
+         _notice(notices, "Pending AI modification cancelled.", "info")
 
-@app.route('/trigger_event', methods=['POST'])
-def trigger_event():
+def _run_trigger_event(plan_id, event_category, event_amount_str):
     """Handles dynamic reallocation based on user-defined event."""
-    current_budget = session.get('current_budget')
-    log = session.get('reallocation_log', [])
-    is_percentage = session.get('is_percentage_based', False) # Should be false now
-    currency = session.get('currency_symbol', '$')
-    current_budget_has_error = isinstance(current_budget, dict) and "Error" in current_budget
+    def reallocate(state):
+        notices = []
+        current_budget = state.get('current_budget')
+        state.setdefault('reallocation_log', [])
+        is_percentage = state.get('is_percentage_based', False) # Should be false now
+        current_budget_has_error = isinstance(current_budget, dict) and "Error" in current_budget
 
+        _cancel_pending(state, notices, "manual reallocation trigger")
 
-    if session.get('pending_modification'):
-         session.pop('pending_modification', None)
-         log.append("Pending AI modification cancelled due to manual reallocation trigger.")
-         flash("Pending AI modification cancelled.", "info")
+        if is_percentage or not current_budget or current_budget_has_error:
+            _notice(notices, "Cannot reallocate: Budget invalid or percentage-based.", "error")
+            return notices
+
+        if not event_category or not event_amount_str:
+            _notice(notices, "Category and amount required for event.", "warning")
+            return notices
+
+        # Perform reallocation using the dedicated function
+        new_budget, new_log, success = budget_operations.perform_reallocation(
+            event_category, event_amount_str, current_budget, state['reallocation_log'] # Pass amount as string initially
+        )
+        state['current_budget'] = new_budget
+        state['reallocation_log'] = new_log
+
+        if success:
+            _notice(notices, f"Reallocation processed for '{event_category}'.", 'success')
+        else:
+            # Failure message should be in the log now
+            _notice(notices, "Reallocation failed. Check activity log for details.", "danger")
+        return notices
 
+    notices, _, _ = plan_store.update(plan_id, reallocate)
+    return notices
 
-    if is_percentage or not current_budget or current_budget_has_error:
-        flash("Cannot reallocate: Budget invalid or percentage-based.", "error")
-        session['reallocation_log'] = log # Save cancellation log if applicable
-        return redirect(url_for('display_plan'))
 
-    event_category = request.form.get('event_category', '').strip()
-    event_amount_str = request.form.get('event_amount', '').strip()
+def _run_trigger_random_event(plan_id):
+    """Handles dynamic reallocation based on a random simulation."""
+    def reallocate(state):
+        notices = []
+        current_budget = state.get('current_budget')
+        state.setdefault('reallocation_log', [])
+        is_percentage = state.get('is_percentage_based', False) # Should be false now
+        currency = state.get('currency_symbol', '$')
+        current_budget_has_error = isinstance(current_budget, dict) and "Error" in current_budget
 
-    if not event_category or not event_amount_str:
-        flash("Category and amount required for event.", "warning")
-        session['reallocation_log'] = log
-        return redirect(url_for('display_plan'))
+        _cancel_pending(state, notices, "random event trigger")
 
-    # Perform reallocation using the dedicated function
-    new_budget, new_log, success = budget_operations.perform_reallocation(
-        event_category, event_amount_str, current_budget, log # Pass amount as string initially
-    )
+        if is_percentage or not current_budget or current_budget_has_error:
+            _notice(notices, "Cannot reallocate random event: Budget invalid or percentage-based.", "error")
+            return notices
+
+        # Filter for categories with actual funds (numeric and > 0)
+        valid_categories = [k for k, v in current_budget.items() if isinstance(v, (int, float)) and v > 0.005]
+        if not valid_categories:
+             _notice(notices, "Cannot trigger random event: No categories with positive funds available.", "warning")
+             return notices
+
+        # Choose a target (could be existing or new)
+        target_category = random.choice(valid_categories + ["Unforeseen Technical Issue", "Supplier Price Increase", "Emergency Repair"])
+
+        # Determine amount (e.g., 1-10% of total, within bounds)
+        current_total_budget = _budget_total(current_budget)
+        # Ensure max_possible_amount is reasonable even if total budget is small
+        max_possible_amount = max(50.0, current_total_budget * 0.10) if current_total_budget > 0 else 100.0
+        min_possible_amount = 25.0
+        # Ensure max isn't less than min if total budget is very small
+        max_amount = max(min_possible_amount, max_possible_amount)
+        event_amount = round(random.uniform(min_possible_amount, max_amount), 2)
+
+        # Perform reallocation
+        new_budget, new_log, success = budget_operations.perform_reallocation(
+            target_category, event_amount, current_budget, state['reallocation_log']
+        )
+        state['current_budget'] = new_budget
+        state['reallocation_log'] = new_log
+
+        if success:
+            _notice(notices, f"Random event simulation: {currency}{event_amount:.2f} allocated to '{target_category}'.", 'success')
+        else:
+             _notice(notices, "Random event reallocation failed. Check activity log.", "danger")
+        return notices
 
-    # Update session
-    session['current_budget'] = new_budget
-    session['reallocation_log'] = new_log
+    notices, _, _ = plan_store.update(plan_id, reallocate)
+    return notices
 
-    if success:
-        flash(f"Reallocation processed for '{event_category}'.", 'success')
-    else:
-        # Failure message should be in the log now
-        flash("Reallocation failed. Check activity log for details.", "danger")
 
+# --- Form Routes (post-redirect-get, used when JavaScript is unavailable) ---
+def _form_action(run_action, *args):
+    plan_id = session.get('plan_id')
+    if not plan_id:
+        flash("Please start by defining your project goal.", "warning")
+        return redirect(url_for('index'))
+    try:
+        notices = run_action(plan_id, *args)
+    except plan_store.PlanNotFound:
+        flash("This budget plan no longer exists. Please start over.", "warning")
+        return redirect(url_for('index'))
+    except plan_store.PlanConflict:
+        notices = [{'message': "The plan is being changed by another request. Please try again.", 'category': 'warning'}]
+    for notice in notices:
+        flash(notice['message'], notice['category'])
     return redirect(url_for('display_plan'))
 
+@app.route('/interact_ai', methods=['POST'])
+def interact_ai():
+    return _form_action(_run_interact_ai, request.form.get('ai_request', '').strip())
 
-@app.route('/trigger_random_event', methods=['POST'])
-def trigger_random_event():
-    """Handles dynamic reallocation based on a random simulation."""
-    current_budget = session.get('current_budget')
-    log = session.get('reallocation_log', [])
-    is_percentage = session.get('is_percentage_based', False) # Should be false now
-    currency = session.get('currency_symbol', '$')
-    current_budget_has_error = isinstance(current_budget, dict) and "Error" in current_budget
-
-
-    if session.get('pending_modification'):
-         session.pop('pending_modification', None)
-         log.append("Pending AI modification cancelled due to random event trigger.")
-         flash("Pending AI modification cancelled.", "info")
-
-    if is_percentage or not current_budget or current_budget_has_error:
-        flash("Cannot reallocate random event: Budget invalid or percentage-based.", "error")
-        session['reallocation_log'] = log
-        return redirect(url_for('display_plan'))
+@app.route('/apply_modification/<action>', methods=['POST'])
+def apply_modification(action):
+    return _form_action(_run_apply_modification, action)
 
-    # Filter for categories with actual funds (numeric and > 0)
-    valid_categories = [k for k, v in current_budget.items() if isinstance(v, (int, float)) and v > 0.005]
-    if not valid_categories:
-         flash("Cannot trigger random event: No categories with positive funds available.", "warning")
-         session['reallocation_log'] = log
-         return redirect(url_for('display_plan'))
-
-    # Choose a target (could be existing or new)
-    target_category = random.choice(valid_categories + ["Unforeseen Technical Issue", "Supplier Price Increase", "Emergency Repair"])
-
-    # Determine amount (e.g., 1-10% of total, within bounds)
-    current_total_budget = sum(v for v in current_budget.values() if isinstance(v, (int, float)))
-    # Ensure max_possible_amount is reasonable even if total budget is small
-    max_possible_amount = max(50.0, current_total_budget * 0.10) if current_total_budget > 0 else 100.0
-    min_possible_amount = 25.0
-    # Ensure max isn't less than min if total budget is very small
-    max_amount = max(min_possible_amount, max_possible_amount)
-    event_amount = round(random.uniform(min_possible_amount, max_amount), 2)
-
-
-    # Perform reallocation
-    new_budget, new_log, success = budget_operations.perform_reallocation(
-        target_category, event_amount, current_budget, log
+@app.route('/trigger_event', methods=['POST'])
+def trigger_event():
+    return _form_action(_run_trigger_event,
+        request.form.get('event_category', '').strip(), request.form.get('event_amount', '').strip()
     )
 
-    # Update session
-    session['current_budget'] = new_budget
-    session['reallocation_log'] = new_log
-
-    if success:
-        flash(f"Random event simulation: {currency}{event_amount:.2f} allocated to '{target_category}'.", 'success')
-    else:
-         flash("Random event reallocation failed. Check activity log.", "danger")
-
-    return redirect(url_for('display_plan'))
+@app.route('/trigger_random_event', methods=['POST'])
+def trigger_random_event():
+    return _form_action(_run_trigger_random_event)
+
+
+# --- JSON API (v1) ---
+# Same actions as the form routes, but one round-trip: the response carries the
+# updated budget, totals, chart data and only the log/conversation entries added
+# since the action started (including entries from concurrent requests).
+
+def _api_params():
+    """Accepts either a JSON body or regular form fields."""
+    return request.get_json(silent=True) or request.form
+
+def _plan_payload(plan, version, notices=None, log_start=0, conversation_start=0):
+    current_budget = plan.get('current_budget', {})
+    initial_budget = plan.get('initial_budget', {})
+    is_percentage = plan.get('is_percentage_based', False)
+    log = plan.get('reallocation_log', [])
+    chart_labels, chart_values = _chart_data(current_budget, initial_budget, is_percentage)
+    return {
+        'version': version,
+        'notices': notices or [],
+        'currency_symbol': plan.get('currency_symbol', '$'),
+        'is_percentage_based': is_percentage,
+        'current_budget': current_budget,
+        'initial_budget': initial_budget,
+        'current_total': round(_budget_total(current_budget), 2),
+        'initial_total': plan.get('initial_total', 0.0),
+        'pending_modification': plan.get('pending_modification'),
+        'budget_explanation': plan.get('budget_explanation'),
+        'proposal_pending': plan.get('proposal_pending', False),
+        'explanation_pending': plan.get('explanation_pending', False),
+        'research_pending': plan.get('research_pending', False),
+        'log_delta': log[log_start:],
+        'log_length': len(log),
+        # Conversation positions are absolute (the stored conversation is capped, see conversation_memory)
+        'conversation_delta': conversation_memory.messages_since(plan, conversation_start),
+        'conversation_length': conversation_memory.total_messages(plan),
+        'chart': {'labels': chart_labels or [], 'values': chart_values or []},
+    }
+
+def _api_action(run_action, *args):
+    """Runs an action and returns the plan payload with log/conversation deltas."""
+    plan_id = session.get('plan_id')
+    try:
+        before, _ = plan_store.load(plan_id) if plan_id else (None, None)
+        if not before:
+            raise plan_store.PlanNotFound(plan_id)
+        notices = run_action(plan_id, *args)
+        plan, version = plan_store.load(plan_id)
+    except plan_store.PlanNotFound:
+        return jsonify({'error': "No active plan. Start a new budget plan."}), 404
+    except plan_store.PlanConflict as e:
+        return jsonify({'error': str(e)}), 409
+    return jsonify(_plan_payload(plan, version, notices,
+                                 len(before.get('reallocation_log', [])), conversation_memory.total_messages(before)))
+
+@app.route('/api/v1/plan', methods=['GET'])
+def api_plan():
+    """Full current plan state (deltas are relative to an empty log/conversation)."""
+    plan_id = session.get('plan_id')
+    try:
+        plan, version = plan_store.load(plan_id)
+    except plan_store.PlanNotFound:
+        return jsonify({'error': "No active plan. Start a new budget plan."}), 404
+    return jsonify(_plan_payload(plan, version))
+
+@app.route('/api/v1/interact_ai', methods=['POST'])
+def api_interact_ai():
+    return _api_action(_run_interact_ai, str(_api_params().get('ai_request', '')).strip())
+
+@app.route('/api/v1/apply_modification/<action>', methods=['POST'])
+def api_apply_modification(action):
+    return _api_action(_run_apply_modification, action)
+
+@app.route('/api/v1/trigger_event', methods=['POST'])
+def api_trigger_event():
+    params = _api_params()
+    return _api_action(_run_trigger_event, str(params.get('event_category', '')).strip(), str(params.get('event_amount', '')).strip())
+
+@app.route('/api/v1/trigger_random_event', methods=['POST'])
+def api_trigger_random_event():
+    return _api_action(_run_trigger_random_event)
+
+
+# --- Export ---
+@app.route('/export/<fmt>')
+def export_plan(fmt):
+    """Streams the current plan as CSV, JSONL or columnar row groups (?sections=budget,log)."""
+    if fmt not in budget_export.FORMATS:
+        return jsonify({'error': f"Unknown export format '{fmt}'."}), 404
+    plan_id, plan = _load_plan()
+    if not plan:
+        flash("Please start by defining your project goal.", "warning")
+        return redirect(url_for('index'))
+    mimetype, extension = budget_export.FORMATS[fmt]
+    sections = budget_export.parse_sections(request.args.get('sections'))
+    response = Response(budget_export.iter_export(plan, fmt, sections, plan_id=plan_id), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="budget_plan_{plan_id[:8]}.{extension}"'
+    return response
+
+
+# --- Portfolio ---
+# Aggregates every user's plans: admin-only, same token check as /admin/profile and /admin/scheduler
+def _require_portfolio_token():
+    """Returns the token for links/forms; aborts 404 if the dashboard is disabled, 403 on a wrong token."""
+    if not portfolio.PORTFOLIO_ADMIN_TOKEN:
+        abort(404)
+    token = request.headers.get('X-Admin-Token') or request.args.get('token', '')
+    if not hmac.compare_digest(token.encode('utf-8'), portfolio.PORTFOLIO_ADMIN_TOKEN.encode('utf-8')):
+        abort(403)
+    return token
+
+def _portfolio_params():
+    goal = request.args.get('goal', '').strip() or None
+    since = request.args.get('since', '').strip() or None
+    if request.args.get('period') == 'quarter':
+        since = portfolio.quarter_start().isoformat()
+    return goal, since
+
+@app.route('/portfolio')
+def portfolio_view():
+    """Dashboard across all stored plans (?token=...&goal=bridge&since=2026-07-01 or &period=quarter)."""
+    token = _require_portfolio_token()
+    goal, since = _portfolio_params()
+    return render_template('portfolio.html', data=portfolio.summary(goal, since), goal=goal, since=since, token=token)
+
+@app.route('/api/v1/portfolio')
+def api_portfolio():
+    _require_portfolio_token()
+    goal, since = _portfolio_params()
+    return jsonify(portfolio.summary(goal, since))
 
 
 # --- Main Execution ---
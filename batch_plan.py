@@ -0,0 +1,265 @@
+"""
+Headless batch planning: runs the research -> digest -> proposal -> parse pipeline for many
+projects from a CSV or JSONL file, without the browser flow.
+
+Usage:
+    python batch_plan.py projects.csv --output results.jsonl --workers 4
+
+Input columns / keys:
+    id             (optional) stable project id, used for checkpoint file names
+    goal           project goal (required)
+    budget_amount  estimated total budget (required)
+    currency       symbol or code, e.g. '$', 'EUR' (optional, default '$')
+    answers        JSON object of {question: answer} (optional)
+    history_file   path to historical budget data, relative to the input file (optional)
+
+Each project's stage results are checkpointed to --checkpoint-dir as soon as a
+model call succeeds, so re-running the same command after an interruption
+skips every completed call and only finishes the remaining work. Checkpoints
+carry a fingerprint of the project's inputs (goal, amount, currency, answers,
+history content); if the row changed, its checkpoint is discarded. Project ids
+must be unique.
+"""
+import argparse
+import concurrent.futures
+import csv
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+
+import research_agent
+import blob_store
+import budget_operations
+import model_scheduler
+
+DEFAULT_WORKERS = 4
+DEFAULT_CHECKPOINT_DIR = '.batch_checkpoints'
+HISTORY_FILE_LIMIT = 100 * 1024 # Same cap as the web upload (MAX_UPLOAD_SIZE)
+
+
+# --- Input ---
+def read_projects(input_path):
+    """Reads a CSV or JSONL file into a list of project dicts (input order preserved)."""
+    projects = []
+    with open(input_path, 'r', encoding='utf-8', newline='') as f:
+        if input_path.lower().endswith(('.jsonl', '.ndjson')):
+            rows = _read_jsonl(f, input_path)
+        else:
+            rows = csv.DictReader(f)
+        for index, row in enumerate(rows):
+            row = {k.strip(): v for k, v in row.items() if k}
+            row.setdefault('id', '')
+            if not row['id']:
+                row['id'] = f"row-{index + 1}"
+            projects.append(row)
+    # Ids name the checkpoint files: ids that differ only in characters the file name can't hold
+    # ('proj 1', 'proj_1') would share (and race on) one checkpoint just like exact duplicates
+    by_file = {}
+    for project in projects:
+        by_file.setdefault(_checkpoint_path('', project['id']), []).append(str(project['id']))
+    clashes = sorted(' / '.join(repr(i) for i in ids) for ids in by_file.values() if len(ids) > 1)
+    if clashes:
+        raise ValueError(f"Duplicate project id(s) in '{input_path}' (after making them file names): {', '.join(clashes)}")
+    return projects
+
+def _read_jsonl(f, input_path):
+    for line_number, line in enumerate(f, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"Invalid JSON on line {line_number} of '{input_path}': {e}")
+        if not isinstance(row, dict):
+            raise ValueError(f"Line {line_number} of '{input_path}' is not a JSON object.")
+        yield row
+
+def _checkpoint_path(checkpoint_dir, project_id):
+    safe_id = re.sub(r'[^A-Za-z0-9_.-]', '_', str(project_id))
+    return os.path.join(checkpoint_dir, f"{safe_id}.json")
+
+def load_checkpoint(checkpoint_dir, project_id):
+    try:
+        with open(_checkpoint_path(checkpoint_dir, project_id), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_checkpoint(checkpoint_dir, project_id, state):
+    """Atomic write so a crash mid-write never leaves a corrupt checkpoint."""
+    path = _checkpoint_path(checkpoint_dir, project_id)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+def input_fingerprint(goal, budget_amount, currency_symbol, answers, history_blob_id):
+    """Hash of everything a project's results depend on; a checkpoint is only reused for the same inputs."""
+    payload = json.dumps([goal, budget_amount, currency_symbol, answers, history_blob_id], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _load_history(project, base_dir):
+    """Returns (prompt_text, blob_id) for the project's history file, or (None, None)."""
+    history_file = (project.get('history_file') or '').strip()
+    if not history_file:
+        return None, None
+    path = history_file if os.path.isabs(history_file) else os.path.join(base_dir, history_file)
+    with open(path, 'rb') as f:
+        blob_id = blob_store.put(f.read(HISTORY_FILE_LIMIT)) # Projects sharing a history file share its blob
+    if not blob_id:
+        return None, None
+    return blob_store.derived(blob_id, research_agent.HISTORY_PROMPT_ARTIFACT, research_agent.history_prompt_text), blob_id
+
+def _model_text_failed(text):
+    """True for the agents' failure strings (failed generation, errored or rejected call)."""
+    return not text or "generation failed" in text or "Error during AI call" in text
+
+def _parse_answers(raw):
+    if isinstance(raw, dict):
+        return raw
+    if not raw:
+        return {}
+    try:
+        answers = json.loads(raw)
+        return answers if isinstance(answers, dict) else {}
+    except ValueError:
+        return {'Additional context': raw} # Free text is still useful context
+
+
+# --- Pipeline ---
+def plan_project(project, base_dir, checkpoint_dir, explain=False):
+    """
+    Runs the agent pipeline for one project, resuming from its checkpoint.
+    Returns the result record written to the output file.
+    """
+    project_id = project['id']
+    result = {'id': project_id, 'goal': (project.get('goal') or '').strip()}
+    try:
+        budget_amount = float(str(project.get('budget_amount', '')).replace(',', ''))
+    except ValueError:
+        return dict(result, status='error', error=f"Invalid budget_amount '{project.get('budget_amount')}'.")
+    if len(result['goal']) < 5:
+        return dict(result, status='error', error="Goal must be at least 5 characters.")
+
+    currency_symbol = budget_operations.detect_currency_symbol(str(project.get('currency') or '').strip())
+    answers = _parse_answers(project.get('answers'))
+    try:
+        historical_data, history_blob_id = _load_history(project, base_dir)
+    except OSError as e:
+        return dict(result, status='error', error=f"Could not read history file: {e}")
+    result.update(budget_amount=budget_amount, currency_symbol=currency_symbol)
+
+    # Resume only from a checkpoint made for these exact inputs (the row may have been edited or reordered)
+    fingerprint = input_fingerprint(result['goal'], budget_amount, currency_symbol, answers, history_blob_id)
+    state = load_checkpoint(checkpoint_dir, project_id)
+    if state.get('fingerprint') != fingerprint:
+        if state:
+            print(f"Batch: Inputs for '{project_id}' changed since its checkpoint, starting over.")
+        state = {'fingerprint': fingerprint}
+    if state.get('done') and (not explain or 'explanation' in state['result']):
+        return state['result']
+
+    # 1. Research (checkpointed only on success so failures are retried on resume)
+    if 'research_summary' not in state:
+        research_summary = research_agent.run_research(result['goal'], answers, historical_data)
+        if _model_text_failed(research_summary):
+            return dict(result, status='error', error=f"Research failed: {research_summary}")
+        state['research_summary'] = research_summary
+        save_checkpoint(checkpoint_dir, project_id, state)
+
+    # 1b. Research digest (checkpointed only on success; this run then uses truncated research)
+    if 'research_digest' not in state:
+        research_digest = research_agent.digest_research(state['research_summary'], result['goal'])
+        if research_digest:
+            state['research_digest'] = research_digest
+            save_checkpoint(checkpoint_dir, project_id, state)
+    research_notes = research_agent.research_context(state['research_summary'], state.get('research_digest'))
+
+    # 2. Budget proposal + parse
+    if 'proposed_budget' not in state:
+        proposal = research_agent.generate_budget_proposal(
+            result['goal'], budget_amount, currency_symbol, answers, research_notes, historical_data
+        )
+        parsed_budget, is_percentage, total = budget_operations.parse_budget_proposal(proposal)
+        if "Error" in parsed_budget:
+            return dict(result, status='error', error=parsed_budget['Error'], research_summary=state['research_summary'])
+        state.update(proposed_budget=parsed_budget, is_percentage_based=is_percentage, total=total)
+        save_checkpoint(checkpoint_dir, project_id, state)
+
+    # 3. Optional explanation (checkpointed only on success, like research)
+    if explain and 'explanation' not in state:
+        explanation = research_agent.generate_explanation(
+            state['proposed_budget'], result['goal'], answers, research_notes, historical_data
+        )
+        if _model_text_failed(explanation):
+            return dict(result, status='error', error=f"Explanation failed: {explanation}",
+                        research_summary=state['research_summary'], proposed_budget=state['proposed_budget'])
+        state['explanation'] = explanation
+        save_checkpoint(checkpoint_dir, project_id, state)
+
+    result.update(
+        status='ok',
+        research_summary=state['research_summary'],
+        research_digest=state.get('research_digest'),
+        proposed_budget=state['proposed_budget'],
+        is_percentage_based=state['is_percentage_based'],
+        total=state['total'],
+    )
+    if 'explanation' in state:
+        result['explanation'] = state['explanation']
+    state.update(done=True, result=result)
+    save_checkpoint(checkpoint_dir, project_id, state)
+    return result
+
+
+def run_batch(input_path, output_path, checkpoint_dir=DEFAULT_CHECKPOINT_DIR, workers=DEFAULT_WORKERS, explain=False):
+    """Plans every project with a bounded worker pool and writes JSONL in input order."""
+    projects = read_projects(input_path)
+    base_dir = os.path.dirname(os.path.abspath(input_path))
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    print(f"Batch: {len(projects)} project(s), {workers} worker(s), checkpoints in '{checkpoint_dir}'.")
+
+    results = [None] * len(projects)
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        # Batch calls yield to interactive and planning calls when sharing the scheduler
+        with model_scheduler.caller('batch', priority='batch'):
+            plan = model_scheduler.bind(plan_project)
+        futures = {pool.submit(plan, p, base_dir, checkpoint_dir, explain): i for i, p in enumerate(projects)}
+        for done_count, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e: # Keep the batch going; this project is retried on the next run
+                print(f"Batch: Project '{projects[i]['id']}' crashed: {e}")
+                results[i] = {'id': projects[i]['id'], 'status': 'error', 'error': f"Unexpected error: {e}"}
+            print(f"Batch: [{done_count}/{len(projects)}] {projects[i]['id']} -> {results[i]['status']}")
+
+    with open(output_path, 'w', encoding='utf-8') as f:
+        for result in results:
+            f.write(json.dumps(result) + '\n')
+    failed = sum(1 for r in results if r['status'] != 'ok')
+    print(f"Batch: Wrote {len(results)} result(s) to '{output_path}' in {time.monotonic() - start:.1f}s ({failed} failed).")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate budget plans for many projects without the web UI.")
+    parser.add_argument('input', help="CSV or JSONL file of projects")
+    parser.add_argument('--output', '-o', default='batch_results.jsonl', help="JSONL results file")
+    parser.add_argument('--checkpoint-dir', default=DEFAULT_CHECKPOINT_DIR, help="Per-project checkpoint directory")
+    parser.add_argument('--workers', '-w', type=int, default=DEFAULT_WORKERS, help="Projects planned concurrently")
+    parser.add_argument('--explain', action='store_true', help="Also generate an explanation for each budget")
+    args = parser.parse_args(argv)
+    try:
+        results = run_batch(args.input, args.output, args.checkpoint_dir, max(1, args.workers), args.explain)
+    except ValueError as e: # Invalid input file, e.g. duplicate ids
+        parser.error(str(e))
+    return 0 if all(r['status'] == 'ok' for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
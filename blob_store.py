@@ -0,0 +1,199 @@
+"""
+Content-addressed store for uploaded files.
+
+An upload is stored once under the sha256 of its bytes; sessions and plans keep
+only that id, so re-uploading the same export (from any session or worker) is
+a hash and an exists() check instead of another decoded copy in a session
+pickle. Artifacts derived from a file (the parsed history table, the
+prompt-ready text sent to the agents) are cached against the id as well: in
+memory per process and as JSON next to the blob, so they are computed once
+across all sessions and workers. Cached artifacts are never recomputed, so
+artifact names carry a version that is bumped whenever the function computing
+them changes its output (a new name is computed fresh; the old files are just
+left unused).
+
+Blobs are garbage-collected: put() sweeps at most once per PURGE_INTERVAL_SECONDS
+and deletes blobs (with their artifacts) that no stored plan references and that
+nobody has uploaded for BLOB_TTL_SECONDS, which leaves time for a session to get
+from /start to /generate. Plans expire themselves (plan_store.purge_expired), so
+their blobs follow one sweep later.
+
+    blob_id = put(data_bytes)
+    text = get_text(blob_id)
+    table = derived(blob_id, budget_operations.HISTORY_TABLE_ARTIFACT, budget_operations.parse_history_table)
+"""
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+
+import plan_store
+
+# --- Configuration ---
+BLOB_STORE_DIR = os.environ.get(
+    'BLOB_STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blob_store')
+)
+MEMORY_CACHE_SIZE = 64 # Texts and derived artifacts kept in memory per process
+BLOB_TTL_SECONDS = float(os.environ.get('BLOB_TTL_SECONDS', 24 * 3600)) # Unreferenced blobs older than this are purged
+PURGE_INTERVAL_SECONDS = 3600 # put() sweeps for unreferenced blobs at most this often per process
+
+_cache = collections.OrderedDict() # (blob_id, name) -> value; name None is the text itself
+_cache_lock = threading.Lock()
+_last_purge = None
+
+
+class BlobNotFound(KeyError):
+    """No stored blob has the given id."""
+
+
+# --- Helpers ---
+def _path(blob_id, name=None):
+    if not blob_id or len(blob_id) != 64 or not all(c in '0123456789abcdef' for c in blob_id):
+        raise BlobNotFound(blob_id)
+    if name is None:
+        return os.path.join(BLOB_STORE_DIR, f"{blob_id}.txt")
+    if not all(c.isalnum() or c == '_' for c in name):
+        raise ValueError(f"Invalid artifact name: {name!r}")
+    return os.path.join(BLOB_STORE_DIR, f"{blob_id}.{name}.json")
+
+def _write_atomic(path, text):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path) # Concurrent writers of the same content are harmless
+
+def _cache_get(key):
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return True, _cache[key]
+    return False, None
+
+def _cache_put(key, value):
+    with _cache_lock:
+        _cache[key] = value
+        _cache.move_to_end(key)
+        while len(_cache) > MEMORY_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+# --- Public API ---
+def put(data):
+    """Stores uploaded bytes (decoded as UTF-8) once; returns the blob id, or None if they decode to nothing."""
+    _maybe_purge()
+    blob_id = hashlib.sha256(data).hexdigest()
+    path = _path(blob_id)
+    if os.path.exists(path):
+        try:
+            os.utime(path) # Re-uploaded: restarts its TTL
+            return blob_id # Already stored: skip decoding and writing
+        except FileNotFoundError:
+            pass # Purged in between: store it again
+    text = data.decode('utf-8', errors='ignore')
+    if not text.strip():
+        return None
+    os.makedirs(BLOB_STORE_DIR, exist_ok=True)
+    _write_atomic(path, text)
+    _cache_put((blob_id, None), text)
+    return blob_id
+
+def get_text(blob_id):
+    """The decoded content of a blob. Raises BlobNotFound."""
+    hit, text = _cache_get((blob_id, None))
+    if hit:
+        return text
+    try:
+        with open(_path(blob_id), 'r', encoding='utf-8') as f:
+            text = f.read()
+    except FileNotFoundError:
+        raise BlobNotFound(blob_id)
+    _cache_put((blob_id, None), text)
+    return text
+
+def derived(blob_id, name, compute):
+    """
+    compute(text) for this blob, cached under name (memory, then disk). The result
+    must be JSON-serializable; None is cached too. name should be versioned (e.g.
+    'history_table_v1') so that changing compute means changing name. Raises BlobNotFound.
+    """
+    key = (blob_id, name)
+    hit, value = _cache_get(key)
+    if hit:
+        return value
+    path = _path(blob_id, name)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            value = json.load(f)['value']
+    except (OSError, ValueError, KeyError):
+        value = compute(get_text(blob_id))
+        _write_atomic(path, json.dumps({'value': value}))
+        print(f"Blob store: Computed '{name}' for blob {blob_id[:12]}.")
+    _cache_put(key, value)
+    return value
+
+
+# --- Garbage Collection ---
+def referenced_blob_ids():
+    """Blob ids referenced by stored plans (their uploaded history)."""
+    referenced = set()
+    for plan_id in plan_store.iter_plan_ids():
+        try:
+            blob_id = plan_store.load(plan_id)[0].get('historical_data_id')
+        except (plan_store.PlanNotFound, ValueError):
+            continue
+        if blob_id:
+            referenced.add(blob_id)
+    return referenced
+
+def purge_unreferenced(referenced=None, max_age=BLOB_TTL_SECONDS):
+    """
+    Deletes blobs not in referenced (default: referenced_blob_ids()) and not
+    uploaded for max_age seconds, their derived artifacts, artifacts whose blob is
+    gone and temp files left by crashed writes. Returns the number of blobs deleted.
+    """
+    if not os.path.isdir(BLOB_STORE_DIR):
+        return 0
+    if referenced is None:
+        referenced = referenced_blob_ids()
+    cutoff = time.time() - max_age
+    filenames = os.listdir(BLOB_STORE_DIR)
+    expired = set()
+    for filename in filenames:
+        blob_id, _, suffix = filename.partition('.')
+        try:
+            if suffix == 'txt' and blob_id not in referenced and os.path.getmtime(os.path.join(BLOB_STORE_DIR, filename)) < cutoff:
+                expired.add(blob_id)
+        except FileNotFoundError:
+            continue
+    for filename in filenames:
+        blob_id, _, suffix = filename.partition('.')
+        path = os.path.join(BLOB_STORE_DIR, filename)
+        try:
+            if blob_id in expired:
+                os.remove(path)
+            elif suffix.endswith('.tmp') and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+            elif suffix.endswith('.json') and not os.path.exists(_path(blob_id)):
+                os.remove(path) # Artifact of a blob purged by another process
+        except (FileNotFoundError, BlobNotFound):
+            continue
+    with _cache_lock:
+        for key in [k for k in _cache if k[0] in expired]:
+            del _cache[key]
+    return len(expired)
+
+def _maybe_purge():
+    global _last_purge
+    now = time.monotonic()
+    with _cache_lock:
+        if _last_purge is not None and now - _last_purge < PURGE_INTERVAL_SECONDS:
+            return
+        _last_purge = now
+    try:
+        removed = purge_unreferenced()
+        if removed:
+            print(f"Blob store: Purged {removed} unreferenced blob(s) older than {BLOB_TTL_SECONDS / 3600:.0f}h.")
+    except OSError as e:
+        print(f"Blob store: Purge failed: {e}")
@@ -0,0 +1,180 @@
+"""
+Streaming export of a stored plan: current/initial budgets with variance and the
+reallocation log, as CSV (sample.csv's columns, with the plan's currency in the
+amount headers), JSONL, or a compact columnar form (JSON lines of
+column-oriented row groups). Multi-plan CSV exports start each row with the plan
+id and currency instead.
+
+Every format is a generator of text chunks, so the web route and the CLI start
+writing immediately and never build the whole output in memory. The plan itself
+is still loaded whole (plan_store keeps each plan as one JSON document), so
+memory is bounded by the largest single plan, not by the export: multi-plan
+exports load one plan at a time.
+
+CSV text cells come from users and the AI (category names, log entries); cells
+starting with a formula character are prefixed with ' so spreadsheets show
+them as text instead of evaluating them.
+
+Usage:
+    python budget_export.py <plan_id> [<plan_id> ...] --format csv -o plan.csv
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+
+import plan_store
+
+CSV_COLUMNS = ["Budget Item", "Category", "Estimated Cost ({currency})", "Allocated Budget ({currency})", "Comments"]
+MULTI_PLAN_CSV_COLUMNS = ["Plan ID", "Currency", "Budget Item", "Category", "Estimated Cost", "Allocated Budget", "Comments"]
+CURRENCY_CODES = {'$': 'USD', '€': 'EUR', '£': 'GBP', '¥': 'JPY', '₹': 'INR', 'CAD $': 'CAD', 'AUD $': 'AUD'}
+SECTIONS = ('budget', 'log')
+COLUMNAR_BATCH_SIZE = 1000 # Rows per row group in the columnar format
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r') # Spreadsheet formula triggers (CSV injection)
+
+FORMATS = {
+    # format: (mimetype, file extension)
+    'csv': ('text/csv', 'csv'),
+    'jsonl': ('application/x-ndjson', 'jsonl'),
+    'columnar': ('application/x-ndjson', 'columnar.jsonl'),
+}
+
+
+# --- Row Generators ---
+def iter_budget_rows(plan):
+    """One row per category: initial (proposed) vs current amount and the variance."""
+    initial = plan.get('initial_budget') or {}
+    current = plan.get('current_budget') or {}
+    if "Error" in initial:
+        initial = {}
+    if "Error" in current:
+        current = {}
+    seen = set()
+    for category in list(initial) + list(current): # Proposal order first, then categories added later
+        if category in seen:
+            continue
+        seen.add(category)
+        initial_amount = initial.get(category)
+        current_amount = current.get(category)
+        variance = None
+        if isinstance(initial_amount, (int, float)) and isinstance(current_amount, (int, float)):
+            variance = round(current_amount - initial_amount, 2)
+        yield {
+            'section': 'budget',
+            'item': category,
+            'category': 'Contingency' if 'contingency' in category.lower() else 'Allocation',
+            'initial': initial_amount,
+            'current': current_amount,
+            'variance': variance,
+        }
+
+def iter_log_rows(plan):
+    for index, entry in enumerate(plan.get('reallocation_log') or [], start=1):
+        yield {'section': 'log', 'index': index, 'entry': entry}
+
+def iter_rows(plan, sections=SECTIONS):
+    if 'budget' in sections:
+        yield from iter_budget_rows(plan)
+    if 'log' in sections:
+        yield from iter_log_rows(plan)
+
+
+# --- Formats ---
+def _csv_cell(value):
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+def _csv_line(values):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow([_csv_cell(v) for v in values])
+    return buffer.getvalue()
+
+def currency_code(plan):
+    symbol = plan.get('currency_symbol') or '$'
+    return CURRENCY_CODES.get(symbol, symbol)
+
+def iter_csv(plan, sections=SECTIONS, header=True, plan_id=None):
+    """sample.csv columns for one plan; with plan_id, the multi-plan layout (plan id and currency per row)."""
+    currency = currency_code(plan)
+    prefix = [plan_id, currency] if plan_id else []
+    if header:
+        yield _csv_line(MULTI_PLAN_CSV_COLUMNS if plan_id else [c.format(currency=currency) for c in CSV_COLUMNS])
+    for row in iter_rows(plan, sections):
+        if row['section'] == 'budget':
+            comment = f"Variance: {row['variance']:+.2f}" if row['variance'] is not None else ("Added after proposal" if row['initial'] is None else "Removed")
+            yield _csv_line(prefix + [row['item'], row['category'], row['initial'] if row['initial'] is not None else '',
+                                      row['current'] if row['current'] is not None else '', comment])
+        else:
+            yield _csv_line(prefix + [f"Activity Log #{row['index']}", 'Log', '', '', row['entry']])
+
+def iter_jsonl(plan, sections=SECTIONS, plan_id=None):
+    for row in iter_rows(plan, sections):
+        if plan_id:
+            row['plan_id'] = plan_id
+        yield json.dumps(row) + '\n'
+
+def iter_columnar(plan, sections=SECTIONS, plan_id=None, batch_size=COLUMNAR_BATCH_SIZE):
+    """Row groups of up to batch_size rows per section: {"section", "plan_id", "columns": {name: [values]}}."""
+    group = None
+    for row in iter_rows(plan, sections):
+        section = row.pop('section')
+        if group and (group['section'] != section or group['rows'] >= batch_size):
+            yield json.dumps({'section': group['section'], 'plan_id': plan_id, 'rows': group['rows'], 'columns': group['columns']}) + '\n'
+            group = None
+        if group is None:
+            group = {'section': section, 'rows': 0, 'columns': {name: [] for name in row}}
+        for name, value in row.items():
+            group['columns'][name].append(value)
+        group['rows'] += 1
+    if group:
+        yield json.dumps({'section': group['section'], 'plan_id': plan_id, 'rows': group['rows'], 'columns': group['columns']}) + '\n'
+
+def iter_export(plan, fmt, sections=SECTIONS, plan_id=None, header=True, multi_plan=False):
+    """Dispatches to the generator for fmt ('csv', 'jsonl' or 'columnar'). multi_plan adds plan ids to CSV rows."""
+    if fmt == 'csv':
+        return iter_csv(plan, sections, header=header, plan_id=plan_id if multi_plan else None)
+    if fmt == 'jsonl':
+        return iter_jsonl(plan, sections, plan_id=plan_id)
+    if fmt == 'columnar':
+        return iter_columnar(plan, sections, plan_id=plan_id)
+    raise ValueError(f"Unknown export format '{fmt}'. Choose from: {', '.join(FORMATS)}")
+
+def parse_sections(raw):
+    """'budget,log' -> ('budget', 'log'); unknown names are ignored, empty means all."""
+    requested = tuple(s.strip() for s in (raw or '').split(',') if s.strip() in SECTIONS)
+    return requested or SECTIONS
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export stored budget plans.")
+    parser.add_argument('plan_ids', nargs='*', help="Plan ids to export (default: all stored plans)")
+    parser.add_argument('--format', '-f', choices=sorted(FORMATS), default='csv')
+    parser.add_argument('--sections', default='budget,log', help="Comma-separated: budget, log")
+    parser.add_argument('--output', '-o', help="Output file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    sections = parse_sections(args.sections)
+    plan_ids = args.plan_ids or plan_store.iter_plan_ids()
+    multi_plan = len(args.plan_ids) != 1 # Rows from several plans need the plan id to be told apart
+    out = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    try:
+        first = True
+        for plan_id in plan_ids:
+            try:
+                plan, _ = plan_store.load(plan_id)
+            except plan_store.PlanNotFound:
+                print(f"Export: Plan '{plan_id}' not found, skipping.", file=sys.stderr)
+                continue
+            for chunk in iter_export(plan, args.format, sections, plan_id=plan_id, header=first, multi_plan=multi_plan):
+                out.write(chunk)
+            first = False
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,35 @@
 import copy
+import csv
+import io
+import re
+
+# --- Currency Detection (shared by the web app and the batch CLI) ---
+def detect_currency_symbol(text):
+    """Detects common currency symbols or keywords in text."""
+    if not text: return '$' # Default if text is empty
+    text_lower = text.lower()
+    # Order matters - check specific symbols first
+    if '£' in text: return '£'
+    if '€' in text: return '€'
+    if '¥' in text: return '¥'
+    if '₹' in text: return '₹'
+    if '$' in text:
+        # Distinguish between USD, CAD, AUD etc. if needed by checking keywords
+        if 'cad' in text_lower or 'canadian' in text_lower: return 'CAD $' # Example
+        if 'aud' in text_lower or 'australian' in text_lower: return 'AUD $' # Example
+        return '$' # Default $
+    # Check keywords
+    if 'pound' in text_lower or 'gbp' in text_lower: return '£'
+    if 'euro' in text_lower or 'eur' in text_lower: return '€'
+    if 'yen' in text_lower or 'jpy' in text_lower: return '¥'
+    if 'rupee' in text_lower or 'inr' in text_lower: return '₹'
+    if 'dollar' in text_lower: return '$' # Default $ if just "dollar"
+    # Fallback: If user entered something like 'USD', return it directly
+    if len(text.strip()) <= 4: # Assume short codes are intended symbols/codes
+         return text.strip().upper()
+    # Default
+    return '$'
+
 
 def parse_budget_proposal(proposal_dict):
     """
@@ -84,6 +115,104 @@ def parse_budget_proposal(proposal_dict):
         return ({'Error': 'No valid budget entries found after parsing.'}, True, None)
 
 
+# --- Local Draft Budget (from uploaded history, no AI call) ---
+DRAFT_CONTINGENCY_MIN = 0.05 # Share of the total budget
+DRAFT_CONTINGENCY_MAX = 0.20
+HISTORY_TABLE_ARTIFACT = 'history_table_v1' # blob_store artifact name; bump when parse_history_table's output changes
+
+def _parse_amount(value):
+    """Float from a history cell like '$1,200' (None if not numeric)."""
+    try:
+        return float(re.sub(r'[$,£€\s]', '', value or ''))
+    except ValueError:
+        return None
+
+def parse_history_table(historical_data):
+    """
+    Category totals from uploaded history: a CSV with a Category column and
+    Allocated/Estimated amount columns, like sample.csv. Returns
+    {'mix': {category: amount}, 'allocated_total', 'estimated_total'} (allocated
+    amounts preferred for the mix), or None if the text has no such structure.
+    JSON-serializable, so blob_store can cache it per uploaded file.
+    """
+    if not historical_data:
+        return None
+    try:
+        reader = csv.DictReader(io.StringIO(historical_data.strip()))
+        fields = [f for f in (reader.fieldnames or []) if f]
+        category_col = next((f for f in fields if 'category' in f.lower()), None)
+        allocated_col = next((f for f in fields if 'allocated' in f.lower()), None)
+        estimated_col = next((f for f in fields if 'estimat' in f.lower()), None)
+        amount_col = allocated_col or estimated_col
+        if not category_col or not amount_col:
+            return None
+
+        mix = {}
+        allocated_total = estimated_total = 0.0
+        for row in reader:
+            category = (row.get(category_col) or '').strip()
+            amount = _parse_amount(row.get(amount_col))
+            if not category or amount is None or amount < 0:
+                continue
+            mix[category] = mix.get(category, 0.0) + amount
+            if allocated_col and estimated_col:
+                allocated, estimated = _parse_amount(row.get(allocated_col)), _parse_amount(row.get(estimated_col))
+                if allocated is not None and estimated is not None:
+                    allocated_total += allocated
+                    estimated_total += estimated
+    except csv.Error as e:
+        print(f"Draft budget: Could not read history as CSV ({e}).")
+        return None
+    if not mix:
+        return None
+    return {'mix': mix, 'allocated_total': allocated_total, 'estimated_total': estimated_total}
+
+def draft_budget_from_table(history_table, budget_amount):
+    """
+    Builds a provisional budget by scaling a parse_history_table() category mix
+    to budget_amount. Contingency gets the larger of the history's contingency
+    share and its allocated-over-estimate overrun, clamped to
+    DRAFT_CONTINGENCY_MIN..MAX. Returns a dict like parse_budget_proposal's
+    dollar-based result, or None if the history has no usable structure.
+    """
+    if not history_table or not budget_amount or budget_amount <= 0:
+        return None
+    mix = history_table['mix']
+    history_total = sum(mix.values())
+    contingency_key = next((k for k in mix if 'contingency' in k.lower()), 'Contingency')
+    base_mix = {k: v for k, v in mix.items() if k != contingency_key and v > 0}
+    if history_total <= 0 or not base_mix:
+        return None
+
+    # Contingency: what the history set aside, or how far allocations ran over estimates, whichever is larger
+    history_share = mix.get(contingency_key, 0.0) / history_total
+    estimated_total = history_table['estimated_total']
+    overrun = history_table['allocated_total'] / estimated_total - 1 if estimated_total > 0 else 0.0
+    contingency_share = min(DRAFT_CONTINGENCY_MAX, max(DRAFT_CONTINGENCY_MIN, history_share, overrun))
+
+    distributable = budget_amount * (1 - contingency_share)
+    base_total = sum(base_mix.values())
+    draft = {k: round(distributable * v / base_total, 2) for k, v in base_mix.items()}
+    draft[contingency_key] = round(budget_amount - sum(draft.values()), 2) # Rounding remainder lands in contingency
+
+    parsed_budget, is_percentage, _ = parse_budget_proposal(draft) # Same rules as an AI proposal
+    if is_percentage or "Error" in parsed_budget:
+        return None
+    return parsed_budget
+
+def budget_diff(old_budget, new_budget):
+    """Per-category rows {'category', 'old', 'new', 'change'} between two numeric budgets, largest change first."""
+    rows = []
+    for category in set(old_budget or {}) | set(new_budget or {}):
+        old = (old_budget or {}).get(category)
+        new = (new_budget or {}).get(category)
+        old = old if isinstance(old, (int, float)) else None
+        new = new if isinstance(new, (int, float)) else None
+        change = round((new or 0.0) - (old or 0.0), 2)
+        rows.append({'category': category, 'old': old, 'new': new, 'change': change})
+    return sorted(rows, key=lambda row: (-abs(row['change']), row['category']))
+
+
 def find_source_funds(amount_needed, current_budget_state):
     """
     Finds where to pull funds from based on rules. Enhanced logic.
@@ -228,4 +357,21 @@ def perform_reallocation(event_category, amount_needed, current_budget_state, lo
     new_log.append(f"--- Reallocation Complete for '{clean_event_category}' ---")
     print("Reallocation successful.")
 
-    return new_budget, new_log, True
\ No newline at end of file
+    return new_budget, new_log, True
+
+def merge_budget_delta(base_budget, proposed_budget, current_budget):
+    """
+    Three-way merge for budgets that changed concurrently.
+    Applies the per-category change (proposed - base) on top of current_budget.
+    Returns (merged_budget, conflicts) where conflicts lists categories that would go negative.
+    """
+    merged = dict(current_budget)
+    for category in set(base_budget) | set(proposed_budget):
+        delta = round(proposed_budget.get(category, 0.0) - base_budget.get(category, 0.0), 2)
+        if delta:
+            merged[category] = round(merged.get(category, 0.0) + delta, 2)
+        # A category the proposal removed stays removed if nothing else refilled it
+        if category not in proposed_budget and abs(merged.get(category, 0.0)) < 0.005:
+            merged.pop(category, None)
+    conflicts = sorted(k for k, v in merged.items() if isinstance(v, (int, float)) and v < -0.005)
+    return merged, conflicts
@@ -0,0 +1,108 @@
+"""
+Bounded conversation memory for the Q&A and modification agents.
+
+The prompt gets a constant-size view of the chat: a rolling summary of older
+turns plus the most recent turns verbatim. The summary is refreshed
+incrementally in the background (one small model call per batch of new turns),
+so no request waits for it. The stored ai_conversation is also capped; messages
+dropped from the front are counted in 'conversation_dropped' so absolute
+positions (used by the summary and by API deltas) stay stable.
+
+Plan state keys:
+    ai_conversation         [{'user': ...} | {'ai': ...}, ...] (most recent MAX_STORED_MESSAGES)
+    conversation_dropped    messages removed from the front of ai_conversation
+    conversation_memory     {'summary': str, 'summarized_upto': absolute message count}
+"""
+import concurrent.futures
+import threading
+
+import model_scheduler
+import plan_store
+import research_agent
+
+RECENT_MESSAGES = 6 # Last turns kept verbatim in prompts (3 user/AI exchanges)
+SUMMARY_BATCH = 4 # Older messages accumulated before a background summary refresh
+MESSAGE_PROMPT_CHARS = 500 # Per-message cap inside prompts
+SUMMARY_MAX_CHARS = 1200 # Cap on the rolling summary
+MAX_STORED_MESSAGES = 200 # Cap on the stored/displayed conversation
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='conversation-summary')
+_in_flight = set() # plan_ids with a refresh running
+_lock = threading.Lock()
+
+
+# --- Conversation State ---
+def total_messages(state):
+    """Absolute number of messages ever added to the plan's conversation."""
+    return state.get('conversation_dropped', 0) + len(state.get('ai_conversation', []))
+
+def messages_since(state, absolute_start):
+    """Stored messages at absolute positions >= absolute_start (older ones may have been dropped)."""
+    return state.get('ai_conversation', [])[max(0, absolute_start - state.get('conversation_dropped', 0)):]
+
+def append(state, *messages):
+    """Adds messages and trims the stored conversation to MAX_STORED_MESSAGES."""
+    conversation = state.get('ai_conversation', []) + list(messages)
+    overflow = len(conversation) - MAX_STORED_MESSAGES
+    if overflow > 0:
+        conversation = conversation[overflow:]
+        state['conversation_dropped'] = state.get('conversation_dropped', 0) + overflow
+    state['ai_conversation'] = conversation
+
+
+# --- Prompt View ---
+def _format_message(message):
+    speaker, text = ('User', message['user']) if message.get('user') else ('AI', message.get('ai', ''))
+    text = ' '.join(str(text).split())
+    if len(text) > MESSAGE_PROMPT_CHARS:
+        text = text[:MESSAGE_PROMPT_CHARS] + '...'
+    return f"{speaker}: {text}"
+
+def format_for_prompt(state):
+    """Summary + recent turns, bounded regardless of conversation length. '' if there is no history."""
+    memory = state.get('conversation_memory') or {}
+    unsummarized = messages_since(state, memory.get('summarized_upto', 0))
+    # Normally <= RECENT_MESSAGES + SUMMARY_BATCH; the cap holds even if refreshes fall behind
+    recent = unsummarized[-(RECENT_MESSAGES + SUMMARY_BATCH):]
+    parts = []
+    if memory.get('summary'):
+        parts.append(f"Summary of earlier conversation: {memory['summary']}")
+    if recent:
+        parts.append("Recent conversation:\n" + "\n".join(_format_message(m) for m in recent))
+    return "\n".join(parts)
+
+
+# --- Background Summary Refresh ---
+def maybe_refresh(plan_id, state):
+    """Schedules a summary refresh when enough messages have aged out of the recent window."""
+    memory = state.get('conversation_memory') or {}
+    start = memory.get('summarized_upto', 0)
+    end = total_messages(state) - RECENT_MESSAGES
+    if end - start < SUMMARY_BATCH:
+        return False
+    with _lock:
+        if plan_id in _in_flight:
+            return False
+        _in_flight.add(plan_id)
+    to_summarize = messages_since(state, start)[:end - max(start, state.get('conversation_dropped', 0))]
+    _executor.submit(model_scheduler.bind(_refresh), plan_id, memory.get('summary', ''), to_summarize, start, end)
+    return True
+
+def _refresh(plan_id, previous_summary, messages, start, end):
+    try:
+        summary = research_agent.summarize_conversation(previous_summary, [_format_message(m) for m in messages])
+        if not summary:
+            return
+        summary = summary.strip()[:SUMMARY_MAX_CHARS]
+        def commit(state):
+            memory = state.get('conversation_memory') or {}
+            if memory.get('summarized_upto', 0) != start: # Another refresh got there first
+                return
+            state['conversation_memory'] = {'summary': summary, 'summarized_upto': end}
+        plan_store.update(plan_id, commit)
+        print(f"Memory: Summarized messages {start}-{end} for plan {plan_id[:8]}.")
+    except Exception as e:
+        print(f"Memory: Summary refresh failed for plan {plan_id[:8]}: {e}")
+    finally:
+        with _lock:
+            _in_flight.discard(plan_id)
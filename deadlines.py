@@ -0,0 +1,85 @@
+"""
+End-to-end latency budget for plan generation.
+
+/generate gets PLAN_SLA_SECONDS in total. Each model stage runs on a worker
+thread and the request waits for it only up to that stage's deadline; a stage
+that overruns keeps running in the background and its result is written into
+the stored plan when it lands (see app._complete_* helpers), so the page renders
+on time with whatever finished and fills in the rest later.
+
+Stage deadlines are shares of the SLA, capped by what is left, while keeping
+STAGE_MIN_SECONDS in reserve for each later stage so one slow stage cannot eat
+the whole budget.
+"""
+import concurrent.futures
+import os
+import time
+
+import model_scheduler
+import profiler
+
+PLAN_SLA_SECONDS = float(os.environ.get('PLAN_SLA_SECONDS', 60))
+STAGES = ('research', 'digest', 'proposal', 'explanation') # In pipeline order
+STAGE_SHARES = {'research': 0.45, 'digest': 0.1, 'proposal': 0.35, 'explanation': 1.0} # Of the SLA, before capping (explanation: whatever is left)
+STAGE_MIN_SECONDS = 2.0 # Reserved for each later stage
+STAGE_WORKERS = int(os.environ.get('PLAN_STAGE_WORKERS', 16))
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix='plan-stage')
+
+
+class Deadline:
+    """Tracks the remaining plan-generation budget and hands out per-stage timeouts."""
+
+    def __init__(self, total_seconds=PLAN_SLA_SECONDS):
+        self.total = total_seconds
+        self.started = time.monotonic()
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def remaining(self):
+        return max(0.0, self.total - self.elapsed())
+
+    def stage_timeout(self, stage):
+        later_stages = len(STAGES) - STAGES.index(stage) - 1
+        available = self.remaining() - later_stages * STAGE_MIN_SECONDS
+        return max(0.0, min(self.total * STAGE_SHARES[stage], available))
+
+
+def submit(fn, *args, **kwargs):
+    """Starts fn on a stage worker, keeping the caller's model scheduler context and active profile."""
+    return _executor.submit(profiler.bind(model_scheduler.bind(fn)), *args, **kwargs)
+
+def wait(future, timeout, stage=None):
+    """
+    Returns (True, result) if the future finished within timeout, else (False, None).
+    The future keeps running; an exception raised by fn propagates.
+    """
+    try:
+        return True, future.result(timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        if stage:
+            print(f"Deadline: Stage '{stage}' overran its {timeout:.1f}s deadline, continuing in the background.")
+        return False, None
+
+def when_done(future, callback, *args, run_on_failure=False):
+    """
+    Runs callback(result, *args) on a stage worker once future finishes successfully (logs failures).
+    With run_on_failure, a failed future still runs the callback, with None as its result.
+    """
+    bound = profiler.bind(model_scheduler.bind(callback)) # Done-callbacks run outside the caller's context
+    def run(result):
+        try:
+            bound(result, *args)
+        except Exception as e:
+            print(f"Deadline: Background completion {getattr(callback, '__name__', callback)} failed: {e}")
+    def on_done(done_future):
+        try:
+            result = done_future.result()
+        except Exception as e:
+            print(f"Deadline: Background stage failed: {e}")
+            if not run_on_failure:
+                return
+            result = None
+        _executor.submit(run, result) # Never run follow-up model calls on the request thread
+    future.add_done_callback(on_done)
@@ -0,0 +1,266 @@
+import collections
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
+import google.generativeai as genai
+
+import model_scheduler
+
+# --- Default Routing ---
+# Tiers trade quality for latency; each agent function is routed to one tier and
+# falls back to the others when its tier fails or misses the deadline.
+DEFAULT_TIERS = {
+    'fast': {'model': 'gemini-1.5-flash-8b', 'deadline': 20},
+    'standard': {'model': 'gemini-1.5-flash', 'deadline': 45},
+    'large': {'model': 'gemini-1.5-pro', 'deadline': 90},
+}
+DEFAULT_ROUTES = {
+    'questions': 'fast',
+    'qna': 'fast',
+    'memory': 'fast',
+    'digest': 'fast', # Extraction only; runs once per plan on the /generate path
+    'modification': 'standard',
+    'proposal': 'standard',
+    'explanation': 'standard',
+    'research': 'large',
+    'research_refine': 'standard', # Short addendum to a prefetched draft
+}
+DEFAULT_TIER = 'standard'
+
+LATENCY_WINDOW = 100 # Recent samples kept per tier (and per agent on each tier) for percentiles
+EWMA_ALPHA = 0.2 # Weight of the newest sample in the moving averages
+UNHEALTHY_ERROR_RATE = 0.5 # Tiers above this are tried last
+
+# Hedging: when a plan-generation call is still running at its agent's p95 latency
+# on that tier, a duplicate request is sent and whichever answers first wins. The
+# duplicate needs a free model scheduler slot of its own, so hedges never push
+# calls in flight past MODEL_CONCURRENCY or jump ahead of queued calls.
+HEDGED_AGENTS = {'questions', 'research', 'research_refine', 'digest', 'proposal', 'explanation'}
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20 # Percentiles from fewer samples are too noisy to hedge on
+HEDGE_MIN_DELAY = 1.0 # Seconds; never hedge earlier than this
+HEDGE_WORKERS = 16
+
+
+class TierStats:
+    """Observed latency and error rate for one tier (thread-safe)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.hedges = 0
+        self.hedge_wins = 0 # Hedged calls answered first by the duplicate
+        self.hedges_skipped = 0 # Hedges not sent because no scheduler slot was free
+        self.latency_ewma = None
+        self.error_rate = 0.0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def record(self, elapsed, ok, timed_out=False):
+        with self._lock:
+            self.calls += 1
+            self.errors += 0 if ok else 1
+            self.timeouts += 1 if timed_out else 0
+            self.error_rate = (1 - EWMA_ALPHA) * self.error_rate + EWMA_ALPHA * (0.0 if ok else 1.0)
+            if ok:
+                self.latencies.append(elapsed)
+                self.latency_ewma = elapsed if self.latency_ewma is None else (1 - EWMA_ALPHA) * self.latency_ewma + EWMA_ALPHA * elapsed
+
+    def record_hedge(self, duplicate_won):
+        with self._lock:
+            self.hedges += 1
+            self.hedge_wins += 1 if duplicate_won else 0
+
+    def record_hedge_skipped(self):
+        with self._lock:
+            self.hedges_skipped += 1
+
+    def percentile(self, pct, min_samples=1):
+        with self._lock:
+            samples = sorted(self.latencies)
+        if len(samples) < max(1, min_samples):
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+    def snapshot(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'hedges_skipped': self.hedges_skipped,
+            'error_rate': round(self.error_rate, 3),
+            'latency_ewma': round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+            'latency_p95': self.percentile(95),
+        }
+
+
+class ModelRouter:
+    """Routes agent calls to model tiers with deadline- and error-driven fallback."""
+
+    def __init__(self, tiers=None, routes=None):
+        self.tiers = self.merge_tiers(tiers)
+        self.routes = dict(DEFAULT_ROUTES, **(routes or {}))
+        self.stats = {name: TierStats() for name in self.tiers}
+        self.agent_stats = {} # (agent, tier) -> TierStats; stages differ too much to share a tier-wide p95
+        self._agent_stats_lock = threading.Lock()
+        self._models = {}
+        self._models_lock = threading.Lock()
+        self._hedge_pool = concurrent.futures.ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix='model-hedge')
+
+    @staticmethod
+    def merge_tiers(overrides=None):
+        """
+        DEFAULT_TIERS with overrides applied one tier at a time: keys given for a tier
+        replace the default's, new tiers are added, and a tier set to null is removed.
+        A tier without a model is skipped.
+        """
+        tiers = {name: dict(config) for name, config in DEFAULT_TIERS.items()}
+        for name, config in (overrides or {}).items():
+            if config is None:
+                tiers.pop(name, None)
+                continue
+            merged = dict(tiers.get(name, {}), **config)
+            if not merged.get('model'):
+                print(f"Warning: Model tier '{name}' has no model, ignoring it.")
+                continue
+            tiers[name] = merged
+        return tiers or {name: dict(config) for name, config in DEFAULT_TIERS.items()}
+
+    @classmethod
+    def from_env(cls):
+        """
+        Reads MODEL_ROUTING (a JSON string or a path to a JSON file) shaped like
+        {"tiers": {"fast": {"model": "...", "deadline": 20}}, "routes": {"qna": "fast"}}.
+        Tiers are merged into DEFAULT_TIERS (see merge_tiers), so the example only
+        changes the fast tier and keeps the others for fallback.
+        """
+        raw = os.environ.get('MODEL_ROUTING', '').strip()
+        if not raw:
+            return cls()
+        try:
+            if os.path.isfile(raw):
+                with open(raw, 'r', encoding='utf-8') as f:
+                    config = json.load(f)
+            else:
+                config = json.loads(raw)
+        except (OSError, ValueError) as e:
+            print(f"Warning: Invalid MODEL_ROUTING config ({e}). Using defaults.")
+            return cls()
+        return cls(tiers=config.get('tiers'), routes=config.get('routes'))
+
+    def _model(self, tier):
+        with self._models_lock:
+            if tier not in self._models:
+                self._models[tier] = genai.GenerativeModel(self.tiers[tier]['model'])
+            return self._models[tier]
+
+    def _agent_stats(self, agent, tier):
+        with self._agent_stats_lock:
+            if (agent, tier) not in self.agent_stats:
+                self.agent_stats[(agent, tier)] = TierStats()
+            return self.agent_stats[(agent, tier)]
+
+    def tier_for(self, agent):
+        tier = self.routes.get(agent, DEFAULT_TIER)
+        return tier if tier in self.tiers else next(iter(self.tiers))
+
+    def candidates(self, agent):
+        """Routed tier first, then the other tiers: healthy before unhealthy, faster first."""
+        primary = self.tier_for(agent)
+        def health_key(tier):
+            stats = self.stats[tier]
+            return (stats.error_rate > UNHEALTHY_ERROR_RATE, stats.latency_ewma if stats.latency_ewma is not None else 0.0)
+        fallbacks = sorted((t for t in self.tiers if t != primary), key=health_key)
+        return [primary] + fallbacks
+
+    def generate(self, agent, prompt, generation_config=None):
+        """
+        Calls the agent's tier, falling back tier by tier on errors or deadline overruns.
+        Returns (response, tier_name). Raises the last error if every tier fails.
+        """
+        last_error = None
+        for tier in self.candidates(agent):
+            deadline = self.tiers[tier].get('deadline', 60)
+            kwargs = {'request_options': {'timeout': deadline}}
+            if generation_config:
+                kwargs['generation_config'] = generation_config
+            start = time.monotonic()
+            try:
+                hedge_delay = self._hedge_delay(agent, tier)
+                if hedge_delay is None or hedge_delay >= deadline:
+                    response = self._model(tier).generate_content(prompt, **kwargs)
+                else:
+                    response = self._generate_hedged(agent, tier, prompt, kwargs, hedge_delay)
+            except Exception as e:
+                elapsed = time.monotonic() - start
+                timed_out = elapsed >= deadline or 'deadline' in str(e).lower() or 'timeout' in str(e).lower()
+                self.stats[tier].record(elapsed, ok=False, timed_out=timed_out)
+                self._agent_stats(agent, tier).record(elapsed, ok=False, timed_out=timed_out)
+                print(f"Router: Tier '{tier}' failed for '{agent}' after {elapsed:.1f}s ({e}). Falling back.")
+                last_error = e
+                continue
+            elapsed = time.monotonic() - start
+            self.stats[tier].record(elapsed, ok=True)
+            self._agent_stats(agent, tier).record(elapsed, ok=True)
+            print(f"Router: '{agent}' served by tier '{tier}' in {elapsed:.1f}s.")
+            return response, tier
+        raise last_error or RuntimeError("No model tiers configured.")
+
+    def _hedge_delay(self, agent, tier):
+        """Seconds after which to hedge this call (the agent's p95 on this tier), or None when not hedging."""
+        if agent not in HEDGED_AGENTS:
+            return None
+        p95 = self._agent_stats(agent, tier).percentile(HEDGE_PERCENTILE, min_samples=HEDGE_MIN_SAMPLES)
+        return max(HEDGE_MIN_DELAY, p95) if p95 is not None else None
+
+    def _generate_hedged(self, agent, tier, prompt, kwargs, hedge_delay):
+        """
+        Sends the request; if it hasn't answered after hedge_delay and a scheduler
+        slot is free, sends a duplicate and returns the first successful response.
+        The caller already holds a slot for the original. The slower call is left
+        to finish and its result is discarded (in-flight HTTP calls can't be
+        cancelled); the duplicate's slot is released when it finishes.
+        """
+        model = self._model(tier)
+        first = self._hedge_pool.submit(model.generate_content, prompt, **kwargs)
+        done, _ = concurrent.futures.wait([first], timeout=hedge_delay)
+        if done:
+            return first.result()
+        if not model_scheduler.scheduler.try_acquire():
+            self.stats[tier].record_hedge_skipped()
+            return first.result()
+        print(f"Router: '{agent}' passed its p95 on tier '{tier}' ({hedge_delay:.1f}s), sending a hedged request.")
+        try:
+            second = self._hedge_pool.submit(model.generate_content, prompt, **kwargs)
+        except RuntimeError: # Pool shut down
+            model_scheduler.scheduler.release()
+            return first.result()
+        second.add_done_callback(lambda _: model_scheduler.scheduler.release())
+        pending = {first, second}
+        last_error = None
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self.stats[tier].record_hedge(duplicate_won=future is second)
+                    return future.result()
+                last_error = future.exception()
+        self.stats[tier].record_hedge(duplicate_won=False)
+        raise last_error
+
+    def snapshot(self):
+        """Per-tier stats, per-agent latency and the current routing table, for logging/admin views."""
+        with self._agent_stats_lock:
+            agent_stats = dict(self.agent_stats)
+        return {
+            'routes': {agent: self.tier_for(agent) for agent in self.routes},
+            'tiers': {name: dict(self.tiers[name], **self.stats[name].snapshot()) for name in self.tiers},
+            'agents': {f"{agent}@{tier}": {'calls': s.calls, 'latency_p95': s.percentile(95)}
+                       for (agent, tier), s in sorted(agent_stats.items())},
+        }
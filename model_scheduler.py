@@ -0,0 +1,279 @@
+"""
+Priority-aware fair scheduler for model calls.
+
+Every _call_gemini goes through scheduler.slot(agent), which limits calls in
+flight to MODEL_CONCURRENCY and decides who goes next when calls queue up:
+
+    1. Priority class: interactive (Q&A, edits) > planning (questions, research,
+       proposal, explanation) > batch (batch CLI, background summaries).
+    2. Within a class, weighted fair queuing per user: each call gets a virtual
+       finish tag max(class virtual time, user's last tag) + 1/weight, and the
+       lowest tag runs first, so a user with many queued calls (a /generate, a
+       batch run) cannot starve one with a single quick question.
+
+Queues are bounded per class and per user; over the limit, or after waiting
+longer than the class's max wait, a call is rejected immediately with
+SchedulerRejected rather than piling up. Queue wait per class is tracked and
+exposed via snapshot() and /admin/scheduler.
+
+Who is calling is thread-local: the web app sets the user per request (read
+from the session only once the request actually makes a model call), the
+batch CLI uses caller('batch', priority='batch'), and work handed to executors
+keeps its caller through bind().
+"""
+import collections
+import contextlib
+import functools
+import heapq
+import hmac
+import json
+import os
+import threading
+import time
+
+PRIORITIES = ('interactive', 'planning', 'batch') # Highest first
+AGENT_PRIORITIES = {
+    'qna': 'interactive',
+    'modification': 'interactive',
+    'questions': 'planning',
+    'research': 'planning',
+    'research_refine': 'planning',
+    'digest': 'planning',
+    'proposal': 'planning',
+    'explanation': 'planning',
+    'memory': 'batch', # Background summary refresh, nobody waits on it
+}
+DEFAULT_PRIORITY = 'planning'
+
+MODEL_CONCURRENCY = int(os.environ.get('MODEL_CONCURRENCY', 8)) # Model calls in flight per process
+MAX_QUEUE_DEPTH = {'interactive': 32, 'planning': 64, 'batch': 256} # Waiting calls per class
+MAX_USER_QUEUED = {'interactive': 4, 'planning': 6, 'batch': None} # Waiting calls per user per class (None = no limit)
+MAX_WAIT_SECONDS = {'interactive': 15, 'planning': 60, 'batch': None}
+WAIT_WINDOW = 500 # Recent wait samples kept per class for percentiles
+SCHEDULER_ADMIN_TOKEN = os.environ.get('SCHEDULER_ADMIN_TOKEN', os.environ.get('PROFILER_ADMIN_TOKEN'))
+
+
+class SchedulerRejected(RuntimeError):
+    """The call was not queued (queue full) or waited too long (max wait exceeded)."""
+
+
+# --- Caller Context ---
+_caller = threading.local()
+
+def set_caller(user=None, priority=None):
+    """user may be a callable; it is resolved the first time a model call asks who is calling."""
+    _caller.user = user
+    _caller.priority = priority
+
+def clear_caller():
+    set_caller(None, None)
+
+def current_caller():
+    user = getattr(_caller, 'user', None)
+    if callable(user):
+        user = _caller.user = user()
+    return user, getattr(_caller, 'priority', None)
+
+@contextlib.contextmanager
+def caller(user, priority=None):
+    """Attributes model calls made inside the block to user (and optionally forces their priority)."""
+    previous = current_caller()
+    set_caller(user, priority)
+    try:
+        yield
+    finally:
+        set_caller(*previous)
+
+def bind(fn):
+    """Wraps fn so it runs with the current caller context, e.g. when submitted to an executor."""
+    user, priority = current_caller()
+    @functools.wraps(fn)
+    def bound(*args, **kwargs):
+        with caller(user, priority):
+            return fn(*args, **kwargs)
+    return bound
+
+
+# --- Scheduler ---
+class WaitStats:
+    """Queue wait and rejections for one priority class."""
+
+    def __init__(self):
+        self.waits = collections.deque(maxlen=WAIT_WINDOW)
+        self.calls = 0
+        self.rejected = 0
+
+    def percentile(self, pct):
+        if not self.waits:
+            return None
+        ordered = sorted(self.waits)
+        return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class ModelScheduler:
+    def __init__(self, concurrency=MODEL_CONCURRENCY, weights=None):
+        self.concurrency = concurrency
+        self.weights = weights or {} # user -> weight (default 1)
+        self._cond = threading.Condition()
+        self._queues = {p: [] for p in PRIORITIES} # heap of (tag, seq, user)
+        self._queued_by_user = {p: collections.Counter() for p in PRIORITIES}
+        self._virtual_time = {p: 0.0 for p in PRIORITIES}
+        self._user_tags = {p: {} for p in PRIORITIES} # user -> last finish tag
+        self._seq = 0
+        self._in_flight = 0
+        self.stats = {p: WaitStats() for p in PRIORITIES}
+
+    @classmethod
+    def from_env(cls):
+        """MODEL_SCHEDULER_WEIGHTS='{"batch": 0.5}' gives some users a smaller (or larger) share."""
+        weights = {}
+        raw = os.environ.get('MODEL_SCHEDULER_WEIGHTS')
+        if raw:
+            try:
+                weights = {str(k): float(v) for k, v in json.loads(raw).items() if float(v) > 0}
+            except (ValueError, AttributeError) as e:
+                print(f"Scheduler: Ignoring invalid MODEL_SCHEDULER_WEIGHTS ({e}).")
+        return cls(weights=weights)
+
+    def _next_up(self):
+        """(priority, seq) of the call that should run next, or None if nothing waits."""
+        for priority in PRIORITIES:
+            if self._queues[priority]:
+                return priority, self._queues[priority][0][1]
+        return None
+
+    def acquire(self, agent):
+        """Blocks until this call may run. Returns (priority, seconds waited); raises SchedulerRejected."""
+        user, forced_priority = current_caller()
+        user = user or 'anonymous'
+        priority = forced_priority or AGENT_PRIORITIES.get(agent, DEFAULT_PRIORITY)
+        stats = self.stats[priority]
+        enqueued = time.monotonic()
+        with self._cond:
+            stats.calls += 1
+            tag = max(self._virtual_time[priority], self._user_tags[priority].get(user, 0.0)) + 1.0 / self.weights.get(user, 1.0)
+            if self._in_flight < self.concurrency and self._next_up() is None: # Idle: no queueing, but still charge the user
+                self._user_tags[priority][user] = tag
+                self._virtual_time[priority] = tag
+                self._in_flight += 1
+                stats.waits.append(0.0)
+                return priority, 0.0
+            user_limit = MAX_USER_QUEUED[priority]
+            if len(self._queues[priority]) >= MAX_QUEUE_DEPTH[priority] or (
+                    user_limit is not None and self._queued_by_user[priority][user] >= user_limit):
+                stats.rejected += 1
+                raise SchedulerRejected(f"Model queue full for {priority} calls, try again shortly.")
+
+            self._user_tags[priority][user] = tag
+            self._seq += 1
+            seq = self._seq
+            heapq.heappush(self._queues[priority], (tag, seq, user))
+            self._queued_by_user[priority][user] += 1
+
+            max_wait = MAX_WAIT_SECONDS[priority]
+            deadline = enqueued + max_wait if max_wait else None
+            while not (self._in_flight < self.concurrency and self._next_up() == (priority, seq)):
+                remaining = deadline - time.monotonic() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    self._remove(priority, seq, user)
+                    stats.rejected += 1
+                    self._cond.notify_all()
+                    raise SchedulerRejected(f"Waited more than {max_wait}s for a model slot ({priority}).")
+                self._cond.wait(remaining)
+
+            heapq.heappop(self._queues[priority])
+            self._queued_by_user[priority][user] -= 1
+            self._virtual_time[priority] = tag
+            self._in_flight += 1
+            self._prune_tags(priority)
+            waited = time.monotonic() - enqueued
+            stats.waits.append(waited)
+            self._cond.notify_all() # The next head may also be able to start
+        return priority, waited
+
+    def try_acquire(self):
+        """Takes a slot only if one is free and nobody is queued (e.g. for a hedged duplicate). Returns True on success."""
+        with self._cond:
+            if self._in_flight >= self.concurrency or self._next_up() is not None:
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def _remove(self, priority, seq, user):
+        queue = self._queues[priority]
+        queue[:] = [entry for entry in queue if entry[1] != seq]
+        heapq.heapify(queue)
+        self._queued_by_user[priority][user] -= 1
+
+    def _prune_tags(self, priority):
+        # Tags at or below virtual time no longer affect ordering
+        tags = self._user_tags[priority]
+        if len(tags) > 1000:
+            virtual_time = self._virtual_time[priority]
+            for user in [u for u, t in tags.items() if t <= virtual_time]:
+                del tags[user]
+
+    @contextlib.contextmanager
+    def slot(self, agent):
+        priority, waited = self.acquire(agent)
+        if waited >= 0.5:
+            print(f"Scheduler: '{agent}' ({priority}) waited {waited:.1f}s for a model slot.")
+        try:
+            yield
+        finally:
+            self.release()
+
+    def snapshot(self):
+        """Queue depth, in-flight calls, rejections and queue wait percentiles per class."""
+        with self._cond:
+            return {
+                'concurrency': self.concurrency,
+                'in_flight': self._in_flight,
+                'classes': {
+                    p: {
+                        'queued': len(self._queues[p]),
+                        'calls': s.calls,
+                        'rejected': s.rejected,
+                        'wait_p50_ms': round(s.percentile(50) * 1000, 1) if s.waits else None,
+                        'wait_p95_ms': round(s.percentile(95) * 1000, 1) if s.waits else None,
+                        'wait_max_ms': round(max(s.waits) * 1000, 1) if s.waits else None,
+                    }
+                    for p, s in self.stats.items()
+                },
+            }
+
+
+scheduler = ModelScheduler.from_env()
+
+
+# --- Flask Integration ---
+def init_app(app):
+    """Attributes each request's model calls to its browser session; adds /admin/scheduler when a token is set."""
+    from flask import abort, jsonify, request, session
+
+    def session_user():
+        return getattr(session, 'sid', None) or request.remote_addr
+
+    @app.before_request
+    def scheduler_caller():
+        # Resolved lazily: requests that make no model call (assets, polling) never look at the session
+        set_caller(user=session_user)
+
+    @app.teardown_request
+    def scheduler_clear(exc):
+        clear_caller()
+
+    if not SCHEDULER_ADMIN_TOKEN:
+        return
+
+    @app.route('/admin/scheduler')
+    def admin_scheduler():
+        token = request.headers.get('X-Admin-Token') or request.args.get('token', '')
+        if not hmac.compare_digest(token.encode('utf-8'), SCHEDULER_ADMIN_TOKEN.encode('utf-8')):
+            abort(403)
+        return jsonify(scheduler.snapshot())
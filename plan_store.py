@@ -0,0 +1,206 @@
+import copy
+import json
+import os
+import threading
+import time
+import uuid
+
+try:
+    import fcntl # POSIX: cross-process locking between workers
+except ImportError:
+    fcntl = None
+
+# --- Configuration ---
+PLAN_STORE_DIR = os.environ.get(
+    'PLAN_STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plan_store')
+)
+MAX_CAS_RETRIES = 8 # Attempts before update() gives up with PlanConflict
+PLAN_TTL_SECONDS = float(os.environ.get('PLAN_TTL_SECONDS', 7 * 24 * 3600)) # Plans not written for this long are purged
+PURGE_INTERVAL_SECONDS = 3600 # create() sweeps for expired plans at most this often per process
+
+_thread_locks = {} # plan_id -> [lock, holders]; dropped once nobody holds or waits for it
+_thread_locks_guard = threading.Lock()
+_last_purge = None
+
+
+class PlanNotFound(KeyError):
+    """No stored plan has the given id."""
+
+
+class PlanConflict(RuntimeError):
+    """The plan kept changing underneath update(); retries were exhausted."""
+
+
+# --- Helpers ---
+def _plan_path(plan_id):
+    if not plan_id or not all(c.isalnum() or c in '-_' for c in plan_id):
+        raise PlanNotFound(plan_id)
+    return os.path.join(PLAN_STORE_DIR, f"{plan_id}.json")
+
+class _PlanLock:
+    """Exclusive lock for one plan: a thread lock plus flock on a sidecar file when available."""
+
+    def __init__(self, plan_id):
+        self.plan_id = plan_id
+        self.path = _plan_path(plan_id) + '.lock'
+        self.entry = None
+        self.handle = None
+
+    def __enter__(self):
+        with _thread_locks_guard:
+            self.entry = _thread_locks.setdefault(self.plan_id, [threading.Lock(), 0])
+            self.entry[1] += 1 # Counted before waiting, so the lock is not dropped under a waiter
+        self.entry[0].acquire()
+        if fcntl:
+            self.handle = open(self.path, 'a')
+            fcntl.flock(self.handle, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self.handle:
+            fcntl.flock(self.handle, fcntl.LOCK_UN)
+            self.handle.close()
+        self.entry[0].release()
+        with _thread_locks_guard:
+            self.entry[1] -= 1
+            if self.entry[1] == 0:
+                del _thread_locks[self.plan_id]
+
+def _read(plan_id):
+    try:
+        with open(_plan_path(plan_id), 'r', encoding='utf-8') as f:
+            record = json.load(f)
+    except FileNotFoundError:
+        raise PlanNotFound(plan_id)
+    return record['state'], record['version']
+
+def _write(plan_id, state, version):
+    path = _plan_path(plan_id)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': version, 'state': state}, f)
+    os.replace(tmp_path, path) # Readers see the old or the new record, never a partial one
+
+
+# --- Public API ---
+def create(state):
+    """Stores a new plan at version 1 and returns its id."""
+    os.makedirs(PLAN_STORE_DIR, exist_ok=True)
+    _maybe_purge()
+    plan_id = uuid.uuid4().hex
+    _write(plan_id, state, 1)
+    _notify(plan_id, None, state, 1)
+    return plan_id
+
+def load(plan_id):
+    """Returns (state, version). Lock-free: writes are atomic renames."""
+    return _read(plan_id)
+
+def compare_and_swap(plan_id, expected_version, new_state):
+    """Writes new_state only if the stored version is still expected_version. Returns the new version or None."""
+    with _PlanLock(plan_id):
+        old_state, version = _read(plan_id)
+        if version != expected_version:
+            return None
+        _write(plan_id, new_state, version + 1)
+    _notify(plan_id, old_state, new_state, version + 1)
+    return version + 1
+
+def update(plan_id, mutate, max_retries=MAX_CAS_RETRIES):
+    """
+    Optimistic read-modify-write. mutate(state) edits a private copy in place and
+    returns any value; on a version conflict it is re-run against the fresh state,
+    so it must not have side effects outside that copy.
+    Returns (mutate_result, new_state, new_version).
+    """
+    for attempt in range(max_retries):
+        state, version = _read(plan_id)
+        working = copy.deepcopy(state)
+        result = mutate(working)
+        new_version = compare_and_swap(plan_id, version, working)
+        if new_version is not None:
+            return result, working, new_version
+        print(f"Plan store: Version conflict on plan {plan_id} (attempt {attempt + 1}), retrying.")
+    raise PlanConflict(f"Plan {plan_id} changed {max_retries} times during update.")
+
+def delete(plan_id, idle_before=None):
+    """
+    Removes the plan and its lock file while holding the plan's lock, so no write
+    is half-way through. A writer already waiting on the lock then finds no plan.
+    With idle_before (epoch seconds), a plan written since then is kept.
+    Returns True if the plan was deleted.
+    """
+    path = _plan_path(plan_id)
+    with _PlanLock(plan_id) as lock:
+        try:
+            if idle_before is not None and os.path.getmtime(path) >= idle_before:
+                return False # A live plan keeps its lock file: unlinking it would let two writers lock different files
+            os.remove(path)
+            deleted = True
+        except FileNotFoundError:
+            deleted = False
+        try:
+            os.remove(lock.path) # Still flocked; whoever locks next, on either file, finds no plan
+        except FileNotFoundError:
+            pass
+    return deleted
+
+def purge_expired(max_age=PLAN_TTL_SECONDS):
+    """
+    Deletes plans not written for max_age seconds, plus lock files of deleted
+    plans and temp files left by crashed writes. Returns the number of plans
+    deleted. Their portfolio rows are kept (see portfolio.rebuild).
+    """
+    if not os.path.isdir(PLAN_STORE_DIR):
+        return 0
+    cutoff = time.time() - max_age
+    removed = 0
+    for filename in os.listdir(PLAN_STORE_DIR):
+        path = os.path.join(PLAN_STORE_DIR, filename)
+        try:
+            if os.path.getmtime(path) >= cutoff:
+                continue
+            if filename.endswith('.json'):
+                removed += delete(filename[:-len('.json')], idle_before=cutoff) # Rechecked under the lock
+            elif filename.endswith('.tmp') or (filename.endswith('.lock') and not os.path.exists(path[:-len('.lock')])):
+                os.remove(path)
+        except (FileNotFoundError, PlanNotFound):
+            continue
+    return removed
+
+def _maybe_purge():
+    global _last_purge
+    now = time.monotonic()
+    with _thread_locks_guard:
+        if _last_purge is not None and now - _last_purge < PURGE_INTERVAL_SECONDS:
+            return
+        _last_purge = now
+    try:
+        removed = purge_expired()
+        if removed:
+            print(f"Plan store: Purged {removed} plan(s) idle for over {PLAN_TTL_SECONDS / 3600:.0f}h.")
+    except OSError as e:
+        print(f"Plan store: Purge failed: {e}")
+
+def iter_plan_ids():
+    """Ids of every stored plan (used for rebuilds and exports)."""
+    if not os.path.isdir(PLAN_STORE_DIR):
+        return
+    for filename in os.listdir(PLAN_STORE_DIR):
+        if filename.endswith('.json'):
+            yield filename[:-len('.json')]
+
+
+# --- Change Listeners ---
+# Called after every successful write as listener(plan_id, old_state, new_state, version).
+_listeners = []
+
+def add_listener(listener):
+    _listeners.append(listener)
+
+def _notify(plan_id, old_state, new_state, version):
+    for listener in _listeners:
+        try:
+            listener(plan_id, old_state, new_state, version)
+        except Exception as e: # A broken listener must never fail the write
+            print(f"Plan store: Listener {getattr(listener, '__name__', listener)} failed: {e}")
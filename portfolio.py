@@ -0,0 +1,390 @@
+"""
+Portfolio analytics across all stored plans.
+
+A SQLite index (stdlib, no server) holds one row per plan, one row per plan
+category and one row per budget change event. Aggregates by category are kept
+in their own table and adjusted incrementally on every plan write (via a
+plan_store listener), so dashboard queries read a few pre-summed rows instead of
+loading every plan. The listener only queues the write: a background thread
+applies queued snapshots in batched transactions, off the request path.
+
+Usage:
+    python portfolio.py rebuild                 # re-index every plan in plan_store
+    python portfolio.py summary --goal bridge --period quarter
+"""
+import argparse
+import atexit
+import datetime
+import json
+import os
+import queue
+import sqlite3
+import sys
+import threading
+
+import plan_store
+
+PORTFOLIO_DB = os.environ.get(
+    'PORTFOLIO_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'portfolio.sqlite3')
+)
+# The dashboard aggregates every user's plans, so like the other admin views it needs a token
+PORTFOLIO_ADMIN_TOKEN = os.environ.get('PORTFOLIO_ADMIN_TOKEN', os.environ.get('PROFILER_ADMIN_TOKEN'))
+
+# Amounts are only ever summed within one currency. Bump SCHEMA_VERSION when the
+# tables change: an older index is dropped and rebuilt from plan_store.
+SCHEMA_VERSION = 2
+TABLES = ('plans', 'plan_categories', 'events', 'category_totals')
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plans (
+    plan_id TEXT PRIMARY KEY,
+    goal TEXT,
+    currency TEXT,
+    created_at TEXT,
+    updated_at TEXT,
+    version INTEGER,
+    initial_total REAL,
+    current_total REAL,
+    contingency_initial REAL,
+    contingency_current REAL,
+    reallocation_count INTEGER DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS plan_categories (
+    plan_id TEXT,
+    category_key TEXT,
+    currency TEXT,
+    initial_amount REAL,
+    current_amount REAL,
+    PRIMARY KEY (plan_id, category_key)
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    plan_id TEXT,
+    ts TEXT,
+    category_key TEXT,
+    currency TEXT,
+    is_contingency INTEGER,
+    delta REAL
+);
+CREATE INDEX IF NOT EXISTS idx_events_contingency_ts ON events (is_contingency, ts);
+CREATE INDEX IF NOT EXISTS idx_events_plan ON events (plan_id);
+CREATE INDEX IF NOT EXISTS idx_plans_created ON plans (created_at);
+CREATE TABLE IF NOT EXISTS category_totals (
+    currency TEXT,
+    category_key TEXT,
+    plans INTEGER DEFAULT 0,
+    initial_total REAL DEFAULT 0,
+    current_total REAL DEFAULT 0,
+    reallocations INTEGER DEFAULT 0,
+    PRIMARY KEY (currency, category_key)
+);
+"""
+
+# Plan writes only queue their snapshot; one writer thread applies them in batches
+SNAPSHOT_QUEUE_SIZE = int(os.environ.get('PORTFOLIO_QUEUE_SIZE', 10000))
+WRITE_BATCH_SIZE = 200
+
+_local = threading.local()
+_pending = queue.Queue(maxsize=SNAPSHOT_QUEUE_SIZE)
+_writer_lock = threading.Lock()
+_writer_started = False
+
+
+# --- Connection ---
+def _connect():
+    """One connection per thread; WAL lets dashboard reads run alongside writes."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(PORTFOLIO_DB, timeout=10, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        _local.conn = conn
+        if _migrate(conn):
+            rebuild()
+    return conn
+
+def _migrate(conn):
+    """Creates the tables, replacing an index built by an older schema. Returns True if it needs a rebuild."""
+    conn.execute('BEGIN IMMEDIATE') # One process migrates; the others then see the new version
+    try:
+        outdated = conn.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION
+        if outdated:
+            for table in TABLES:
+                conn.execute(f'DROP TABLE IF EXISTS {table}')
+        for statement in SCHEMA.split(';'):
+            if statement.strip():
+                conn.execute(statement)
+        if outdated:
+            conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    if outdated:
+        print(f"Portfolio: Index schema changed (v{SCHEMA_VERSION}), rebuilding from plan_store.")
+    return outdated
+
+def _category_key(category):
+    return ' '.join(str(category).split()).lower()
+
+def _numeric_budget(budget):
+    if not isinstance(budget, dict) or "Error" in budget:
+        return {}
+    merged = {}
+    for category, amount in budget.items():
+        if isinstance(amount, (int, float)):
+            key = _category_key(category)
+            merged[key] = merged.get(key, 0.0) + amount
+    return merged
+
+def _contingency(budget):
+    return sum(v for k, v in budget.items() if 'contingency' in k)
+
+
+# --- Incremental Maintenance ---
+def _snapshot(plan_id, old_state, new_state, version):
+    """
+    Reduces one plan write to the plain values the index stores: the plan row,
+    its categories and one event per category whose current amount changed.
+    The write that stores a late AI proposal (replacing the placeholder or
+    provisional draft) is not a reallocation and logs no events.
+    """
+    now = datetime.datetime.utcnow().isoformat()
+    initial = _numeric_budget(new_state.get('initial_budget'))
+    current = _numeric_budget(new_state.get('current_budget'))
+    previous = _numeric_budget(old_state.get('current_budget')) if old_state else {}
+    changes = {k: round(current.get(k, 0.0) - previous.get(k, 0.0), 2) for k in set(current) | set(previous)}
+    generated = bool(old_state and old_state.get('proposal_pending') and not new_state.get('proposal_pending'))
+    changes = {k: d for k, d in changes.items() if abs(d) >= 0.005} if old_state and not generated else {}
+    return {'plan_id': plan_id, 'version': version, 'ts': now, 'goal': new_state.get('goal'),
+            'currency': new_state.get('currency_symbol', '$'), 'created_at': new_state.get('created_at') or now,
+            'initial': initial, 'current': current, 'changes': changes}
+
+def _apply(conn, snap):
+    """Adjusts the plan row, its categories and the category aggregates by the difference from the indexed snapshot."""
+    plan_id, currency, initial, current = snap['plan_id'], snap['currency'], snap['initial'], snap['current']
+    # Events are per write, so they are recorded even if a newer snapshot was indexed first
+    for key, delta in snap['changes'].items():
+        conn.execute('INSERT INTO events (plan_id, ts, category_key, currency, is_contingency, delta) VALUES (?, ?, ?, ?, ?, ?)',
+                     (plan_id, snap['ts'], key, currency, int('contingency' in key), delta))
+        conn.execute('INSERT INTO category_totals (currency, category_key, reallocations) VALUES (?, ?, 1) '
+                     'ON CONFLICT(currency, category_key) DO UPDATE SET reallocations = reallocations + 1', (currency, key))
+
+    row = conn.execute('SELECT version FROM plans WHERE plan_id = ?', (plan_id,)).fetchone()
+    if row is None or row['version'] < snap['version']:
+        # Back out this plan's old contribution, then add the new one
+        for old in conn.execute('SELECT * FROM plan_categories WHERE plan_id = ?', (plan_id,)).fetchall():
+            conn.execute('UPDATE category_totals SET plans = plans - 1, initial_total = initial_total - ?, '
+                         'current_total = current_total - ? WHERE currency = ? AND category_key = ?',
+                         (old['initial_amount'], old['current_amount'], old['currency'], old['category_key']))
+        conn.execute('DELETE FROM plan_categories WHERE plan_id = ?', (plan_id,))
+        for key in set(initial) | set(current):
+            initial_amount, current_amount = initial.get(key, 0.0), current.get(key, 0.0)
+            conn.execute('INSERT INTO plan_categories VALUES (?, ?, ?, ?, ?)', (plan_id, key, currency, initial_amount, current_amount))
+            conn.execute('INSERT INTO category_totals (currency, category_key, plans, initial_total, current_total) VALUES (?, ?, 1, ?, ?) '
+                         'ON CONFLICT(currency, category_key) DO UPDATE SET plans = plans + 1, '
+                         'initial_total = initial_total + excluded.initial_total, current_total = current_total + excluded.current_total',
+                         (currency, key, initial_amount, current_amount))
+        conn.execute('INSERT INTO plans (plan_id, goal, currency, created_at, updated_at, version, initial_total, current_total, '
+                     'contingency_initial, contingency_current, reallocation_count) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0) '
+                     'ON CONFLICT(plan_id) DO UPDATE SET goal = excluded.goal, currency = excluded.currency, '
+                     'updated_at = excluded.updated_at, version = excluded.version, initial_total = excluded.initial_total, '
+                     'current_total = excluded.current_total, contingency_initial = excluded.contingency_initial, '
+                     'contingency_current = excluded.contingency_current',
+                     (plan_id, snap['goal'], currency, snap['created_at'], snap['ts'], snap['version'],
+                      sum(initial.values()), sum(current.values()), _contingency(initial), _contingency(current)))
+    if snap['changes']:
+        conn.execute('UPDATE plans SET reallocation_count = reallocation_count + 1 WHERE plan_id = ?', (plan_id,))
+
+def _write(snapshots):
+    """Applies snapshots in one transaction, so a burst of plan writes costs one commit."""
+    conn = _connect()
+    conn.execute('BEGIN IMMEDIATE') # Serializes writers across threads and processes
+    try:
+        for snap in snapshots:
+            _apply(conn, snap)
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+def record_snapshot(plan_id, old_state, new_state, version):
+    """Indexes one plan write right away (rebuild and the CLI; the app queues them instead)."""
+    _write([_snapshot(plan_id, old_state, new_state, version)])
+
+def rebuild():
+    """Drops the index and re-indexes every stored plan (no event history before the rebuild)."""
+    conn = _connect()
+    for table in TABLES:
+        conn.execute(f'DELETE FROM {table}')
+    count, batch = 0, []
+    for plan_id in plan_store.iter_plan_ids():
+        try:
+            state, version = plan_store.load(plan_id)
+        except (plan_store.PlanNotFound, ValueError):
+            continue
+        batch.append(_snapshot(plan_id, None, state, version))
+        count += 1
+        if len(batch) >= WRITE_BATCH_SIZE:
+            _write(batch)
+            batch = []
+    if batch:
+        _write(batch)
+    print(f"Portfolio: Indexed {count} plan(s).")
+    return count
+
+
+# --- Background Writer ---
+def _writer_loop():
+    while True:
+        batch = [_pending.get()]
+        while len(batch) < WRITE_BATCH_SIZE:
+            try:
+                batch.append(_pending.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _write(batch)
+        except Exception as e:
+            print(f"Portfolio: Batch of {len(batch)} snapshot(s) failed ({e}), retrying one by one.")
+            for snap in batch:
+                try:
+                    _write([snap])
+                except Exception as e:
+                    print(f"Portfolio: Dropped snapshot of plan {snap['plan_id']} v{snap['version']}: {e}")
+        finally:
+            for _ in batch:
+                _pending.task_done()
+
+def _ensure_writer():
+    global _writer_started
+    with _writer_lock:
+        if _writer_started:
+            return
+        _writer_started = True
+    threading.Thread(target=_writer_loop, name='portfolio-writer', daemon=True).start()
+    atexit.register(flush)
+
+def queue_snapshot(plan_id, old_state, new_state, version):
+    """
+    plan_store listener: the SQLite write happens on the background writer, so a
+    plan write only pays for computing the snapshot (and blocks only when
+    SNAPSHOT_QUEUE_SIZE snapshots are already waiting).
+    """
+    _ensure_writer()
+    _pending.put(_snapshot(plan_id, old_state, new_state, version))
+
+def flush():
+    """Blocks until every queued snapshot is in the index."""
+    _pending.join()
+
+def init_app(app):
+    """Keeps the index current for every plan write made by this process (a moment behind, via the writer)."""
+    plan_store.add_listener(queue_snapshot)
+
+
+# --- Queries ---
+def quarter_start(today=None):
+    today = today or datetime.date.today()
+    return datetime.date(today.year, 3 * ((today.month - 1) // 3) + 1, 1)
+
+def _goal_filter(goal_contains, alias='p'):
+    """(' AND <alias>.goal LIKE ?', [pattern]) or ('', [])."""
+    if not goal_contains:
+        return '', []
+    return f' AND {alias}.goal LIKE ?', [f"%{goal_contains}%"]
+
+def totals_by_currency(goal_contains=None):
+    """Plan count and totals per currency (amounts in different currencies are never added together)."""
+    goal_sql, params = _goal_filter(goal_contains)
+    rows = _connect().execute(
+        'SELECT p.currency, COUNT(*) AS plans, COALESCE(SUM(p.initial_total), 0) AS initial_total, '
+        'COALESCE(SUM(p.current_total), 0) AS current_total, '
+        'COALESCE(SUM(p.contingency_initial - p.contingency_current), 0) AS contingency_consumed '
+        'FROM plans p WHERE 1 = 1' + goal_sql + ' GROUP BY p.currency ORDER BY plans DESC', params)
+    return [dict(r) for r in rows]
+
+def totals_by_category(currency, goal_contains=None, limit=20):
+    """Per category within one currency: pre-aggregated rows, or a scan of the matching plans when filtering by goal."""
+    if not goal_contains:
+        rows = _connect().execute('SELECT category_key, plans, initial_total, current_total FROM category_totals '
+                                  'WHERE currency = ? AND plans > 0 ORDER BY current_total DESC LIMIT ?', (currency, limit))
+        return [dict(r) for r in rows]
+    goal_sql, params = _goal_filter(goal_contains)
+    rows = _connect().execute(
+        'SELECT pc.category_key, COUNT(*) AS plans, SUM(pc.initial_amount) AS initial_total, SUM(pc.current_amount) AS current_total '
+        'FROM plan_categories pc JOIN plans p ON p.plan_id = pc.plan_id WHERE pc.currency = ?' + goal_sql +
+        ' GROUP BY pc.category_key ORDER BY current_total DESC LIMIT ?', [currency] + params + [limit])
+    return [dict(r) for r in rows]
+
+def reallocation_frequency(goal_contains=None, limit=20):
+    """Change events per category across all currencies (counts, not amounts)."""
+    if not goal_contains:
+        rows = _connect().execute('SELECT category_key, SUM(reallocations) AS reallocations FROM category_totals '
+                                  'GROUP BY category_key HAVING SUM(reallocations) > 0 ORDER BY reallocations DESC LIMIT ?', (limit,))
+        return [dict(r) for r in rows]
+    goal_sql, params = _goal_filter(goal_contains)
+    rows = _connect().execute(
+        'SELECT e.category_key, COUNT(*) AS reallocations FROM events e JOIN plans p ON p.plan_id = e.plan_id '
+        'WHERE 1 = 1' + goal_sql + ' GROUP BY e.category_key ORDER BY reallocations DESC LIMIT ?', params + [limit])
+    return [dict(r) for r in rows]
+
+def contingency_burn(currency, goal_contains=None, since=None):
+    """
+    Contingency consumed (net outflow from contingency categories) in one currency
+    by events since `since` (ISO date), optionally only for plans whose goal
+    contains goal_contains.
+    """
+    sql = 'SELECT COALESCE(-SUM(e.delta), 0) AS burned, COUNT(DISTINCT e.plan_id) AS plans FROM events e'
+    params = []
+    if goal_contains:
+        sql += ' JOIN plans p ON p.plan_id = e.plan_id'
+    sql += ' WHERE e.is_contingency = 1 AND e.currency = ?'
+    params.append(currency)
+    if since:
+        sql += ' AND e.ts >= ?'
+        params.append(str(since))
+    goal_sql, goal_params = _goal_filter(goal_contains)
+    row = _connect().execute(sql + goal_sql, params + goal_params).fetchone()
+    return {'burned': round(row['burned'], 2), 'plans': row['plans']}
+
+def summary(goal_contains=None, since=None, limit=20):
+    """Everything the dashboard shows, per currency; goal_contains filters all of it, since only the burn."""
+    currencies = []
+    for totals in totals_by_currency(goal_contains):
+        currency = totals['currency']
+        currencies.append({
+            'currency': currency,
+            'plans': totals['plans'],
+            'initial_total': round(totals['initial_total'], 2),
+            'current_total': round(totals['current_total'], 2),
+            'contingency_consumed': round(totals['contingency_consumed'], 2),
+            'contingency_burn': contingency_burn(currency, goal_contains, since),
+            'totals_by_category': totals_by_category(currency, goal_contains, limit),
+        })
+    return {
+        'plans': sum(c['plans'] for c in currencies),
+        'goal': goal_contains,
+        'since': str(since) if since else None,
+        'currencies': currencies,
+        'reallocation_frequency': reallocation_frequency(goal_contains, limit),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Portfolio analytics over stored plans.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('rebuild', help="Re-index every plan in plan_store")
+    summary_parser = sub.add_parser('summary', help="Print the portfolio summary as JSON")
+    summary_parser.add_argument('--goal', help="Only plans whose goal contains this text")
+    summary_parser.add_argument('--since', help="ISO date for contingency burn")
+    summary_parser.add_argument('--period', choices=['quarter'], help="Shortcut for --since <start of this quarter>")
+    args = parser.parse_args(argv)
+    if args.command == 'rebuild':
+        rebuild()
+    else:
+        since = quarter_start().isoformat() if args.period == 'quarter' else args.since
+        print(json.dumps(summary(args.goal, since), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,242 @@
+"""
+Low-overhead sampling profiler for requests.
+
+A single background thread wakes every PROFILE_INTERVAL_MS and samples the
+stacks of request threads that are being profiled, via sys._current_frames().
+Nothing is instrumented, so unprofiled requests pay only a dict lookup. Samples
+are wall-clock, so time blocked on model calls or the session store shows up
+alongside CPU time (session pickling, Jinja rendering, JSON parsing, deepcopy).
+
+A request is profiled when:
+    - random() < PROFILE_SAMPLE_RATE (e.g. 0.01 for 1% of requests), or
+    - it carries an 'X-Profile: 1' header together with a valid 'X-Admin-Token'
+      (PROFILER_ADMIN_TOKEN; ignored when unset); its own stacks are then kept
+      too and the response gets an X-Profile-Id header.
+
+Work a profiled request hands to a stage worker (deadlines.submit/when_done,
+the research prefetch) is wrapped with bind(), so the worker thread is sampled
+under the same route and request profile while it runs, including stages that
+finish after the response was sent.
+
+Stacks are aggregated per route in flamegraph "folded" format
+("route;frame;frame count"), readable by flamegraph.pl and speedscope:
+    GET /admin/profile?token=...                      # all routes, folded
+    GET /admin/profile?token=...&route=/generate      # one route
+    GET /admin/profile?token=...&id=<X-Profile-Id>    # one request
+    GET /admin/profile?token=...&format=json&reset=1  # per-route totals, then clear
+The endpoint is only registered when PROFILER_ADMIN_TOKEN is set.
+"""
+import collections
+import functools
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0)) # Fraction of requests profiled
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 5))
+PROFILER_ADMIN_TOKEN = os.environ.get('PROFILER_ADMIN_TOKEN')
+PROFILE_HEADER = 'X-Profile'
+MAX_STACK_DEPTH = 64
+MAX_STACKS_PER_ROUTE = 5000 # Distinct stacks kept per route; the rest are counted under '[other]'
+RECENT_REQUEST_PROFILES = 50 # Per-request (header-triggered) profiles kept for /admin/profile?id=
+
+_lock = threading.Lock()
+_active = {} # thread ident -> {'route': str, 'stacks': Counter or None}
+_route_stacks = collections.defaultdict(collections.Counter) # route -> folded stack -> samples
+_route_requests = collections.Counter() # route -> profiled requests
+_recent = collections.OrderedDict() # profile id -> {'route', 'stacks', 'duration_ms'}
+_sampler_started = False
+_wakeup = threading.Event()
+
+
+# --- Sampling ---
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ',')
+
+def _fold(frame):
+    """Root-first 'a;b;c' for a thread's current frame."""
+    labels = []
+    while frame is not None and len(labels) < MAX_STACK_DEPTH:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+def _sample_once():
+    frames = sys._current_frames()
+    with _lock:
+        for ident, profile in _active.items():
+            frame = frames.get(ident)
+            if frame is None:
+                continue
+            stack = _fold(frame)
+            route_stacks = _route_stacks[profile['route']]
+            if stack not in route_stacks and len(route_stacks) >= MAX_STACKS_PER_ROUTE:
+                stack = '[other]'
+            route_stacks[stack] += 1
+            if profile['stacks'] is not None:
+                profile['stacks'][stack] += 1
+
+def _sampler_loop():
+    interval = PROFILE_INTERVAL_MS / 1000
+    while True:
+        if not _active:
+            _wakeup.wait() # Idle until a profiled request starts
+            _wakeup.clear()
+        time.sleep(interval)
+        try:
+            _sample_once()
+        except Exception as e:
+            print(f"Profiler: Sampling error: {e}")
+
+def _ensure_sampler():
+    global _sampler_started
+    with _lock:
+        if _sampler_started:
+            return
+        _sampler_started = True
+    threading.Thread(target=_sampler_loop, name='profiler-sampler', daemon=True).start()
+
+
+# --- Profiling a Thread ---
+def start(route, keep_request=False):
+    """Starts sampling the calling thread under route. Returns a profile id when keep_request."""
+    _ensure_sampler()
+    profile_id = uuid.uuid4().hex[:12] if keep_request else None
+    with _lock:
+        _active[threading.get_ident()] = {'route': route, 'stacks': collections.Counter() if keep_request else None,
+                                          'id': profile_id, 'started': time.monotonic()}
+        _route_requests[route] += 1
+    _wakeup.set()
+    return profile_id
+
+def bind(fn):
+    """
+    Wraps fn so that the thread running it is sampled under the calling thread's
+    profile (same route and per-request stacks). Returns fn itself when the
+    calling thread is not being profiled.
+    """
+    with _lock:
+        profile = _active.get(threading.get_ident())
+    if profile is None:
+        return fn
+    @functools.wraps(fn)
+    def profiled(*args, **kwargs):
+        ident = threading.get_ident()
+        with _lock:
+            _active[ident] = profile
+        _wakeup.set()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with _lock:
+                if _active.get(ident) is profile:
+                    del _active[ident]
+    return profiled
+
+def stop():
+    """Stops sampling the calling thread; keeps its own stacks if it was started with keep_request."""
+    with _lock:
+        profile = _active.pop(threading.get_ident(), None)
+        if profile and profile['id']:
+            _recent[profile['id']] = {'route': profile['route'], 'stacks': profile['stacks'],
+                                      'duration_ms': round((time.monotonic() - profile['started']) * 1000, 1)}
+            while len(_recent) > RECENT_REQUEST_PROFILES:
+                _recent.popitem(last=False)
+
+
+# --- Reports ---
+def folded(route_filter=None, profile_id=None):
+    """Folded stacks ('route;frames count' lines), for all routes, routes containing route_filter, or one request."""
+    with _lock:
+        if profile_id:
+            recent = _recent.get(profile_id)
+            sources = {recent['route']: dict(recent['stacks'])} if recent else {}
+        else:
+            sources = {route: dict(stacks) for route, stacks in _route_stacks.items()
+                       if not route_filter or route_filter in route}
+    lines = []
+    for route, stacks in sorted(sources.items()):
+        for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+            lines.append(f"{route};{stack} {count}")
+    return "\n".join(lines) + ("\n" if lines else "")
+
+def summary(top=15):
+    """Per route: profiled requests, samples and the hottest leaf frames (self time)."""
+    with _lock:
+        snapshot = {route: dict(stacks) for route, stacks in _route_stacks.items()}
+        requests = dict(_route_requests)
+    routes = {}
+    for route, stacks in sorted(snapshot.items()):
+        leaves = collections.Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        total = sum(stacks.values())
+        routes[route] = {
+            'requests': requests.get(route, 0),
+            'samples': total,
+            'sampled_ms': round(total * PROFILE_INTERVAL_MS, 1),
+            'top_self': [{'frame': frame, 'samples': count, 'share': round(count / total, 3)} for frame, count in leaves.most_common(top)],
+        }
+    return {'interval_ms': PROFILE_INTERVAL_MS, 'sample_rate': PROFILE_SAMPLE_RATE, 'routes': routes}
+
+def reset():
+    with _lock:
+        _route_stacks.clear()
+        _route_requests.clear()
+        _recent.clear()
+
+
+# --- Flask Integration ---
+def _admin_token_valid(token):
+    if not PROFILER_ADMIN_TOKEN or not token:
+        return False
+    return hmac.compare_digest(token.encode('utf-8'), PROFILER_ADMIN_TOKEN.encode('utf-8'))
+
+def init_app(app):
+    """Registers the per-request hooks and, when PROFILER_ADMIN_TOKEN is set, /admin/profile."""
+    from flask import Response, abort, g, jsonify, request
+
+    @app.before_request
+    def profile_start():
+        # Forced profiling costs sampler time, so only admins may ask for it
+        forced = request.headers.get(PROFILE_HEADER) == '1' and _admin_token_valid(request.headers.get('X-Admin-Token'))
+        if not forced and (PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE):
+            return
+        if request.path.startswith('/admin'):
+            return
+        route = f"{request.method} {request.url_rule.rule if request.url_rule else request.path}"
+        g.profile_id = start(route, keep_request=forced)
+        g.profiling = True
+
+    @app.after_request
+    def profile_header(response):
+        if g.get('profile_id'):
+            response.headers['X-Profile-Id'] = g.profile_id
+        return response
+
+    @app.teardown_request
+    def profile_stop(exc):
+        # After the response is built, so template rendering and session saving are included
+        if g.get('profiling'):
+            stop()
+
+    if not PROFILER_ADMIN_TOKEN:
+        return
+
+    @app.route('/admin/profile')
+    def admin_profile():
+        if not _admin_token_valid(request.headers.get('X-Admin-Token') or request.args.get('token', '')):
+            abort(403)
+        if request.args.get('format') == 'json':
+            response = jsonify(summary())
+        else:
+            body = folded(request.args.get('route'), request.args.get('id'))
+            response = Response(body, mimetype='text/plain')
+        if request.args.get('reset') == '1':
+            reset()
+        return response
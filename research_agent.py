@@ -2,36 +2,61 @@ import google.generativeai as genai
 import os
 import json
 import re
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 from dotenv import load_dotenv
 
+import model_scheduler
+import structured_output
+from model_router import ModelRouter
+
 load_dotenv() # Load environment variables from .env file
 
-# --- Configuration & Helpers (_clean_json_response, _call_gemini - Keep as before) ---
+# --- Configuration & Helpers (_call_gemini; JSON parsing/repair lives in structured_output) ---
 # ... (ensure these are present) ...
 try:
     # configure_gemini()
-    gemini_model = genai.GenerativeModel('gemini-1.5-flash')
-    print("Gemini model initialized successfully.")
+    # Each agent function is routed to a model tier (see model_router.DEFAULT_ROUTES / MODEL_ROUTING env)
+    model_router = ModelRouter.from_env()
+    print(f"Gemini model router initialized: {model_router.snapshot()['routes']}")
 except Exception as e:
-    print(f"Error initializing Gemini model: {e}")
-    gemini_model = None
-def _clean_json_response(text):
-    if not text: return text
-    start_brace = text.find('{'); start_bracket = text.find('['); end_brace = text.rfind('}'); end_bracket = text.rfind(']')
-    start_index = -1; end_index = -1
-    if start_brace != -1 and end_brace != -1:
-        if start_bracket == -1 or start_brace < start_bracket: start_index = start_brace; end_index = end_brace + 1
-    elif start_bracket != -1 and end_bracket != -1: start_index = start_bracket; end_index = end_bracket + 1
-    if start_index != -1 and end_index != -1:
-        potential_json = text[start_index:end_index]
-        if (potential_json.startswith('{') and potential_json.endswith('}')) or (potential_json.startswith('[') and potential_json.endswith(']')): return potential_json
-    cleaned = re.sub(r'^```(?:json)?\s*', '', text.strip(), flags=re.IGNORECASE); cleaned = re.sub(r'\s*```$', '', cleaned)
-    return cleaned.strip()
-def _call_gemini(prompt):
-    if not gemini_model: print("Error: Gemini model not initialized."); return None
+    print(f"Error initializing Gemini model router: {e}")
+    model_router = None
+
+# Structured output: pass a response schema so Gemini returns JSON directly (set GEMINI_STRUCTURED_OUTPUT=0 to disable)
+STRUCTURED_OUTPUT_ENABLED = os.environ.get('GEMINI_STRUCTURED_OUTPUT', '1') != '0'
+
+def _generation_config(response_schema):
+    if not response_schema or not STRUCTURED_OUTPUT_ENABLED: return None
+    return genai.GenerationConfig(response_mime_type="application/json", response_schema=response_schema)
+
+# Observers see every model call as observer(agent, prompt, response_text, seconds) (e.g. traffic_capture)
+_response_observers = []
+
+def add_response_observer(observer):
+    _response_observers.append(observer)
+
+def _call_gemini(prompt, response_schema=None, agent='default'):
+    # Waits for a slot from the fair scheduler (priority class + per-user fairness, see model_scheduler)
     try:
-        print(f"\n--- Sending Prompt to Gemini ({len(prompt)} chars) ---\n{prompt[:500]}...\n--------------------")
-        response = gemini_model.generate_content(prompt); print("--- Gemini Response Received ---")
+        with model_scheduler.scheduler.slot(agent):
+            started = time.monotonic()
+            response_text = _generate_text(prompt, response_schema, agent)
+    except model_scheduler.SchedulerRejected as e:
+        print(f"Scheduler: Rejected '{agent}' call: {e}"); return f"Error during AI call: {e}"
+    for observer in _response_observers:
+        try: observer(agent, prompt, response_text, time.monotonic() - started)
+        except Exception as e: print(f"Warning: Response observer failed: {e}")
+    return response_text
+
+def _generate_text(prompt, response_schema, agent):
+    if not model_router: print("Error: Gemini model not initialized."); return None
+    try:
+        print(f"\n--- Sending Prompt to Gemini [{agent}] ({len(prompt)} chars) ---\n{prompt[:500]}...\n--------------------")
+        response, tier = model_router.generate(agent, prompt, _generation_config(response_schema))
+        print(f"--- Gemini Response Received (tier: {tier}) ---")
         if not response.candidates:
              reason = "Unknown"
              try: reason = response.prompt_feedback.block_reason.name
@@ -58,12 +83,11 @@ def get_clarifying_questions(goal):
     Output Format: MUST be a JSON list of strings. No extra text.
     Example: ["What are the key deadlines or milestones?", "Are there existing resources (personnel, equipment) available?", "What are the top 3 priorities for this project?", "Are there known regulatory hurdles?"]
     """
-    response_text = _call_gemini(prompt)
-    # ... (rest of parsing/error handling unchanged) ...
+    response_text = _call_gemini(prompt, response_schema=structured_output.QUESTIONS_SCHEMA, agent='questions')
     if not response_text or "blocked" in response_text or "Error" in response_text: return ["Error: Failed to get questions." + (f" ({response_text})" if response_text else "")]
-    cleaned = _clean_json_response(response_text)
-    try: questions = json.loads(cleaned); return questions if isinstance(questions, list) and all(isinstance(q, str) for q in questions) else ["Error: AI response not list."]
-    except Exception as e: print(f"JSON Error: {e}\nCleaned: {cleaned}"); return ["Error: Could not parse questions."]
+    questions, error = structured_output.parse_questions(response_text)
+    if error: print(f"JSON Error: {error}\nRaw: {response_text[:500]}"); return ["Error: Could not parse questions."]
+    return questions
 
 
 # Role: Research Agent (Accepts historical_data)
@@ -107,15 +131,161 @@ def run_research(goal, answers_dict, historical_data=None):
 
     **Output Format:** Use Markdown with clear headings for each section and bullet points for detail. Ensure analysis is relevant and avoids generic info.
     """
-    response_text = _call_gemini(prompt)
+    response_text = _call_gemini(prompt, agent='research')
     if response_text and ("blocked" in response_text or "Error" in response_text):
         return f"Research summary generation failed: {response_text}"
     return response_text
 
 
+# Role: Research Agent, refinement of a prefetched draft (see research_prefetch)
+def refine_research(draft_summary, goal, answers_dict):
+    """Returns a short Markdown addendum adjusting a goal-only research draft to the user's answers."""
+    answers_formatted = "\n".join([f"- {q}: {a}" for q, a in (answers_dict or {}).items() if a])
+    prompt = f"""
+    Act as an expert research analyst. A research draft for budgeting this project was written from the goal (and any historical data) alone. The user has since answered clarifying questions.
+
+    **Project Goal:** '{goal}'
+
+    **User Answers:**
+    {answers_formatted}
+
+    **Existing Draft:**
+    {draft_summary}
+
+    **Your Task:** Do NOT repeat the draft. Write only a concise section titled "## Adjustments Based on Your Answers" with bullet points covering what the answers change: added or removed cost categories, risks, cost factors, or benchmark ranges. If the answers change nothing material, say so in one bullet.
+    """
+    response_text = _call_gemini(prompt, agent='research_refine')
+    if response_text and ("blocked" in response_text or "Error" in response_text):
+        return f"Research refinement generation failed: {response_text}"
+    return response_text
+
+
+# Role: Research Digest Agent (one-time condensation of the research for all downstream prompts)
+DIGEST_CACHE_SIZE = 256 # Digests kept in-process, keyed by research text hash
+RESEARCH_FALLBACK_CHARS = 3000 # Raw research passed downstream when no digest is available
+DIGEST_LIST_LIMIT = 10 # Items per digest list in prompts
+DIGEST_TEXT_LIMIT = 160 # Chars per digest item in prompts
+
+_digest_cache = OrderedDict()
+_input_digests = OrderedDict() # inputs_key -> latest digest, fallback when research fails or overruns its deadline
+_digest_lock = threading.Lock()
+
+def inputs_key(goal, answers, historical_data):
+    """
+    Hash of everything research sees. Research (and so its digest) reflects the
+    user's answers and uploaded history, so a fallback digest is only reused for
+    identical inputs, never just the same goal text.
+    """
+    payload = json.dumps([' '.join(str(goal).lower().split()), answers or {}, historical_data or ''], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def cached_digest_for_inputs(key):
+    """Most recent digest produced in this process for the same inputs_key, or None."""
+    with _digest_lock:
+        return _input_digests.get(key)
+
+def digest_research(research_summary, goal, key=None):
+    """
+    Extracts cost categories, risks, cost factors and benchmark ranges from the
+    research Markdown (structured_output.DIGEST_SCHEMA). Cached by content hash;
+    with key (see inputs_key), also kept as the fallback for those inputs.
+    Returns the digest dict, or None if the research is unusable or extraction fails.
+    """
+    if not research_summary or "generation failed" in research_summary or "blocked" in research_summary:
+        return None
+    content_key = hashlib.sha256(research_summary.encode('utf-8')).hexdigest()
+    with _digest_lock:
+        if content_key in _digest_cache:
+            _digest_cache.move_to_end(content_key)
+            digest = _digest_cache[content_key]
+            if key:
+                _input_digests[key] = digest
+                _input_digests.move_to_end(key)
+            return digest
+
+    prompt = f"""
+    Act as a research editor. Condense the research below for budgeting the project into compact structured data.
+    Project Goal: '{goal}'
+
+    Research:
+    {research_summary}
+
+    Output a JSON object with:
+    - "cost_categories": up to 10 items {{"name", "typical_share" (share of total, e.g. "10-15%", or ""), "notes" (one short phrase)}}
+    - "risks": up to 6 short strings (cost or schedule risks)
+    - "cost_factors": up to 6 short strings
+    - "benchmarks": up to 6 items {{"item", "range"}} only where the research states a range
+    Keep every string under 20 words. Output ONLY the JSON object.
+    """
+    response_text = _call_gemini(prompt, response_schema=structured_output.DIGEST_SCHEMA, agent='digest')
+    if not response_text or "blocked" in response_text or "Error" in response_text:
+        print(f"Research digest failed: {response_text}"); return None
+    digest, error = structured_output.parse_digest(response_text)
+    if error: print(f"JSON Error: {error}\nRaw: {response_text[:500]}"); return None
+    with _digest_lock:
+        _digest_cache[content_key] = digest
+        if key:
+            _input_digests[key] = digest
+            _input_digests.move_to_end(key)
+        for cache in (_digest_cache, _input_digests):
+            while len(cache) > DIGEST_CACHE_SIZE:
+                cache.popitem(last=False)
+    return digest
+
+def format_digest(digest):
+    """Compact prompt text for a digest dict."""
+    def clip(text):
+        text = ' '.join(str(text).split())
+        return text if len(text) <= DIGEST_TEXT_LIMIT else text[:DIGEST_TEXT_LIMIT] + '...'
+    lines = []
+    categories = []
+    for c in digest.get('cost_categories', [])[:DIGEST_LIST_LIMIT]:
+        detail = ", ".join(clip(x) for x in (c.get('typical_share'), c.get('notes')) if x)
+        categories.append(f"{clip(c['name'])} ({detail})" if detail else clip(c['name']))
+    if categories: lines.append("Cost categories: " + "; ".join(categories))
+    if digest.get('risks'): lines.append("Risks: " + "; ".join(clip(r) for r in digest['risks'][:DIGEST_LIST_LIMIT]))
+    if digest.get('cost_factors'): lines.append("Cost factors: " + "; ".join(clip(f) for f in digest['cost_factors'][:DIGEST_LIST_LIMIT]))
+    if digest.get('benchmarks'): lines.append("Benchmarks: " + "; ".join(f"{clip(b['item'])}: {clip(b['range'])}" for b in digest['benchmarks'][:DIGEST_LIST_LIMIT]))
+    return "\n".join(lines)
+
+def research_context(research_summary, digest=None):
+    """Research text for downstream prompts: the formatted digest, else the raw research truncated."""
+    if digest:
+        return format_digest(digest)
+    if not research_summary:
+        return "N/A"
+    if len(research_summary) > RESEARCH_FALLBACK_CHARS:
+        return research_summary[:RESEARCH_FALLBACK_CHARS] + "\n... (research truncated)"
+    return research_summary
+
+
+# --- Historical Data (prompt-ready text; blob_store caches it per uploaded file) ---
+HISTORY_PROMPT_CHARS = 2000 # Same cap the research and proposal prompts apply
+HISTORY_PROMPT_ARTIFACT = 'prompt_text_v1' # blob_store artifact name; bump when history_prompt_text's output changes
+
+def history_prompt_text(historical_data):
+    """
+    Compacts uploaded history for prompts: normalized line endings, no blank lines
+    or padding, cut at a line boundary to HISTORY_PROMPT_CHARS (marker included,
+    so the agents' own truncation leaves it alone).
+    """
+    if not historical_data:
+        return None
+    lines = [re.sub(r'[ \t]+', ' ', line).strip() for line in historical_data.splitlines()]
+    text = "\n".join(line for line in lines if line)
+    if len(text) <= HISTORY_PROMPT_CHARS:
+        return text
+    marker = "\n... (data truncated)"
+    cut = text[:HISTORY_PROMPT_CHARS - len(marker)]
+    if "\n" in cut:
+        cut = cut[:cut.rindex("\n")]
+    return cut + marker
+
+
 # Role: Budget Allocation Agent (Accepts historical_data, expects amount)
 def generate_budget_proposal(goal, budget_amount, currency_symbol, answers_dict, research_summary, historical_data=None):
-    """Uses Gemini to propose a budget allocation dictionary based on a GIVEN amount and historical data."""
+    """Uses Gemini to propose a budget allocation dictionary based on a GIVEN amount and historical data.
+    research_summary is the prompt-facing research text, normally research_context() of the digest."""
     answers_formatted = "\n".join([f"- {q}: {a}" for q, a in answers_dict.items() if a])
 
     # Truncate historical data for prompt
@@ -134,7 +304,7 @@ def generate_budget_proposal(goal, budget_amount, currency_symbol, answers_dict,
     Project Goal: '{goal}'
     Total Estimated Budget: {currency_symbol}{budget_amount:,.2f} # Provided for context, DO NOT include symbol/commas in output values
     User Provided Context/Answers: {answers_formatted}
-    AI Research Summary: {research_summary if research_summary and 'blocked' not in research_summary else "N/A"}
+    AI Research Digest: {research_summary if research_summary and 'blocked' not in research_summary else "N/A"}
     Previous Budget Data (if provided):
     ```
     {historical_data_summary}
@@ -145,20 +315,19 @@ def generate_budget_proposal(goal, budget_amount, currency_symbol, answers_dict,
     1. Identify 5-10 key, distinct budget categories relevant to THIS goal (e.g., 'Site Preparation').
     2. Include a 'Contingency' category (allocate appropriate amount, e.g., 5-20% of total).
     3. Allocate the **entire provided Total Estimated Budget** ({budget_amount:.2f}) across your chosen categories using **numerical amounts** only. The sum MUST equal the total budget.
-    4. Format output *strictly* as a JSON object. Keys=category names (strings), values=allocated **numerical amounts** (numbers only, no symbols, no commas, no percentages).
-    5. Ensure all values are non-negative numbers.
+    4. Format output *strictly* as a JSON object with an "allocations" list. Each item has "category" (string) and "amount" (**number only**, no symbols, no commas, no percentages).
+    5. Ensure all amounts are non-negative numbers.
 
     Example Output (if total budget was 50000):
-    {{"Planning": 5000, "Materials": 15000, "Labor": 18000, "Contingency": 5000, ...}}
+    {{"allocations": [{{"category": "Planning", "amount": 5000}}, {{"category": "Materials", "amount": 15000}}, {{"category": "Labor", "amount": 25000}}, {{"category": "Contingency", "amount": 5000}}]}}
 
     Output ONLY the JSON object representing the complete, amount-based budget breakdown.
     """
-    response_text = _call_gemini(prompt)
-    # ... (rest of parsing/error handling unchanged) ...
+    response_text = _call_gemini(prompt, response_schema=structured_output.BUDGET_SCHEMA, agent='proposal')
     if not response_text or "blocked" in response_text or "Error" in response_text: return {"Error": "Failed to get budget proposal." + (f" ({response_text})" if response_text else "")}
-    cleaned = _clean_json_response(response_text)
-    try: budget_dict = json.loads(cleaned); return budget_dict if isinstance(budget_dict, dict) and budget_dict else {"Error": "AI returned empty proposal."}
-    except Exception as e: print(f"JSON Error: {e}\nCleaned: {cleaned}"); return {"Error": f"Could not parse proposal. Raw: {cleaned[:200]}"}
+    budget_dict, error = structured_output.parse_budget(response_text, target_total=budget_amount)
+    if error: print(f"JSON Error: {error}\nRaw: {response_text[:500]}"); return {"Error": f"Could not parse proposal ({error}). Raw: {response_text[:200]}"}
+    return budget_dict
 
 
 # Role: Reasoning & Explanation Agent (Accepts historical_data)
@@ -184,13 +353,13 @@ def generate_explanation(proposed_budget, goal, answers_dict, research_summary,
 
     Project Goal: '{goal}'
     User Context: {answers_formatted}
-    AI Research Summary: {research_summary if research_summary and 'blocked' not in research_summary else "N/A"}
+    AI Research Digest: {research_summary if research_summary and 'blocked' not in research_summary else "N/A"}
     Previous Budget Data Context: {historical_data_summary}
     Proposed Budget: ```json\n{budget_string}\n```
 
     Your Explanation (rationale-focused):
     """
-    response_text = _call_gemini(prompt)
+    response_text = _call_gemini(prompt, agent='explanation')
     if response_text and ("blocked" in response_text or "Error" in response_text):
         return f"Budget explanation generation failed: {response_text}"
     return response_text if response_text else "Explanation could not be generated."
@@ -202,8 +371,10 @@ def answer_budget_question(question, current_budget_dict, context_dict):
     # ... (keep existing code) ...
     if not isinstance(current_budget_dict, dict) or not current_budget_dict or "Error" in current_budget_dict: return "Cannot answer question: No valid budget data."
     budget_string = json.dumps(current_budget_dict, indent=2); context_string = "\n".join([f"- {q}: {a}" for q, a in context_dict.get('answers', {}).items()]); goal = context_dict.get('goal', 'N/A')
-    prompt = f"""Act as budget assistant answering question. Goal: {goal}. Context: {context_string if context_string else "N/A"}. Budget: ```json\n{budget_string}\n``` User Question: "{question}". Task: Answer concisely based ONLY on provided info. If unsure, say so. Answer:"""
-    response_text = _call_gemini(prompt); return response_text if response_text and "blocked" not in response_text and "Error" not in response_text else ("Answer generation failed: " + response_text if response_text else "Issue answering.")
+    conversation = context_dict.get('conversation') or "N/A" # Bounded summary + recent turns (conversation_memory)
+    research = context_dict.get('research') or "N/A" # Research digest (research_context), never the raw Markdown
+    prompt = f"""Act as budget assistant answering question. Goal: {goal}. Context: {context_string if context_string else "N/A"}. Research Digest:\n{research}\nBudget: ```json\n{budget_string}\n``` Conversation so far:\n{conversation}\nUser Question: "{question}". Task: Answer concisely based ONLY on provided info; use the conversation to resolve follow-ups (e.g. "and what about labor?"). If unsure, say so. Answer:"""
+    response_text = _call_gemini(prompt, agent='qna'); return response_text if response_text and "blocked" not in response_text and "Error" not in response_text else ("Answer generation failed: " + response_text if response_text else "Issue answering.")
 
 def modify_budget_proposal(modification_request, current_budget_dict, context_dict):
      # ... (keep existing code - ensures amount based, asks only for JSON) ...
@@ -211,9 +382,29 @@ def modify_budget_proposal(modification_request, current_budget_dict, context_di
     is_percentage = any(isinstance(v, str) and '%' in v for v in current_budget_dict.values())
     if is_percentage: return {"Error": "Modifying percentage budgets not supported."}
     budget_string = json.dumps(current_budget_dict, indent=2); context_string = "\n".join([f"- {q}: {a}" for q, a in context_dict.get('answers', {}).items()]); goal = context_dict.get('goal', 'N/A')
-    prompt = f"""Act as budget modification assistant (amount-based). Goal: {goal}. Context: {context_string if context_string else "N/A"}. Current Budget: ```json\n{budget_string}\n``` User Request: "{modification_request}". Task: Generate JSON for new budget reflecting request. Keep total identical via reallocation (use Contingency first). Values must be numbers. Output ONLY the JSON object."""
-    response_text = _call_gemini(prompt)
+    conversation = context_dict.get('conversation') or "N/A"
+    research = context_dict.get('research') or "N/A"
+    prompt = f"""Act as budget modification assistant (amount-based). Goal: {goal}. Context: {context_string if context_string else "N/A"}. Research Digest:\n{research}\nCurrent Budget: ```json\n{budget_string}\n``` Conversation so far:\n{conversation}\nUser Request: "{modification_request}". Task: Generate JSON for new budget reflecting request. Keep total identical via reallocation (use Contingency first). Output ONLY a JSON object: {{"allocations": [{{"category": "...", "amount": 123.45}}, ...]}} with numeric amounts."""
+    response_text = _call_gemini(prompt, response_schema=structured_output.BUDGET_SCHEMA, agent='modification')
     if not response_text or "blocked" in response_text or "Error" in response_text: return {"Error": "Failed to get modification proposal." + (f" ({response_text})" if response_text else "")}
-    cleaned = _clean_json_response(response_text)
-    try: modified_budget = json.loads(cleaned); return modified_budget if isinstance(modified_budget, dict) and modified_budget else {"Error": "AI returned empty proposal."}
-    except Exception as e: print(f"JSON Error: {e}\nCleaned: {cleaned}"); return {"Error": f"Could not parse modified budget. Raw: {cleaned[:200]}"}
\ No newline at end of file
+    current_total = sum(v for v in current_budget_dict.values() if isinstance(v, (int, float)))
+    modified_budget, error = structured_output.parse_budget(response_text, target_total=current_total)
+    if error: print(f"JSON Error: {error}\nRaw: {response_text[:500]}"); return {"Error": f"Could not parse modified budget ({error}). Raw: {response_text[:200]}"}
+    return modified_budget
+
+
+# Role: Conversation Memory (rolling summary of older chat turns, see conversation_memory)
+def summarize_conversation(previous_summary, messages):
+    """Folds new chat lines into the running summary. Returns the new summary or None on failure."""
+    lines = "\n".join(messages)
+    prompt = f"""Act as a note-taker for a budget planning chat. Update the running summary with the new messages.
+    Keep it under 150 words. Preserve decisions, constraints, categories discussed, requested or applied changes, and open questions. Drop small talk.
+
+    Running Summary: {previous_summary if previous_summary else "None yet."}
+    New Messages:
+    {lines}
+
+    Updated Summary:"""
+    response_text = _call_gemini(prompt, agent='memory')
+    if not response_text or "blocked" in response_text or "Error" in response_text: return None
+    return response_text
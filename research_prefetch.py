@@ -0,0 +1,136 @@
+"""
+Speculative research drafts.
+
+/start launches a "goal + history" research call in the background while the
+user reads and answers the clarifying questions; /generate then reuses that
+draft (optionally refined with the answers) instead of starting the longest
+model call from scratch on the critical path.
+
+Drafts live in this process only. If /generate lands on a different worker, or
+the draft expired, take_draft() returns None and the caller falls back to a
+full research call.
+"""
+import concurrent.futures
+import os
+import threading
+import time
+import uuid
+
+import model_scheduler
+import profiler
+import research_agent
+
+PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS', 4))
+DRAFT_TTL_SECONDS = int(os.environ.get('DRAFT_TTL_SECONDS', 30 * 60)) # Abandoned sessions are cleaned up after this
+DRAFT_WAIT_SECONDS = 90 # Max time /generate waits for an in-flight draft
+REAPER_INTERVAL_SECONDS = 60
+
+# Answers that carry no information for research purposes
+UNINFORMATIVE_ANSWERS = {'', 'n/a', 'na', 'no', 'none', 'nope', 'not sure', 'unknown', 'idk', "don't know", 'no idea', '-', 'tbd', 'yes'}
+MIN_INFORMATIVE_CHARS = 40 # Below this many chars of real answers, the draft is reused as-is
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='research-draft')
+_drafts = {} # draft_id -> {'future': Future, 'created': monotonic seconds}
+_lock = threading.Lock()
+_reaper_started = False
+
+
+# --- Lifecycle ---
+def start_draft(goal, historical_data=None):
+    """Starts a background research draft for the goal (+history) and returns its id."""
+    _ensure_reaper()
+    draft_id = uuid.uuid4().hex
+    future = _executor.submit(profiler.bind(model_scheduler.bind(research_agent.run_research)), goal, {}, historical_data) # Same user as the request
+    with _lock:
+        _drafts[draft_id] = {'future': future, 'created': time.monotonic()}
+    print(f"Prefetch: Started research draft {draft_id[:8]}.")
+    return draft_id
+
+def cancel_draft(draft_id):
+    """Drops a draft. Not-yet-started calls are cancelled; running ones finish and are discarded."""
+    if not draft_id:
+        return
+    with _lock:
+        draft = _drafts.pop(draft_id, None)
+    if draft:
+        draft['future'].cancel()
+        print(f"Prefetch: Cancelled research draft {draft_id[:8]}.")
+
+def take_draft(draft_id, timeout=DRAFT_WAIT_SECONDS):
+    """
+    Removes the draft and returns its research text, waiting up to timeout for it
+    to finish. Returns None if unknown, cancelled, failed or still too slow.
+    """
+    if not draft_id:
+        return None
+    with _lock:
+        draft = _drafts.pop(draft_id, None)
+    if not draft:
+        return None
+    try:
+        summary = draft['future'].result(timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        draft['future'].cancel()
+        print(f"Prefetch: Draft {draft_id[:8]} not ready after {timeout}s, discarding.")
+        return None
+    except Exception as e:
+        print(f"Prefetch: Draft {draft_id[:8]} failed: {e}")
+        return None
+    if not summary or "generation failed" in summary:
+        return None
+    return summary
+
+def reap_expired():
+    """Cancels drafts older than DRAFT_TTL_SECONDS (sessions abandoned on the questions page)."""
+    cutoff = time.monotonic() - DRAFT_TTL_SECONDS
+    with _lock:
+        expired = [draft_id for draft_id, draft in _drafts.items() if draft['created'] < cutoff]
+    for draft_id in expired:
+        cancel_draft(draft_id)
+    return len(expired)
+
+def _reaper_loop():
+    while True:
+        time.sleep(REAPER_INTERVAL_SECONDS)
+        try:
+            reap_expired()
+        except Exception as e:
+            print(f"Prefetch: Reaper error: {e}")
+
+def _ensure_reaper():
+    global _reaper_started
+    with _lock:
+        if _reaper_started:
+            return
+        _reaper_started = True
+    threading.Thread(target=_reaper_loop, name='research-draft-reaper', daemon=True).start()
+
+
+# --- Using a Draft ---
+def answers_add_little(answers_dict):
+    """True when the answers are too thin to be worth a refinement call."""
+    informative = [a.strip() for a in (answers_dict or {}).values()
+                   if isinstance(a, str) and a.strip().lower().rstrip('.!') not in UNINFORMATIVE_ANSWERS]
+    return sum(len(a) for a in informative) < MIN_INFORMATIVE_CHARS
+
+def research_from_draft(draft_id, goal, answers_dict, historical_data=None, partial=None):
+    """
+    Research for /generate: the prefetched draft, refined with the answers when
+    they add enough, or a full research call when no usable draft exists.
+    If given, partial['research'] is set to the unrefined draft as soon as it is
+    available, so a caller whose deadline passes during refinement can use it.
+    """
+    draft = take_draft(draft_id)
+    if draft and partial is not None:
+        partial['research'] = draft
+    if not draft:
+        print("Prefetch: No usable draft, running full research.")
+        return research_agent.run_research(goal, answers_dict, historical_data)
+    if answers_add_little(answers_dict):
+        print("Prefetch: Answers add little, reusing draft as-is.")
+        return draft
+    addendum = research_agent.refine_research(draft, goal, answers_dict)
+    if not addendum or "generation failed" in addendum:
+        print(f"Prefetch: Refinement failed ({addendum}), using unrefined draft.")
+        return draft
+    return f"{draft}\n\n{addendum}"
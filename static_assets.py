@@ -0,0 +1,221 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+
+from flask import abort, request, send_from_directory
+
+try:
+    import brotli # Optional: enables 'br' encoding when installed
+except ImportError:
+    brotli = None
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ASSET_SOURCE_DIR = os.path.join(BASE_DIR, 'templates') # css/ and js/ live next to the templates
+ASSET_SUBDIRS = ('css', 'js')
+ASSET_BUILD_DIR = os.environ.get('ASSET_BUILD_DIR', os.path.join(BASE_DIR, 'static_build'))
+ASSET_URL_PREFIX = '/assets'
+MANIFEST_NAME = 'manifest.json'
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable' # Fingerprinted names never change content
+COMPRESSIBLE_MIMETYPES = {'text/html', 'application/json', 'text/css', 'application/javascript', 'text/javascript'}
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024)) # Bytes; tiny bodies aren't worth the CPU
+DYNAMIC_GZIP_LEVEL = 6
+DYNAMIC_BROTLI_QUALITY = 5 # Lower than build-time quality, responses are compressed per request
+
+
+# --- Minifiers (conservative: only strip what is safe without a real parser) ---
+CSS_COMMENT_OR_STRING = re.compile(r'''/\*.*?\*/|"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*\'''', re.DOTALL)
+CSS_DECLARATION = re.compile(r'[^{};]+(?=[;}])') # Ends in ';' or '}'; a selector or at-rule prelude ends in '{'
+
+def minify_css(text):
+    """Strips comments and redundant whitespace from a stylesheet, leaving string literals intact."""
+    strings = []
+    def stash(match):
+        if match.group(0).startswith('/*'):
+            return ''
+        strings.append(match.group(0))
+        return f"\x00{len(strings) - 1}\x00"
+    text = CSS_COMMENT_OR_STRING.sub(stash, text)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+    # Spaces around ':' only go inside declarations: in a selector '.a :hover' and '.a:hover' differ
+    text = CSS_DECLARATION.sub(lambda m: re.sub(r'\s*:\s*', ':', m.group(0)), text)
+    text = text.replace(';}', '}')
+    return re.sub(r'\x00(\d+)\x00', lambda m: strings[int(m.group(1))], text.strip())
+
+JS_SPACE = re.compile(r'\s+')
+JS_COMMENT = re.compile(r'//[^\n]*|/\*.*?\*/', re.DOTALL)
+JS_STRING = re.compile(r'''"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|`(?:\\.|[^`\\])*`''', re.DOTALL)
+JS_REGEX = re.compile(r'/(?:\\.|\[(?:\\.|[^\]\\\n])*\]|[^/\\\[\n])+/[a-z]*')
+JS_WORD = re.compile(r'[\w$]+')
+# After these tokens a '/' opens a regex literal; after anything else (a name, ')', ']') it divides
+JS_REGEX_PRECEDERS = set('(,=:[!&|?{};+-*%<>~^') | {'return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete',
+                                                    'void', 'throw', 'case', 'do', 'else', 'yield', 'await'}
+
+def minify_js(text):
+    """
+    Drops comments, indentation and blank lines from a script.
+    Scans token by token so string, template and regex literals are copied verbatim;
+    line breaks are kept because the script may rely on automatic semicolon insertion.
+    """
+    out = []
+    last = None
+    pos = 0
+    while pos < len(text):
+        char = text[pos]
+        comment = JS_COMMENT.match(text, pos) if char == '/' else None
+        if char.isspace() or comment:
+            gap = comment or JS_SPACE.match(text, pos)
+            pos = gap.end()
+            if '\n' in gap.group(0) or gap.group(0).startswith('//'):
+                while out and out[-1] == ' ':
+                    out.pop()
+                if out and out[-1] != '\n':
+                    out.append('\n')
+            elif out and out[-1] not in (' ', '\n'):
+                out.append(' ')
+            continue
+        if char == '/':
+            match = JS_REGEX.match(text, pos) if last is None or last in JS_REGEX_PRECEDERS else None
+        elif char in '"\'`':
+            match = JS_STRING.match(text, pos)
+        else:
+            match = JS_WORD.match(text, pos)
+        last = match.group(0) if match else char
+        out.append(last)
+        pos += len(last)
+    return ''.join(out).strip()
+
+MINIFIERS = {'.css': minify_css, '.js': minify_js}
+
+
+# --- Build Step ---
+def _write_atomic(path, data):
+    """Writes bytes via a temp file so concurrent workers never serve a half-written asset."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def build_assets(source_dir=ASSET_SOURCE_DIR, build_dir=ASSET_BUILD_DIR):
+    """
+    Minifies and fingerprints every CSS/JS file under source_dir.
+    Writes 'name.<hash>.ext' plus pre-compressed .gz/.br variants and a manifest.
+    Returns the manifest dict: {logical_path: fingerprinted_path}.
+    """
+    manifest = {}
+    for subdir in ASSET_SUBDIRS:
+        src_subdir = os.path.join(source_dir, subdir)
+        if not os.path.isdir(src_subdir):
+            continue
+        for filename in sorted(os.listdir(src_subdir)):
+            stem, ext = os.path.splitext(filename)
+            minifier = MINIFIERS.get(ext.lower())
+            if not minifier:
+                continue
+            with open(os.path.join(src_subdir, filename), 'r', encoding='utf-8') as f:
+                content = minifier(f.read()).encode('utf-8')
+            digest = hashlib.sha256(content).hexdigest()[:12]
+            logical_path = f"{subdir}/{filename}"
+            built_path = f"{subdir}/{stem}.{digest}{ext}"
+
+            out_path = os.path.join(build_dir, built_path)
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            if not os.path.exists(out_path): # Same hash means same bytes, skip rewriting
+                _write_atomic(out_path, content)
+                _write_atomic(out_path + '.gz', gzip.compress(content, compresslevel=9, mtime=0))
+                if brotli:
+                    _write_atomic(out_path + '.br', brotli.compress(content, quality=11))
+            manifest[logical_path] = built_path
+
+    os.makedirs(build_dir, exist_ok=True)
+    _write_atomic(os.path.join(build_dir, MANIFEST_NAME), json.dumps(manifest, indent=2).encode('utf-8'))
+    print(f"Static assets: built {len(manifest)} file(s) into '{build_dir}'.")
+    return manifest
+
+
+# --- Response Compression ---
+def _accepts(encoding):
+    """True if the current request accepts the given content-coding."""
+    return request.accept_encodings.quality(encoding) > 0
+
+def _pick_encoding():
+    if brotli and _accepts('br'):
+        return 'br'
+    if _accepts('gzip'):
+        return 'gzip'
+    return None
+
+def compress_response(response):
+    """after_request hook: compresses large HTML/JSON bodies with br or gzip."""
+    if (response.direct_passthrough or response.is_streamed # Never buffer streaming responses
+            or response.status_code != 200
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < COMPRESSION_MIN_SIZE:
+        return response
+    encoding = _pick_encoding()
+    if not encoding:
+        return response
+    if encoding == 'br':
+        compressed = brotli.compress(body, quality=DYNAMIC_BROTLI_QUALITY)
+    else:
+        compressed = gzip.compress(body, compresslevel=DYNAMIC_GZIP_LEVEL)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+# --- Flask Integration ---
+def init_app(app):
+    """Builds assets, registers the /assets route, the asset_url() helper and compression."""
+    try:
+        manifest = build_assets()
+    except OSError as e:
+        # Fall back to a previously built manifest (e.g. read-only deploy with assets prebuilt)
+        print(f"Static assets: build failed ({e}), loading existing manifest.")
+        try:
+            with open(os.path.join(ASSET_BUILD_DIR, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+    built_files = set(manifest.values())
+
+    @app.route(f'{ASSET_URL_PREFIX}/<path:filename>')
+    def serve_asset(filename):
+        """Serves a fingerprinted asset with far-future immutable caching."""
+        if filename not in built_files:
+            abort(404)
+        served_name = filename
+        encoding = None
+        for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if _accepts(candidate) and os.path.exists(os.path.join(ASSET_BUILD_DIR, filename + suffix)):
+                served_name, encoding = filename + suffix, candidate
+                break
+        response = send_from_directory(ASSET_BUILD_DIR, served_name, max_age=31536000)
+        response.mimetype = 'text/css' if filename.endswith('.css') else 'application/javascript'
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        return response
+
+    @app.context_processor
+    def inject_asset_url():
+        """Exposes asset_url('css/styles.css') -> '/assets/css/styles.<hash>.css' to templates."""
+        def asset_url(logical_path):
+            return f"{ASSET_URL_PREFIX}/{manifest.get(logical_path, logical_path)}"
+        return {'asset_url': asset_url}
+
+    app.after_request(compress_response)
+    return manifest
+
+
+if __name__ == '__main__':
+    build_assets()
@@ -0,0 +1,261 @@
+import copy
+import json
+import math
+import re
+
+# --- Response Schemas (OpenAPI subset accepted by Gemini's response_schema) ---
+# Budgets are a list of {category, amount} pairs because the schema format has no
+# way to describe "object with arbitrary string keys and number values".
+QUESTIONS_SCHEMA = {
+    "type": "array",
+    "items": {"type": "string"},
+}
+
+BUDGET_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "allocations": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "category": {"type": "string"},
+                    "amount": {"type": "number"},
+                },
+                "required": ["category", "amount"],
+            },
+        },
+    },
+    "required": ["allocations"],
+}
+
+# Compact form of the research Markdown consumed by downstream agents (see research_agent.digest_research)
+DIGEST_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "cost_categories": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "typical_share": {"type": "string"}, # e.g. "10-15%" of the total, "" if unknown
+                    "notes": {"type": "string"},
+                },
+                "required": ["name"],
+            },
+        },
+        "risks": {"type": "array", "items": {"type": "string"}},
+        "cost_factors": {"type": "array", "items": {"type": "string"}},
+        "benchmarks": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "item": {"type": "string"},
+                    "range": {"type": "string"},
+                },
+                "required": ["item", "range"],
+            },
+        },
+    },
+    "required": ["cost_categories", "risks"],
+}
+
+# Model output is checked against this before repair: same shape as BUDGET_SCHEMA, but amounts may
+# still be strings like '$1,200' that coerce_amount() repairs.
+REPAIRABLE_BUDGET_SCHEMA = copy.deepcopy(BUDGET_SCHEMA)
+del REPAIRABLE_BUDGET_SCHEMA["properties"]["allocations"]["items"]["properties"]["amount"]["type"]
+
+TOTAL_TOLERANCE = 0.005 # Relative mismatch (0.5%) that triggers total reconciliation
+CONTINGENCY_ABSORB_SHARE = 0.05 # Mismatches up to 5% of the target go into Contingency
+MAX_SCALE_DEVIATION = 0.25 # Larger mismatches are scaled proportionally up to 25%, beyond that the proposal is rejected
+CURRENCY_CODES = ('USD', 'EUR', 'GBP', 'INR', 'JPY', 'CAD', 'AUD')
+MAX_JSON_CANDIDATES = 50 # '{' / '[' positions tried by extract_json before giving up
+
+_JSON_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "number": (int, float),
+    "integer": int,
+    "boolean": bool,
+}
+
+
+# --- Validation ---
+def validate(value, schema, path="$"):
+    """
+    Single-pass schema check. Walks value once alongside schema.
+    Returns the first problem found as a string, or None if valid.
+    """
+    expected = _JSON_TYPES.get(schema.get("type"))
+    if expected:
+        # bool is a subclass of int, reject it where a number is expected
+        if not isinstance(value, expected) or (isinstance(value, bool) and schema["type"] != "boolean"):
+            return f"{path}: expected {schema['type']}, got {type(value).__name__}"
+        # json accepts NaN and Infinity, which are never usable amounts
+        if isinstance(value, float) and not math.isfinite(value):
+            return f"{path}: expected a finite {schema['type']}, got {value}"
+    if isinstance(value, dict):
+        for key in schema.get("required", ()):
+            if key not in value:
+                return f"{path}: missing '{key}'"
+        for key, sub_schema in schema.get("properties", {}).items():
+            if key in value:
+                error = validate(value[key], sub_schema, f"{path}.{key}")
+                if error:
+                    return error
+    elif isinstance(value, list) and "items" in schema:
+        for i, item in enumerate(value):
+            error = validate(item, schema["items"], f"{path}[{i}]")
+            if error:
+                return error
+    return None
+
+
+# --- Local Repair (no extra model call) ---
+def extract_json(text):
+    """
+    Decodes the first JSON value in text, ignoring code fences and any
+    leading/trailing prose (including brackets in the prose before it, e.g.
+    'Here is {bad} then {"a": 1}'). Returns (value, None) or (None, error_message).
+    """
+    if not text:
+        return None, "Empty response."
+    text = re.sub(r'^```(?:json)?\s*', '', text.strip(), flags=re.IGNORECASE)
+    decoder = json.JSONDecoder()
+    error = None
+    for attempt, match in enumerate(re.finditer(r'[{\[]', text)):
+        if attempt >= MAX_JSON_CANDIDATES:
+            break
+        try:
+            value, _ = decoder.raw_decode(text, match.start()) # Stops at the end of the value, trailing text is ignored
+            return value, None
+        except ValueError as e:
+            error = error or str(e) # The first candidate's error is the most telling
+    return None, error or "No JSON found in response."
+
+def coerce_amount(value):
+    """
+    Turns 1200, '1200', '$1,200.50' or 'USD 1200' into a float. Returns None if
+    impossible, including strings that still hold unit letters ('1.5k', '2 million'),
+    misplaced commas ('1,2,3') and non-finite numbers.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value) if math.isfinite(value) else None
+    if isinstance(value, str):
+        cleaned = re.sub(r'\b(?:' + '|'.join(CURRENCY_CODES) + r')\b', '', value.strip(), flags=re.IGNORECASE)
+        cleaned = re.sub(r'[$£€¥₹\s]', '', cleaned)
+        if ',' in cleaned: # Only as thousands separators
+            if not re.fullmatch(r'-?\d{1,3}(?:,\d{3})+(?:\.\d+)?', cleaned):
+                return None
+            cleaned = cleaned.replace(',', '')
+        if not re.fullmatch(r'-?\d+(?:\.\d+)?|-?\.\d+', cleaned):
+            return None
+        return float(cleaned)
+    return None
+
+def _allocation_pairs(data):
+    """Yields (category, raw_amount) from either the schema shape or a plain {category: amount} dict."""
+    if isinstance(data, dict) and isinstance(data.get("allocations"), list):
+        for item in data["allocations"]:
+            if isinstance(item, dict) and "category" in item:
+                yield str(item["category"]).strip(), item.get("amount")
+    elif isinstance(data, dict):
+        for category, amount in data.items():
+            yield str(category).strip(), amount
+
+def reconcile_total(budget, target_total):
+    """
+    Makes amounts sum to target_total. Returns (budget, None) or (None, error_message).
+    A small difference (up to CONTINGENCY_ABSORB_SHARE of the target) goes into
+    Contingency when that keeps it non-negative; otherwise categories are scaled
+    proportionally, and totals off by more than MAX_SCALE_DEVIATION (or that are
+    not positive) are rejected.
+    """
+    current_total = sum(budget.values())
+    if current_total <= 0:
+        return None, f"Allocations sum to {current_total:,.2f}; nothing was allocated."
+    if target_total is None or target_total <= 0:
+        return budget, None
+    difference = target_total - current_total
+    if abs(difference) <= target_total * TOTAL_TOLERANCE:
+        return budget, None
+    if abs(difference) > target_total * MAX_SCALE_DEVIATION:
+        return None, f"Allocations sum to {current_total:,.2f}, too far from the target {target_total:,.2f} to repair."
+    print(f"Repair: Allocations sum to {current_total:,.2f}, reconciling to {target_total:,.2f}.")
+    repaired = dict(budget)
+    contingency_key = next((k for k in repaired if 'contingency' in k.lower()), None)
+    if contingency_key and abs(difference) <= target_total * CONTINGENCY_ABSORB_SHARE and repaired[contingency_key] + difference >= 0:
+        repaired[contingency_key] = round(repaired[contingency_key] + difference, 2)
+        return repaired, None
+    factor = target_total / current_total
+    repaired = {k: round(v * factor, 2) for k, v in repaired.items()}
+    # Put the rounding residue on the largest category
+    residue = round(target_total - sum(repaired.values()), 2)
+    if residue:
+        largest = max(repaired, key=repaired.get)
+        repaired[largest] = round(repaired[largest] + residue, 2)
+    return repaired, None
+
+
+# --- Parsers used by the agents ---
+def parse_questions(text):
+    """Returns (list_of_questions, None) or (None, error_message)."""
+    data, error = extract_json(text)
+    if error:
+        return None, error
+    if isinstance(data, dict): # e.g. {"questions": [...]}
+        data = next((v for v in data.values() if isinstance(v, list)), data)
+    if isinstance(data, list):
+        data = [q.strip() for q in data if isinstance(q, str) and q.strip()]
+    error = validate(data, QUESTIONS_SCHEMA)
+    if error:
+        return None, error
+    return (data, None) if data else (None, "AI returned no questions.")
+
+def parse_budget(text, target_total=None):
+    """
+    Returns ({category: amount}, None) or (None, error_message).
+    Repairs trailing text, currency strings, duplicate categories and totals
+    that don't match target_total.
+    """
+    data, error = extract_json(text)
+    if error:
+        return None, error
+    # Check what the model sent (not what repair builds from it): the schema shape, or a plain {category: amount} dict
+    if isinstance(data, dict) and "allocations" in data:
+        error = validate(data, REPAIRABLE_BUDGET_SCHEMA)
+    elif isinstance(data, dict):
+        error = next((f"$.{k}: expected number, got {type(v).__name__}" for k, v in data.items()
+                      if not isinstance(v, (int, float, str)) or isinstance(v, bool)), None)
+    else:
+        error = f"$: expected object, got {type(data).__name__}"
+    if error:
+        return None, error
+    budget = {}
+    for category, raw_amount in _allocation_pairs(data):
+        amount = coerce_amount(raw_amount)
+        if not category or amount is None:
+            return None, f"Unusable allocation '{category}': {raw_amount!r}"
+        if amount < 0:
+            return None, f"Negative allocation for '{category}': {raw_amount!r}"
+        budget[category] = round(budget.get(category, 0.0) + amount, 2)
+    if not budget:
+        return None, "AI returned empty proposal."
+    return reconcile_total(budget, target_total)
+
+def parse_digest(text):
+    """Returns (digest_dict, None) or (None, error_message). Missing optional lists become []."""
+    data, error = extract_json(text)
+    if error:
+        return None, error
+    error = validate(data, DIGEST_SCHEMA)
+    if error:
+        return None, error
+    for key in ("cost_factors", "benchmarks"):
+        data.setdefault(key, [])
+    return (data, None) if data["cost_categories"] else (None, "AI returned no cost categories.")
@@ -0,0 +1,256 @@
+// Budget plan page: sends action forms to the /api/v1 JSON endpoints and
+// applies the returned state in place instead of a full post-redirect-get reload.
+(function () {
+    'use strict';
+
+    const money = (value) => '$' + Number(value).toLocaleString('en-US', { minimumFractionDigits: 2, maximumFractionDigits: 2 });
+
+    function el(tag, className, text) {
+        const node = document.createElement(tag);
+        if (className) node.className = className;
+        if (text !== undefined) node.textContent = text;
+        return node;
+    }
+
+    function sortedEntries(budget) {
+        return Object.entries(budget || {}).sort((a, b) => a[0].localeCompare(b[0]));
+    }
+
+    // --- Renderers ---
+    function renderNotices(notices) {
+        const box = document.getElementById('api-notices');
+        if (!box) return;
+        box.replaceChildren();
+        notices.forEach(({ message, category }) => {
+            let type = category === 'error' ? 'danger' : category;
+            if (!['success', 'warning', 'danger', 'info'].includes(type)) type = 'secondary';
+            const alert = el('div', `alert alert-${type} alert-dismissible fade show`, message);
+            alert.setAttribute('role', 'alert');
+            const close = el('button', 'btn-close');
+            close.type = 'button';
+            close.setAttribute('data-bs-dismiss', 'alert');
+            close.setAttribute('aria-label', 'Close');
+            alert.appendChild(close);
+            box.appendChild(alert);
+        });
+    }
+
+    function renderBudget(data) {
+        const body = document.getElementById('current-budget-body');
+        if (!body) return;
+        const rows = sortedEntries(data.current_budget).map(([category, amount]) => {
+            const row = el('tr');
+            row.appendChild(el('td', '', category));
+            row.appendChild(el('td', 'text-end', money(amount)));
+            return row;
+        });
+        const totalRow = el('tr', 'fw-bold table-group-divider');
+        totalRow.appendChild(el('td', '', 'Current Total'));
+        const totalCell = el('td', 'text-end', money(data.current_total));
+        totalCell.id = 'current-total';
+        totalRow.appendChild(totalCell);
+        body.replaceChildren(...rows, totalRow);
+    }
+
+    function renderChart(chart) {
+        const canvas = document.getElementById('budgetPieChart');
+        const instance = canvas && window.Chart ? Chart.getChart(canvas) : null;
+        if (!instance) return;
+        instance.data.labels = chart.labels;
+        instance.data.datasets[0].data = chart.values;
+        instance.update();
+    }
+
+    function renderLog(entries) {
+        const log = document.getElementById('activity-log');
+        if (!log || !entries.length) return;
+        const placeholder = log.querySelector('p.text-muted');
+        if (placeholder) placeholder.remove();
+        // Newest first, matching the server-rendered `log|reverse`
+        entries.forEach((entry) => log.prepend(el('div', 'log-entry small', entry)));
+    }
+
+    function renderConversation(messages) {
+        const box = document.getElementById('ai-conversation-history');
+        if (!box || !messages.length) return;
+        const placeholder = box.querySelector('p.text-muted');
+        if (placeholder) placeholder.remove();
+        messages.forEach((msg) => {
+            const isUser = Boolean(msg.user);
+            const row = el('div', `d-flex ${isUser ? 'justify-content-end' : 'justify-content-start'} mb-2`);
+            const bubble = el('div', `${isUser ? 'bg-secondary-subtle' : 'bg-primary-subtle'} text-dark-emphasis rounded-3 px-3 py-2 mw-75`);
+            if (!isUser) bubble.style.whiteSpace = 'pre-wrap';
+            bubble.appendChild(el('strong', '', isUser ? 'You:' : 'AI:'));
+            bubble.appendChild(el('br'));
+            bubble.appendChild(document.createTextNode(isUser ? msg.user : msg.ai));
+            row.appendChild(bubble);
+            box.appendChild(row);
+        });
+        box.scrollTop = box.scrollHeight;
+    }
+
+    function actionForm(box, label, icon, btnClass, action) {
+        const form = el('form', 'flex-grow-1');
+        form.method = 'POST';
+        form.action = box.dataset[`${action}Url`];
+        form.dataset.api = box.dataset[`${action}Api`];
+        const button = el('button', `btn ${btnClass} btn-sm w-100`);
+        button.type = 'submit';
+        button.appendChild(el('i', `bi ${icon} me-1`));
+        button.appendChild(document.createTextNode(label));
+        form.appendChild(button);
+        return form;
+    }
+
+    function renderPending(pending) {
+        const box = document.getElementById('pending-modification');
+        const input = document.getElementById('ai-input');
+        if (!box) return;
+        box.replaceChildren();
+        const valid = pending && !pending.Error;
+        if (input) input.hidden = Boolean(valid);
+        if (pending && pending.Error) {
+            box.appendChild(el('div', 'alert alert-danger small', `Error in pending modification: ${pending.Error}`));
+            return;
+        }
+        if (!valid) return;
+
+        const section = el('div', 'pending-modification-section border rounded p-3 mb-3 bg-warning-subtle');
+        section.appendChild(el('h4', 'h6 text-dark', 'AI Suggestion: Proposed Budget Changes'));
+        section.appendChild(el('p', 'small', 'The AI proposes the following budget based on your last request. Review carefully before applying.'));
+        const table = el('table', 'table table-sm table-bordered small bg-white');
+        const head = el('thead', 'table-light');
+        const headRow = el('tr');
+        headRow.appendChild(el('th', '', 'Category'));
+        headRow.appendChild(el('th', 'text-end', 'Proposed Amount'));
+        head.appendChild(headRow);
+        const body = el('tbody');
+        let total = 0;
+        sortedEntries(pending).forEach(([category, amount]) => {
+            const row = el('tr');
+            row.appendChild(el('td', '', category));
+            row.appendChild(el('td', 'text-end', typeof amount === 'number' ? money(amount) : String(amount)));
+            if (typeof amount === 'number') total += amount;
+            body.appendChild(row);
+        });
+        const totalRow = el('tr', 'fw-bold table-group-divider');
+        totalRow.appendChild(el('td', '', 'Proposed Total'));
+        totalRow.appendChild(el('td', 'text-end', money(total)));
+        body.appendChild(totalRow);
+        table.append(head, body);
+        const wrapper = el('div', 'table-responsive mb-3');
+        wrapper.style.maxHeight = '200px';
+        wrapper.style.overflowY = 'auto';
+        wrapper.appendChild(table);
+        const buttons = el('div', 'd-flex justify-content-around gap-2');
+        buttons.append(actionForm(box, 'Approve', 'bi-check-lg', 'btn-success', 'approve'), actionForm(box, 'Reject', 'bi-x-lg', 'btn-danger', 'reject'));
+        section.append(wrapper, buttons);
+        box.appendChild(section);
+    }
+
+    function applyPayload(data) {
+        renderNotices(data.notices || []);
+        renderBudget(data);
+        renderChart(data.chart);
+        renderLog(data.log_delta || []);
+        renderConversation(data.conversation_delta || []);
+        renderPending(data.pending_modification);
+    }
+
+    // --- Stages that overran the generation deadline: poll until the server fills them in ---
+    const POLL_INTERVAL_MS = 3000;
+    const POLL_MAX_ATTEMPTS = 100; // ~5 minutes
+
+    function renderExplanation(text) {
+        const box = document.getElementById('budget-explanation');
+        if (!box) return;
+        const paragraph = el('p', 'mb-0', text || 'Explanation not available.');
+        paragraph.style.whiteSpace = 'pre-wrap';
+        box.replaceChildren(paragraph);
+    }
+
+    function renderResearchReady() {
+        const notice = document.getElementById('research-pending');
+        if (!notice) return;
+        notice.replaceChildren(document.createTextNode('The full research is ready. '));
+        const link = el('a', 'alert-link', 'Reload to view it');
+        link.href = window.location.href;
+        notice.appendChild(link);
+    }
+
+    function pollPendingStages() {
+        const status = document.getElementById('plan-status');
+        if (!status || !window.fetch) return;
+        const pending = {
+            proposal: status.dataset.proposalPending === '1',
+            explanation: status.dataset.explanationPending === '1',
+            research: status.dataset.researchPending === '1',
+        };
+        if (!pending.proposal && !pending.explanation && !pending.research) return;
+        let attempts = 0;
+        const timer = setInterval(async () => {
+            attempts += 1;
+            if (attempts >= POLL_MAX_ATTEMPTS) clearInterval(timer);
+            try {
+                const response = await fetch(status.dataset.pollUrl, { headers: { 'Accept': 'application/json' }, credentials: 'same-origin' });
+                if (!response.ok) throw new Error(`HTTP ${response.status}`);
+                const data = await response.json();
+                if (pending.proposal && !data.proposal_pending) {
+                    // Tables, chart and actions are server-rendered; reload once the budget exists
+                    clearInterval(timer);
+                    window.location.reload();
+                    return;
+                }
+                if (pending.explanation && !data.explanation_pending) {
+                    renderExplanation(data.budget_explanation);
+                    pending.explanation = false;
+                }
+                if (pending.research && !data.research_pending) {
+                    renderResearchReady();
+                    pending.research = false;
+                }
+                if (!pending.proposal && !pending.explanation && !pending.research) clearInterval(timer);
+            } catch (err) {
+                console.warn('Polling plan status failed.', err);
+            }
+        }, POLL_INTERVAL_MS);
+    }
+
+    pollPendingStages();
+
+    // --- Form interception (event delegation also covers re-rendered forms) ---
+    document.addEventListener('submit', async (event) => {
+        const form = event.target;
+        if (!form.dataset || !form.dataset.api || !window.fetch) return;
+        event.preventDefault();
+        const buttons = form.querySelectorAll('button[type="submit"]');
+        buttons.forEach((b) => { b.disabled = true; });
+        let response;
+        try {
+            response = await fetch(form.dataset.api, {
+                method: 'POST',
+                body: new FormData(form),
+                headers: { 'Accept': 'application/json' },
+                credentials: 'same-origin',
+            });
+        } catch (err) {
+            // The request never reached the server, so a regular submit cannot apply the action twice
+            console.warn('API request failed, falling back to a regular form submit.', err);
+            buttons.forEach((b) => { b.disabled = false; });
+            form.submit();
+            return;
+        }
+        try {
+            // The server may already have applied the action (e.g. a 409 after a write): never resubmit, just report
+            const data = await response.json().catch(() => ({}));
+            if (!response.ok) {
+                renderNotices([{ message: data.error || `Request failed (HTTP ${response.status}). Reload the page to see the current plan.`, category: 'error' }]);
+                return;
+            }
+            applyPayload(data);
+            form.reset();
+        } finally {
+            buttons.forEach((b) => { b.disabled = false; });
+        }
+    });
+})();
@@ -0,0 +1,85 @@
+import os
+import time
+
+import pytest
+
+import blob_store
+import plan_store
+
+
+@pytest.fixture(autouse=True)
+def store_dirs(tmp_path, monkeypatch):
+    monkeypatch.setattr(blob_store, 'BLOB_STORE_DIR', str(tmp_path / 'blobs'))
+    monkeypatch.setattr(blob_store, '_cache', blob_store.collections.OrderedDict())
+    monkeypatch.setattr(blob_store, '_last_purge', time.monotonic()) # No sweep inside put() unless a test asks
+    monkeypatch.setattr(plan_store, 'PLAN_STORE_DIR', str(tmp_path / 'plans'))
+    monkeypatch.setattr(plan_store, '_listeners', [])
+    return tmp_path
+
+
+def _age(blob_id, seconds):
+    past = time.time() - seconds
+    for filename in os.listdir(blob_store.BLOB_STORE_DIR):
+        if filename.startswith(blob_id):
+            os.utime(os.path.join(blob_store.BLOB_STORE_DIR, filename), (past, past))
+
+
+def test_put_deduplicates_by_content():
+    first = blob_store.put(b"a,b\n1,2\n")
+    assert blob_store.put(b"a,b\n1,2\n") == first
+    assert blob_store.get_text(first) == "a,b\n1,2\n"
+    assert blob_store.put(b"   ") is None
+
+
+def test_derived_is_computed_once_and_cached_on_disk():
+    blob_id = blob_store.put(b"hello")
+    calls = []
+    def compute(text):
+        calls.append(text)
+        return text.upper()
+    assert blob_store.derived(blob_id, 'upper_v1', compute) == 'HELLO'
+    blob_store._cache.clear() # A fresh process still finds the artifact on disk
+    assert blob_store.derived(blob_id, 'upper_v1', compute) == 'HELLO'
+    assert calls == ['hello']
+
+
+def test_purge_keeps_referenced_and_recent_blobs():
+    kept_by_plan = blob_store.put(b"plan history")
+    recent = blob_store.put(b"just uploaded")
+    stale = blob_store.put(b"abandoned upload")
+    blob_store.derived(stale, 'upper_v1', str.upper)
+    plan_store.create({'historical_data_id': kept_by_plan})
+    _age(kept_by_plan, 2 * blob_store.BLOB_TTL_SECONDS)
+    _age(stale, 2 * blob_store.BLOB_TTL_SECONDS)
+
+    assert blob_store.purge_unreferenced() == 1
+    assert blob_store.get_text(kept_by_plan) == "plan history"
+    assert blob_store.get_text(recent) == "just uploaded"
+    assert not any(f.startswith(stale) for f in os.listdir(blob_store.BLOB_STORE_DIR)) # Artifacts go too
+    with pytest.raises(blob_store.BlobNotFound):
+        blob_store.get_text(stale)
+
+
+def test_blobs_of_expired_plans_are_purged_next():
+    blob_id = blob_store.put(b"old plan history")
+    plan_id = plan_store.create({'historical_data_id': blob_id})
+    _age(blob_id, 2 * blob_store.BLOB_TTL_SECONDS)
+    assert blob_store.purge_unreferenced() == 0
+
+    plan_store.delete(plan_id) # What plan_store.purge_expired does once the plan idles out
+    assert blob_store.purge_unreferenced() == 1
+
+
+def test_reupload_restarts_ttl():
+    blob_id = blob_store.put(b"uploaded again")
+    _age(blob_id, 2 * blob_store.BLOB_TTL_SECONDS)
+    assert blob_store.put(b"uploaded again") == blob_id
+    assert blob_store.purge_unreferenced() == 0
+
+
+def test_put_sweeps_at_most_once_per_interval(monkeypatch):
+    stale = blob_store.put(b"abandoned upload")
+    _age(stale, 2 * blob_store.BLOB_TTL_SECONDS)
+    monkeypatch.setattr(blob_store, '_last_purge', None)
+    blob_store.put(b"new upload")
+    assert not os.path.exists(os.path.join(blob_store.BLOB_STORE_DIR, f"{stale}.txt"))
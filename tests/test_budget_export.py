@@ -0,0 +1,80 @@
+import csv
+import io
+import json
+
+import pytest
+
+import budget_export
+import plan_store
+
+
+PLAN = {
+    'currency_symbol': '€',
+    'initial_budget': {'Materials': 600.0, 'Contingency': 400.0},
+    'current_budget': {'Materials': 700.0, 'Contingency': 300.0, 'Permits': 0.0},
+    'reallocation_log': ["Added €100.00 to 'Materials'.", "=HYPERLINK(\"http://example.com\")"],
+}
+
+
+def _rows(chunks):
+    return list(csv.reader(io.StringIO(''.join(chunks))))
+
+
+def test_single_plan_csv_uses_plan_currency_and_variance():
+    rows = _rows(budget_export.iter_csv(PLAN))
+    assert rows[0] == ["Budget Item", "Category", "Estimated Cost (EUR)", "Allocated Budget (EUR)", "Comments"]
+    assert rows[1] == ['Materials', 'Allocation', '600.0', '700.0', 'Variance: +100.00']
+    assert rows[2] == ['Contingency', 'Contingency', '400.0', '300.0', 'Variance: -100.00']
+    assert rows[3] == ['Permits', 'Allocation', '', '0.0', 'Added after proposal']
+    assert rows[4][:2] == ['Activity Log #1', 'Log']
+
+
+def test_multi_plan_csv_labels_rows_with_plan_and_currency():
+    chunks = list(budget_export.iter_export(PLAN, 'csv', plan_id='p1', multi_plan=True))
+    chunks += list(budget_export.iter_export(dict(PLAN, currency_symbol='$'), 'csv', plan_id='p2', header=False, multi_plan=True))
+    rows = _rows(chunks)
+    assert rows[0] == budget_export.MULTI_PLAN_CSV_COLUMNS
+    assert {tuple(r[:2]) for r in rows[1:]} == {('p1', 'EUR'), ('p2', 'USD')}
+
+
+@pytest.mark.parametrize('text', ['=1+1', '+1', '-2+3', '@SUM(A1)', '\tx', '\rx'])
+def test_csv_cells_cannot_start_formulas(text):
+    plan = {'current_budget': {text: 10.0}, 'reallocation_log': [text]}
+    rows = _rows(budget_export.iter_csv(plan, header=False))
+    assert rows[0][0] == "'" + text
+    assert rows[1][4] == "'" + text
+
+
+def test_csv_keeps_numbers_and_plain_text():
+    plan = {'current_budget': {'Labor': -5.0}, 'reallocation_log': ['Plain entry']}
+    rows = _rows(budget_export.iter_csv(plan, header=False))
+    assert rows[0][3] == '-5.0'
+    assert rows[1][4] == 'Plain entry'
+
+
+def test_jsonl_rows_carry_plan_id_and_sections_filter():
+    rows = [json.loads(line) for line in budget_export.iter_jsonl(PLAN, ('log',), plan_id='p1')]
+    assert [r['section'] for r in rows] == ['log', 'log']
+    assert all(r['plan_id'] == 'p1' for r in rows)
+
+
+def test_columnar_groups_rows_per_section_and_batch():
+    groups = [json.loads(line) for line in budget_export.iter_columnar(PLAN, plan_id='p1', batch_size=2)]
+    assert [(g['section'], g['rows']) for g in groups] == [('budget', 2), ('budget', 1), ('log', 2)]
+    assert groups[0]['columns']['item'] == ['Materials', 'Contingency']
+
+
+def test_parse_sections():
+    assert budget_export.parse_sections('log, bogus') == ('log',)
+    assert budget_export.parse_sections('') == budget_export.SECTIONS
+
+
+def test_cli_exports_all_plans_with_plan_ids(tmp_path, monkeypatch):
+    monkeypatch.setattr(plan_store, 'PLAN_STORE_DIR', str(tmp_path / 'plans'))
+    monkeypatch.setattr(plan_store, '_listeners', [])
+    first, second = plan_store.create(PLAN), plan_store.create(dict(PLAN, currency_symbol='$'))
+    output = tmp_path / 'out.csv'
+    assert budget_export.main(['--format', 'csv', '-o', str(output)]) == 0
+    rows = list(csv.reader(output.open(encoding='utf-8')))
+    assert rows[0] == budget_export.MULTI_PLAN_CSV_COLUMNS
+    assert {r[0] for r in rows[1:]} == {first, second}
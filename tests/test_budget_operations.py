@@ -0,0 +1,82 @@
+import budget_operations
+
+
+def test_merge_applies_delta_on_top_of_concurrent_change():
+    base = {'Materials': 500.0, 'Labor': 300.0, 'Contingency': 200.0}
+    proposed = {'Materials': 600.0, 'Labor': 300.0, 'Contingency': 100.0} # Move 100 from contingency
+    current = {'Materials': 500.0, 'Labor': 350.0, 'Contingency': 150.0} # An event took 50 meanwhile
+    merged, conflicts = budget_operations.merge_budget_delta(base, proposed, current)
+    assert merged == {'Materials': 600.0, 'Labor': 350.0, 'Contingency': 50.0}
+    assert conflicts == []
+
+
+def test_merge_reports_categories_that_would_go_negative():
+    base = {'Materials': 500.0, 'Contingency': 200.0}
+    proposed = {'Materials': 650.0, 'Contingency': 50.0}
+    current = {'Materials': 600.0, 'Contingency': 100.0} # Contingency already drawn down
+    merged, conflicts = budget_operations.merge_budget_delta(base, proposed, current)
+    assert merged['Contingency'] == -50.0
+    assert conflicts == ['Contingency']
+
+
+def test_merge_adds_and_removes_categories():
+    base = {'Materials': 500.0, 'Permits': 100.0}
+    proposed = {'Materials': 500.0, 'Inspection': 100.0} # Permits renamed
+    current = {'Materials': 450.0, 'Permits': 100.0, 'Labor': 50.0}
+    merged, conflicts = budget_operations.merge_budget_delta(base, proposed, current)
+    assert merged == {'Materials': 450.0, 'Inspection': 100.0, 'Labor': 50.0}
+    assert conflicts == []
+
+
+def test_merge_keeps_category_that_was_refilled_concurrently():
+    base = {'Permits': 100.0}
+    proposed = {}
+    current = {'Permits': 150.0}
+    merged, conflicts = budget_operations.merge_budget_delta(base, proposed, current)
+    assert merged == {'Permits': 50.0}
+    assert conflicts == []
+
+
+# --- Draft budget from uploaded history ---
+HISTORY_CSV = """Budget Item,Category,Estimated Cost (USD),Allocated Budget (USD),Comments
+Lumber,Materials,"$4,000","$4,400",Price rise
+Crew,Labor,3000,3300,
+Tools,Materials,1000,1100,
+Buffer,Contingency,1000,1200,
+"""
+
+
+def test_parse_history_table_sums_allocations_per_category():
+    table = budget_operations.parse_history_table(HISTORY_CSV)
+    assert table == {'mix': {'Materials': 5500.0, 'Labor': 3300.0, 'Contingency': 1200.0},
+                     'allocated_total': 10000.0, 'estimated_total': 9000.0}
+
+
+def test_parse_history_table_needs_category_and_amount_columns():
+    assert budget_operations.parse_history_table("Item,Notes\nLumber,cheap\n") is None
+    assert budget_operations.parse_history_table("") is None
+
+
+def test_draft_scales_history_mix_to_the_budget():
+    draft = budget_operations.draft_budget_from_table(budget_operations.parse_history_table(HISTORY_CSV), 20000)
+    # Contingency: larger of the history's share (12%) and the overrun over estimates (11.1%)
+    assert draft['Contingency'] == 2400.0
+    assert draft['Materials'] == round(17600 * 5500 / 8800, 2)
+    assert draft['Labor'] == round(17600 * 3300 / 8800, 2)
+    assert round(sum(draft.values()), 2) == 20000
+
+
+def test_draft_contingency_is_clamped():
+    table = {'mix': {'Materials': 1000.0}, 'allocated_total': 0.0, 'estimated_total': 0.0}
+    draft = budget_operations.draft_budget_from_table(table, 1000)
+    assert draft == {'Materials': 950.0, 'Contingency': 50.0} # DRAFT_CONTINGENCY_MIN
+    table = {'mix': {'Materials': 1000.0}, 'allocated_total': 2000.0, 'estimated_total': 1000.0}
+    assert budget_operations.draft_budget_from_table(table, 1000)['Contingency'] == 200.0 # DRAFT_CONTINGENCY_MAX
+
+
+def test_no_draft_without_usable_history_or_budget():
+    table = budget_operations.parse_history_table(HISTORY_CSV)
+    assert budget_operations.draft_budget_from_table(None, 1000) is None
+    assert budget_operations.draft_budget_from_table(table, 0) is None
+    only_contingency = {'mix': {'Contingency': 100.0}, 'allocated_total': 0.0, 'estimated_total': 0.0}
+    assert budget_operations.draft_budget_from_table(only_contingency, 1000) is None
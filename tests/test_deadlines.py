@@ -0,0 +1,33 @@
+import concurrent.futures
+import threading
+
+import deadlines
+
+
+def settle(future, **kwargs):
+    """Chains a recorder on future and returns what it was called with (or None if it never ran)."""
+    results, done = [], threading.Event()
+    def record(result, tag):
+        results.append((result, tag))
+        done.set()
+    deadlines.when_done(future, record, 'tag', **kwargs)
+    return results, done
+
+
+def test_when_done_runs_the_callback_on_a_stage_worker():
+    future = concurrent.futures.Future()
+    results, done = settle(future)
+    assert not done.is_set() # Nothing waits on the future meanwhile
+    future.set_result('research')
+    assert done.wait(5)
+    assert results == [('research', 'tag')]
+
+def test_failed_future_skips_the_callback_unless_asked():
+    skipped, failed = concurrent.futures.Future(), concurrent.futures.Future()
+    skipped_results, _ = settle(skipped)
+    failed_results, done = settle(failed, run_on_failure=True)
+    skipped.set_exception(RuntimeError('boom'))
+    failed.set_exception(RuntimeError('boom'))
+    assert done.wait(5)
+    assert failed_results == [(None, 'tag')]
+    assert skipped_results == []
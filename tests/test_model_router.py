@@ -0,0 +1,113 @@
+import time
+
+import pytest
+
+pytest.importorskip('google.generativeai')
+
+import model_router
+import model_scheduler
+
+
+class FakeModel:
+    """Answers after delay seconds, or raises error; records its calls."""
+
+    def __init__(self, answer='ok', delay=0.0, error=None):
+        self.answer, self.delay, self.error = answer, delay, error
+        self.calls = 0
+
+    def generate_content(self, prompt, **kwargs):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return self.answer
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    scheduler = model_scheduler.ModelScheduler(concurrency=2)
+    monkeypatch.setattr(model_scheduler, 'scheduler', scheduler)
+    return scheduler
+
+
+def make_router(models, **kwargs):
+    router = model_router.ModelRouter(**kwargs)
+    router._model = lambda tier: models[tier]
+    return router
+
+
+def test_tier_overrides_are_merged_into_the_defaults():
+    router = model_router.ModelRouter(tiers={'fast': {'model': 'custom-flash', 'deadline': 5}})
+    assert set(router.tiers) == set(model_router.DEFAULT_TIERS) # Fallback tiers are kept
+    assert router.tiers['fast'] == {'model': 'custom-flash', 'deadline': 5}
+    assert router.tiers['large'] == model_router.DEFAULT_TIERS['large']
+
+def test_tier_overrides_can_tweak_add_and_remove_tiers():
+    tiers = model_router.ModelRouter.merge_tiers({'standard': {'deadline': 10}, 'large': None,
+                                                  'local': {'model': 'local-model'}, 'broken': {'deadline': 3}})
+    assert tiers['standard'] == dict(model_router.DEFAULT_TIERS['standard'], deadline=10)
+    assert 'large' not in tiers and 'broken' not in tiers
+    assert tiers['local'] == {'model': 'local-model'}
+    assert model_router.DEFAULT_TIERS['standard']['deadline'] == 45 # Defaults untouched
+
+
+def test_routed_tier_serves_the_call(scheduler):
+    models = {'fast': FakeModel('fast answer'), 'standard': FakeModel(), 'large': FakeModel()}
+    router = make_router(models)
+    assert router.generate('qna', 'prompt') == ('fast answer', 'fast')
+    assert models['standard'].calls == models['large'].calls == 0
+
+def test_failed_tier_falls_back_and_is_recorded(scheduler):
+    models = {'fast': FakeModel(error=RuntimeError('boom')), 'standard': FakeModel('standard answer'), 'large': FakeModel()}
+    router = make_router(models)
+    assert router.generate('qna', 'prompt') == ('standard answer', 'standard')
+    assert router.stats['fast'].errors == 1
+    assert router.stats['standard'].calls == 1
+
+def test_unhealthy_tiers_are_tried_last(scheduler):
+    router = make_router({})
+    for _ in range(5):
+        router.stats['standard'].record(1.0, ok=False)
+    router.stats['large'].record(1.0, ok=True)
+    assert router.candidates('qna') == ['fast', 'large', 'standard']
+
+def test_every_tier_failing_raises_the_last_error(scheduler):
+    error = RuntimeError('down')
+    router = make_router({tier: FakeModel(error=error) for tier in model_router.DEFAULT_TIERS})
+    with pytest.raises(RuntimeError, match='down'):
+        router.generate('qna', 'prompt')
+
+
+def _prime_latency(router, agent, tier, seconds):
+    stats = router._agent_stats(agent, tier)
+    for _ in range(model_router.HEDGE_MIN_SAMPLES):
+        stats.record(seconds, ok=True)
+
+def test_slow_call_is_hedged_with_its_own_slot(scheduler, monkeypatch):
+    monkeypatch.setattr(model_router, 'HEDGE_MIN_DELAY', 0.05)
+    router = make_router({'standard': FakeModel(delay=0.3)})
+    _prime_latency(router, 'proposal', 'standard', 0.01)
+    with scheduler.slot('proposal'):
+        assert router.generate('proposal', 'prompt') == ('ok', 'standard')
+        assert scheduler.snapshot()['in_flight'] == 2 # The losing call still holds the hedge slot
+    time.sleep(0.4)
+    assert scheduler.snapshot()['in_flight'] == 0
+    assert router.stats['standard'].hedges == 1
+
+def test_hedge_is_skipped_without_a_free_slot(scheduler, monkeypatch):
+    monkeypatch.setattr(model_router, 'HEDGE_MIN_DELAY', 0.05)
+    model = FakeModel(delay=0.2)
+    router = make_router({'standard': model})
+    _prime_latency(router, 'proposal', 'standard', 0.01)
+    with scheduler.slot('proposal'), scheduler.slot('proposal'): # Concurrency 2, both taken
+        assert router.generate('proposal', 'prompt') == ('ok', 'standard')
+    assert model.calls == 1
+    assert router.stats['standard'].hedges_skipped == 1
+
+def test_hedge_delay_uses_the_agents_own_latency(scheduler):
+    router = make_router({})
+    _prime_latency(router, 'research', 'standard', 30.0)
+    _prime_latency(router, 'digest', 'standard', 2.0)
+    assert router._hedge_delay('digest', 'standard') == 2.0
+    assert router._hedge_delay('research', 'standard') == 30.0
+    assert router._hedge_delay('qna', 'standard') is None # Not a hedged agent
@@ -0,0 +1,123 @@
+import threading
+import time
+
+import pytest
+
+import model_scheduler
+
+
+@pytest.fixture
+def scheduler():
+    return model_scheduler.ModelScheduler(concurrency=1)
+
+
+def wait_for_queued(scheduler, priority, count):
+    deadline = time.monotonic() + 2
+    while scheduler.snapshot()['classes'][priority]['queued'] < count:
+        assert time.monotonic() < deadline, "call never queued"
+        time.sleep(0.005)
+
+def queue_calls(scheduler, calls, order):
+    """Queues (user, agent) calls one after another behind a held slot; each records its user once it runs."""
+    threads = []
+    for user, agent in calls:
+        def run(user=user, agent=agent):
+            with model_scheduler.caller(user), scheduler.slot(agent):
+                order.append(user)
+        priority = model_scheduler.AGENT_PRIORITIES[agent]
+        queued = scheduler.snapshot()['classes'][priority]['queued']
+        thread = threading.Thread(target=run)
+        thread.start()
+        wait_for_queued(scheduler, priority, queued + 1)
+        threads.append(thread)
+    return threads
+
+def run_queued(scheduler, calls):
+    order = []
+    scheduler.acquire('qna') # Hold the only slot so every call queues
+    threads = queue_calls(scheduler, calls, order)
+    scheduler.release()
+    for thread in threads:
+        thread.join(timeout=5)
+    return order
+
+
+def test_idle_scheduler_runs_without_queueing(scheduler):
+    assert scheduler.acquire('proposal') == ('planning', 0.0)
+    scheduler.release()
+
+def test_interactive_calls_run_before_planning(scheduler):
+    order = run_queued(scheduler, [('planner', 'proposal'), ('asker', 'qna')])
+    assert order == ['asker', 'planner']
+
+def test_fair_queuing_interleaves_users(scheduler):
+    order = run_queued(scheduler, [('busy', 'research'), ('busy', 'research'), ('busy', 'research'), ('quick', 'research')])
+    assert order.index('quick') <= 1 # Not behind all of busy's calls
+
+def test_weights_give_a_larger_share(scheduler):
+    scheduler.weights = {'heavy': 2.0}
+    order = run_queued(scheduler, [('light', 'research'), ('light', 'research'), ('heavy', 'research'), ('heavy', 'research')])
+    assert order == ['heavy', 'light', 'heavy', 'light'] # Tags 1.5, 2, 2, 3: heavy's calls cost half as much
+
+
+def test_per_user_queue_limit_rejects(scheduler, monkeypatch):
+    monkeypatch.setitem(model_scheduler.MAX_USER_QUEUED, 'interactive', 1)
+    scheduler.acquire('qna')
+    threads = queue_calls(scheduler, [('asker', 'qna')], [])
+    with model_scheduler.caller('asker'), pytest.raises(model_scheduler.SchedulerRejected, match='queue full'):
+        scheduler.acquire('qna')
+    with model_scheduler.caller('other'): # Another user still gets in line
+        threads += queue_calls(scheduler, [('other', 'qna')], [])
+    scheduler.release()
+    for thread in threads:
+        thread.join(timeout=5)
+    assert scheduler.stats['interactive'].rejected == 1
+
+def test_class_queue_depth_rejects(scheduler, monkeypatch):
+    monkeypatch.setitem(model_scheduler.MAX_QUEUE_DEPTH, 'planning', 1)
+    scheduler.acquire('qna')
+    threads = queue_calls(scheduler, [('a', 'proposal')], [])
+    with model_scheduler.caller('b'), pytest.raises(model_scheduler.SchedulerRejected):
+        scheduler.acquire('proposal')
+    scheduler.release()
+    threads[0].join(timeout=5)
+
+def test_max_wait_rejects_and_leaves_the_queue(scheduler, monkeypatch):
+    monkeypatch.setitem(model_scheduler.MAX_WAIT_SECONDS, 'interactive', 0.05)
+    scheduler.acquire('proposal')
+    with pytest.raises(model_scheduler.SchedulerRejected, match='Waited more than'):
+        scheduler.acquire('qna')
+    assert scheduler.snapshot()['classes']['interactive']['queued'] == 0
+    scheduler.release()
+
+
+def test_try_acquire_only_takes_a_free_slot(scheduler):
+    assert scheduler.try_acquire()
+    assert not scheduler.try_acquire()
+    scheduler.release()
+    assert scheduler.snapshot()['in_flight'] == 0
+
+
+# --- Caller Context ---
+def test_bind_carries_the_caller_into_another_thread():
+    seen = []
+    with model_scheduler.caller('alice', priority='batch'):
+        bound = model_scheduler.bind(lambda: seen.append(model_scheduler.current_caller()))
+    thread = threading.Thread(target=bound)
+    thread.start()
+    thread.join()
+    assert seen == [('alice', 'batch')]
+
+def test_lazy_caller_is_resolved_once_on_first_use():
+    lookups = []
+    def lookup():
+        lookups.append(1)
+        return 'session-user'
+    model_scheduler.set_caller(user=lookup)
+    try:
+        assert lookups == [] # Setting the caller does not look it up
+        assert model_scheduler.current_caller() == ('session-user', None)
+        assert model_scheduler.current_caller()[0] == 'session-user'
+        assert lookups == [1]
+    finally:
+        model_scheduler.clear_caller()
@@ -0,0 +1,107 @@
+import os
+import threading
+import time
+
+import pytest
+
+import plan_store
+
+
+@pytest.fixture(autouse=True)
+def store_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(plan_store, 'PLAN_STORE_DIR', str(tmp_path))
+    monkeypatch.setattr(plan_store, '_listeners', [])
+    return tmp_path
+
+
+def test_update_reruns_mutation_on_conflict():
+    plan_id = plan_store.create({'log': []})
+    calls = []
+
+    def mutate(state):
+        calls.append(list(state['log']))
+        if len(calls) == 1: # Another writer lands between our read and our write
+            plan_store.update(plan_id, lambda other: other['log'].append('other'))
+        state['log'].append('mine')
+        return len(calls)
+
+    result, state, version = plan_store.update(plan_id, mutate)
+    assert result == 2
+    assert calls == [[], ['other']] # Re-run against the fresh state
+    assert state['log'] == ['other', 'mine']
+    assert plan_store.load(plan_id) == ({'log': ['other', 'mine']}, version)
+    assert version == 3
+
+
+def test_update_gives_up_after_max_retries():
+    plan_id = plan_store.create({'n': 0})
+
+    def always_conflicts(state):
+        plan_store.update(plan_id, lambda other: other.update(n=other['n'] + 1))
+
+    with pytest.raises(plan_store.PlanConflict):
+        plan_store.update(plan_id, always_conflicts, max_retries=3)
+    assert plan_store.load(plan_id)[0]['n'] == 3 # The competing writes all landed
+
+
+def test_concurrent_updates_lose_nothing():
+    plan_id = plan_store.create({'n': 0})
+
+    def worker():
+        for _ in range(25):
+            plan_store.update(plan_id, lambda state: state.update(n=state['n'] + 1), max_retries=1000)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    state, version = plan_store.load(plan_id)
+    assert state['n'] == 200
+    assert version == 201
+    assert plan_id not in plan_store._thread_locks # Released locks are dropped
+
+
+def test_compare_and_swap_rejects_stale_version():
+    plan_id = plan_store.create({'a': 1})
+    assert plan_store.compare_and_swap(plan_id, 1, {'a': 2}) == 2
+    assert plan_store.compare_and_swap(plan_id, 1, {'a': 3}) is None
+    assert plan_store.load(plan_id) == ({'a': 2}, 2)
+
+
+def test_purge_expired_removes_idle_plans(store_dir):
+    old_id = plan_store.create({'old': True})
+    plan_store.update(old_id, lambda state: None) # Leaves a .lock file
+    new_id = plan_store.create({'old': False})
+    stale = time.time() - 3600
+    for filename in os.listdir(store_dir):
+        if filename.startswith(old_id):
+            os.utime(store_dir / filename, (stale, stale))
+
+    assert plan_store.purge_expired(max_age=60) == 1
+    assert sorted(plan_store.iter_plan_ids()) == [new_id]
+    assert not any(f.startswith(old_id) for f in os.listdir(store_dir))
+    with pytest.raises(plan_store.PlanNotFound):
+        plan_store.load(old_id)
+
+
+def test_delete_waits_for_an_in_flight_write(store_dir):
+    plan_id = plan_store.create({'a': 1})
+    deleted = threading.Event()
+    with plan_store._PlanLock(plan_id): # A writer mid compare_and_swap
+        thread = threading.Thread(target=lambda: plan_store.delete(plan_id) and deleted.set())
+        thread.start()
+        assert not deleted.wait(0.2)
+        assert os.path.exists(store_dir / f"{plan_id}.json.lock")
+    thread.join(timeout=5)
+    assert deleted.is_set()
+    assert os.listdir(store_dir) == []
+    with pytest.raises(plan_store.PlanNotFound):
+        plan_store.update(plan_id, lambda state: None) # A writer queued behind the delete finds no plan
+
+
+def test_delete_keeps_a_plan_written_since_the_cutoff(store_dir):
+    plan_id = plan_store.create({'a': 1})
+    plan_store.update(plan_id, lambda state: None)
+    assert plan_store.delete(plan_id, idle_before=time.time() - 60) is False
+    assert sorted(os.listdir(store_dir)) == [f"{plan_id}.json", f"{plan_id}.json.lock"]
@@ -0,0 +1,91 @@
+import threading
+
+import pytest
+
+import plan_store
+import portfolio
+
+
+@pytest.fixture(autouse=True)
+def index(tmp_path, monkeypatch):
+    monkeypatch.setattr(plan_store, 'PLAN_STORE_DIR', str(tmp_path / 'plans'))
+    monkeypatch.setattr(plan_store, '_listeners', [])
+    monkeypatch.setattr(portfolio, 'PORTFOLIO_DB', str(tmp_path / 'portfolio.sqlite3'))
+    monkeypatch.setattr(portfolio, '_local', threading.local()) # Every thread, the writer too, reconnects to this db
+    portfolio.init_app(None)
+    yield
+    portfolio.flush()
+
+
+def make_plan(goal, currency='$', materials=600.0, contingency=400.0, **extra):
+    budget = {'Materials': materials, 'Contingency': contingency}
+    return plan_store.create(dict({'goal': goal, 'currency_symbol': currency, 'initial_budget': budget,
+                                   'current_budget': dict(budget)}, **extra))
+
+def reallocate(plan_id, amount):
+    def mutate(state):
+        state['current_budget']['Contingency'] -= amount
+        state['current_budget']['Materials'] += amount
+    plan_store.update(plan_id, mutate)
+
+
+def test_totals_are_kept_per_currency():
+    make_plan('Garden shed')
+    make_plan('Kitchen remodel', materials=1400.0, contingency=600.0)
+    make_plan('Bridge repair', currency='€')
+    portfolio.flush()
+    totals = {t['currency']: t for t in portfolio.totals_by_currency()}
+    assert totals['$']['plans'] == 2 and totals['$']['initial_total'] == 3000.0
+    assert totals['€']['plans'] == 1 and totals['€']['initial_total'] == 1000.0
+    by_category = {r['category_key']: r for r in portfolio.totals_by_category('$')}
+    assert by_category['materials']['current_total'] == 2000.0
+
+
+def test_reallocations_log_events_and_burn_contingency():
+    plan_id = make_plan('Garden shed')
+    reallocate(plan_id, 100.0)
+    reallocate(plan_id, 50.0)
+    portfolio.flush()
+    assert portfolio.contingency_burn('$') == {'burned': 150.0, 'plans': 1}
+    frequency = {r['category_key']: r['reallocations'] for r in portfolio.reallocation_frequency()}
+    assert frequency == {'materials': 2, 'contingency': 2}
+    summary = portfolio.summary()
+    assert summary['currencies'][0]['contingency_consumed'] == 150.0
+    assert summary['currencies'][0]['current_total'] == 1000.0 # Aggregates moved with the plan, not added twice
+
+
+def test_storing_a_late_proposal_is_not_a_reallocation():
+    plan_id = make_plan('Garden shed', materials=0.0, contingency=0.0, proposal_pending=True)
+    def store_proposal(state):
+        state['current_budget'] = state['initial_budget'] = {'Materials': 700.0, 'Contingency': 300.0}
+        state['proposal_pending'] = False
+    plan_store.update(plan_id, store_proposal)
+    portfolio.flush()
+    assert portfolio.reallocation_frequency() == []
+    assert portfolio.totals_by_currency()[0]['current_total'] == 1000.0
+
+
+def test_goal_filter_applies_to_every_aggregate():
+    shed = make_plan('Garden shed')
+    make_plan('Bridge repair')
+    reallocate(shed, 100.0)
+    portfolio.flush()
+    summary = portfolio.summary(goal_contains='shed')
+    assert summary['plans'] == 1
+    assert summary['currencies'][0]['contingency_burn'] == {'burned': 100.0, 'plans': 1}
+    assert portfolio.summary(goal_contains='bridge')['currencies'][0]['contingency_burn']['burned'] == 0
+
+
+def test_older_snapshot_does_not_overwrite_a_newer_one():
+    state = {'goal': 'Shed', 'current_budget': {'Materials': 900.0}}
+    portfolio.record_snapshot('p1', None, state, 3)
+    portfolio.record_snapshot('p1', None, dict(state, current_budget={'Materials': 100.0}), 2)
+    assert portfolio.totals_by_currency()[0]['current_total'] == 900.0
+
+
+def test_rebuild_reindexes_stored_plans():
+    make_plan('Garden shed')
+    make_plan('Bridge repair', currency='€')
+    portfolio.flush()
+    assert portfolio.rebuild() == 2
+    assert {t['currency'] for t in portfolio.totals_by_currency()} == {'$', '€'}
@@ -0,0 +1,42 @@
+import threading
+import time
+
+import pytest
+
+import deadlines
+import profiler
+
+
+@pytest.fixture(autouse=True)
+def fast_sampling(monkeypatch):
+    monkeypatch.setattr(profiler, 'PROFILE_INTERVAL_MS', 1)
+    profiler.reset()
+    yield
+    profiler.reset()
+
+
+def busy_stage():
+    time.sleep(0.2)
+    return 'done'
+
+
+def test_stage_workers_are_sampled_under_the_request_profile():
+    profile_id = profiler.start('POST /generate', keep_request=True)
+    try:
+        future = deadlines.submit(busy_stage)
+        assert future.result(timeout=5) == 'done'
+    finally:
+        profiler.stop()
+    request_stacks = profiler.folded(profile_id=profile_id)
+    assert 'busy_stage' in request_stacks
+    assert 'busy_stage' in profiler.folded(route_filter='/generate')
+    assert not profiler._active # The worker detached when the stage finished
+
+
+def test_bind_is_a_no_op_outside_a_profile():
+    assert profiler.bind(busy_stage) is busy_stage
+    result = []
+    thread = threading.Thread(target=lambda: result.append(profiler.bind(busy_stage)()))
+    thread.start()
+    thread.join()
+    assert result == ['done']
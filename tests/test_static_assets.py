@@ -0,0 +1,25 @@
+import static_assets
+
+
+# --- minify_css ---
+def test_css_keeps_descendant_pseudo_selectors():
+    assert static_assets.minify_css('.a :hover { color : red ; }') == '.a :hover{color:red}'
+    assert static_assets.minify_css('.a:hover , .b > .c { margin : 0 }') == '.a:hover,.b>.c{margin:0}'
+
+def test_css_strips_comments_but_not_strings():
+    css = '/* head */ .a { content : "a  ;  /* b */" ; } @media (min-width: 600px) { .b { top : 0 } }'
+    assert static_assets.minify_css(css) == '.a{content:"a  ;  /* b */"}@media (min-width: 600px){.b{top:0}}'
+
+
+# --- minify_js ---
+def test_js_drops_comments_indentation_and_blank_lines():
+    js = '// header\nfunction f() {\n    /* block\n       comment */\n\n    return 1; // trailing\n}\n'
+    assert static_assets.minify_js(js) == 'function f() {\nreturn 1;\n}'
+
+def test_js_copies_literals_verbatim():
+    js = 'var url = "http://x/*y*/";\nvar re = /\\/*foo/g;\nvar t = `line1\n    // kept`;\n'
+    assert static_assets.minify_js(js) == js.strip()
+
+def test_js_tells_division_from_regex():
+    assert static_assets.minify_js('var d = a.length / 2 / 1; // half') == 'var d = a.length / 2 / 1;'
+    assert static_assets.minify_js('if (x) return /a+b/.test(s) // match') == 'if (x) return /a+b/.test(s)'
@@ -0,0 +1,95 @@
+import pytest
+
+import structured_output
+
+
+# --- extract_json ---
+@pytest.mark.parametrize('text, expected', [
+    ('{"a": 1}', {'a': 1}),
+    ('```json\n{"a": 1}\n```', {'a': 1}),
+    ('Sure! Here it is: ["Q1?", "Q2?"] Hope that helps.', ['Q1?', 'Q2?']),
+    ('Here is {bad} then {"a": 1}', {'a': 1}),
+])
+def test_extract_json_skips_prose_and_fences(text, expected):
+    assert structured_output.extract_json(text) == (expected, None)
+
+def test_extract_json_reports_missing_json():
+    assert structured_output.extract_json('no json here') == (None, "No JSON found in response.")
+    assert structured_output.extract_json('') == (None, "Empty response.")
+    value, error = structured_output.extract_json('{"a": ')
+    assert value is None and error
+
+
+# --- coerce_amount ---
+@pytest.mark.parametrize('raw, expected', [
+    (1200, 1200.0),
+    ('1200', 1200.0),
+    ('$1,200.50', 1200.5),
+    ('USD 1200', 1200.0),
+    ('1,234,567', 1234567.0),
+    ('1.5k', None),
+    ('2 million', None),
+    ('1,2,3', None),
+    ('12,00', None),
+    (float('nan'), None),
+    (float('inf'), None),
+    (True, None),
+    (None, None),
+])
+def test_coerce_amount(raw, expected):
+    assert structured_output.coerce_amount(raw) == expected
+
+
+# --- parse_budget ---
+def test_parse_budget_accepts_schema_and_plain_shapes():
+    schema_shape = '{"allocations": [{"category": "Labor", "amount": 600}, {"category": "Contingency", "amount": "$400"}]}'
+    assert structured_output.parse_budget(schema_shape, 1000) == ({'Labor': 600.0, 'Contingency': 400.0}, None)
+    assert structured_output.parse_budget('{"Labor": 600, "Contingency": 400}', 1000) == ({'Labor': 600.0, 'Contingency': 400.0}, None)
+
+def test_parse_budget_merges_duplicate_categories():
+    text = '{"allocations": [{"category": "Labor", "amount": 300}, {"category": "Labor ", "amount": 300}, {"category": "Tools", "amount": 400}]}'
+    assert structured_output.parse_budget(text, 1000) == ({'Labor': 600.0, 'Tools': 400.0}, None)
+
+def test_small_difference_goes_into_contingency():
+    budget, error = structured_output.parse_budget('{"Labor": 600, "Contingency": 370}', 1000)
+    assert error is None
+    assert budget == {'Labor': 600.0, 'Contingency': 400.0}
+
+def test_larger_difference_is_scaled_proportionally():
+    budget, error = structured_output.parse_budget('{"Labor": 450, "Tools": 450}', 1000)
+    assert error is None
+    assert budget == {'Labor': 500.0, 'Tools': 500.0}
+    assert sum(budget.values()) == 1000
+
+@pytest.mark.parametrize('text, message', [
+    ('{"Labor": 50000, "Contingency": 5000}', 'too far from the target'),
+    ('{"A": 0, "B": 0}', 'nothing was allocated'),
+    ('{"A": NaN}', 'Unusable allocation'),
+    ('{"allocations": [{"category": "A", "amount": Infinity}]}', 'Unusable allocation'),
+    ('{"A": "1.5k"}', 'Unusable allocation'),
+    ('{"A": -100, "B": 1100}', 'Negative allocation'),
+    ('{"A": [100]}', 'expected number'),
+    ('{"allocations": [{"amount": 100}]}', "missing 'category'"),
+    ('[1000]', 'expected object'),
+    ('{}', 'empty proposal'),
+])
+def test_parse_budget_rejects_unusable_output(text, message):
+    budget, error = structured_output.parse_budget(text, 1000)
+    assert budget is None
+    assert message in error
+
+
+# --- Other parsers ---
+def test_parse_questions_unwraps_and_cleans():
+    assert structured_output.parse_questions('{"questions": [" Q1? ", "", 3, "Q2?"]}') == (['Q1?', 'Q2?'], None)
+    assert structured_output.parse_questions('[]') == (None, "AI returned no questions.")
+
+def test_parse_digest_fills_optional_lists():
+    digest, error = structured_output.parse_digest('{"cost_categories": [{"name": "Labor"}], "risks": ["Delays"]}')
+    assert error is None
+    assert digest['cost_factors'] == [] and digest['benchmarks'] == []
+
+def test_validate_rejects_non_finite_numbers():
+    schema = {"type": "object", "properties": {"x": {"type": "number"}}}
+    assert structured_output.validate({'x': 1.5}, schema) is None
+    assert 'finite' in structured_output.validate({'x': float('nan')}, schema)
@@ -0,0 +1,433 @@
+"""
+Opt-in production traffic capture and deterministic replay.
+
+Capture (set TRAFFIC_CAPTURE_DIR to enable): every request is appended to
+<dir>/capture-<pid>.jsonl with its route, anonymized form/JSON fields, upload
+sizes, status and duration, keyed by an anonymous per-browser tag. Every model
+call is recorded too (agent, prompt size, latency, response). Free text is
+masked word by word (lengths, digits, punctuation and the modification keywords
+that steer /interact_ai are kept). Structured JSON model responses keep their
+shape so replay can parse them, but every string inside them is masked too,
+with same-length pseudonyms (consistent within one capture process) so that
+category names still match across the proposal, modifications and events.
+
+Model calls are attributed to the browser and the request that was in flight
+when they started; calls that start after their request returned (overrunning
+stages finishing in the background) are recorded as background calls.
+
+Replay re-drives a trace against an in-process instance: one thread, cookie
+jar and seeded random generator per captured browser, requests at their
+captured offsets divided by --speed (0 = no waiting), and the model replaced by
+the responses recorded for the same browser, request and agent (background
+calls from that browser's own queue), with their recorded latency. No network
+access needed.
+
+Usage:
+    TRAFFIC_CAPTURE_DIR=captures/ python app.py
+    python traffic_capture.py replay captures/ --speed 10 --output replay_stats.json
+"""
+import argparse
+import collections
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import model_scheduler
+import structured_output
+
+TRAFFIC_CAPTURE_DIR = os.environ.get('TRAFFIC_CAPTURE_DIR')
+SKIPPED_ENDPOINTS = {'static', 'serve_asset'} # Asset fetches are not part of the workload
+SKIPPED_PREFIXES = ('/admin',)
+FREE_TEXT_FIELDS = {'goal', 'ai_request', 'event_category'} # Plus every answer_<n> field
+CATEGORY_FIELDS = {'event_category'} # Pseudonymized like model responses so events hit the same categories
+# Kept unmasked so replayed /interact_ai requests take the same question/modification path
+KEEP_WORDS = {'change', 'modify', 'update', 'set', 'increase', 'decrease', 'add', 'remove', 'allocate', 'adjust', 'revise',
+              'error', 'blocked', 'contingency'}
+JSON_AGENTS = {'questions', 'proposal', 'modification', 'digest'} # Structured responses: strings masked, shape kept
+MAX_TRACKED_CLIENTS = 1024 # Browsers whose recent requests are remembered for attributing model calls
+
+_lock = threading.Lock()
+_salt = uuid.uuid4().hex # Per-process: browser tags can't be linked across captures
+_seq = 0
+_client_requests = collections.OrderedDict() # scheduler caller -> deque of [seq, started, finished or None]
+
+
+# --- Anonymization ---
+def _pseudonym(word):
+    """Same-length letters derived from the salted word; the same word always maps the same way (case kept)."""
+    digest = hashlib.sha256(f"{_salt}:{word.lower()}".encode('utf-8')).hexdigest()
+    letters = [chr(ord('a') + int(digest[i % len(digest)], 16)) for i in range(len(word))]
+    return ''.join(l.upper() if c.isupper() else l for l, c in zip(letters, word))
+
+def anonymize_text(text, keep=KEEP_WORDS, mask=lambda word: 'x' * len(word)):
+    """Replaces every word not in keep with mask(word) (default: x's of the same length)."""
+    return re.sub(r'[^\W\d_]+', lambda m: m.group(0) if m.group(0).lower() in keep else mask(m.group(0)), str(text))
+
+def _schema_keys(schema):
+    keys = set(schema.get('properties', {}))
+    for child in list(schema.get('properties', {}).values()) + [schema.get('items')]:
+        if child:
+            keys |= _schema_keys(child)
+    return keys
+
+# Property names of the response schemas; any other object key (e.g. a category name) is masked
+SCHEMA_KEYS = _schema_keys(structured_output.BUDGET_SCHEMA) | _schema_keys(structured_output.DIGEST_SCHEMA)
+
+def anonymize_json_text(text):
+    """
+    Pseudonymizes every string inside a JSON response, and every object key that
+    isn't a schema property name. A response without JSON is masked as a whole.
+    """
+    data, error = structured_output.extract_json(text) # Fences and surrounding prose are dropped
+    if error:
+        return anonymize_text(text, mask=_pseudonym)
+    def mask(value):
+        if isinstance(value, str):
+            return anonymize_text(value, mask=_pseudonym)
+        if isinstance(value, list):
+            return [mask(v) for v in value]
+        if isinstance(value, dict):
+            return {k if k in SCHEMA_KEYS else anonymize_text(k, mask=_pseudonym): mask(v) for k, v in value.items()}
+        return value
+    return json.dumps(mask(data))
+
+def _anonymize_fields(fields):
+    anonymized = {}
+    for name, value in fields.items():
+        if isinstance(value, str) and name in CATEGORY_FIELDS:
+            value = anonymize_text(value, mask=_pseudonym)
+        elif isinstance(value, str) and (name in FREE_TEXT_FIELDS or name.startswith('answer_')):
+            value = anonymize_text(value)
+        anonymized[name] = value
+    return anonymized
+
+def _client_tag(caller_id):
+    """Stable anonymous id for one browser (its model scheduler caller id: Flask-Session sid, salted and hashed)."""
+    return hashlib.sha256(f"{_salt}:{caller_id or 'anonymous'}".encode('utf-8')).hexdigest()[:16]
+
+def _request_at(caller_id, started):
+    """Seq of caller_id's request that was in flight at started (monotonic), or None for a background call."""
+    with _lock:
+        for seq, request_started, finished in reversed(_client_requests.get(caller_id, ())):
+            if request_started <= started and (finished is None or started <= finished):
+                return seq
+    return None
+
+
+# --- Capture ---
+def _write(event):
+    line = json.dumps(event) + '\n'
+    with _lock:
+        with open(os.path.join(TRAFFIC_CAPTURE_DIR, f"capture-{os.getpid()}.jsonl"), 'a', encoding='utf-8') as f:
+            f.write(line)
+
+def _upload_sizes(files):
+    sizes = {}
+    for field, storage in files.items():
+        if not storage or not storage.filename:
+            continue
+        storage.stream.seek(0, os.SEEK_END)
+        size = storage.stream.tell()
+        storage.stream.seek(0)
+        sizes[field] = {'ext': storage.filename.rsplit('.', 1)[-1].lower() if '.' in storage.filename else '', 'size': size}
+    return sizes
+
+def init_app(app):
+    """Registers the capture hooks when TRAFFIC_CAPTURE_DIR is set; otherwise does nothing."""
+    if not TRAFFIC_CAPTURE_DIR:
+        return False
+    from flask import g, request
+    import research_agent
+    os.makedirs(TRAFFIC_CAPTURE_DIR, exist_ok=True)
+
+    def skipped():
+        return request.endpoint in SKIPPED_ENDPOINTS or request.path.startswith(SKIPPED_PREFIXES)
+
+    @app.before_request
+    def capture_start():
+        global _seq
+        if skipped():
+            return
+        g.capture_caller = model_scheduler.current_caller()[0] # Set by the scheduler's own before_request hook
+        g.capture_started = time.monotonic()
+        g.capture_ts = time.time()
+        with _lock:
+            _seq += 1
+            g.capture_seq = _seq
+            g.capture_entry = [_seq, g.capture_started, None]
+            recent = _client_requests.setdefault(g.capture_caller, collections.deque(maxlen=8))
+            _client_requests.move_to_end(g.capture_caller)
+            recent.append(g.capture_entry)
+            while len(_client_requests) > MAX_TRACKED_CLIENTS:
+                _client_requests.popitem(last=False)
+
+    @app.after_request
+    def capture_finish(response):
+        if 'capture_seq' not in g:
+            return response
+        g.capture_entry[2] = time.monotonic() # Model calls starting from now on are background calls
+        try:
+            _write({
+                'type': 'request',
+                'seq': g.capture_seq,
+                'ts': g.capture_ts,
+                'client': _client_tag(g.capture_caller),
+                'method': request.method,
+                'path': request.path,
+                'route': request.url_rule.rule if request.url_rule else request.path,
+                'form': _anonymize_fields(request.form.to_dict()),
+                'json': _anonymize_fields(request.get_json(silent=True) or {}),
+                'files': _upload_sizes(request.files),
+                'status': response.status_code,
+                'duration_ms': round((time.monotonic() - g.capture_started) * 1000, 1),
+            })
+        except Exception as e: # Capture must never break a request
+            print(f"Traffic capture: Failed to record request: {e}")
+        return response
+
+    def capture_model_call(agent, prompt, response_text, seconds):
+        # Runs on the thread that made the call (often a stage worker), where the scheduler caller is still bound
+        caller_id = model_scheduler.current_caller()[0]
+        if response_text is None:
+            recorded = None
+        else:
+            recorded = anonymize_json_text(response_text) if agent in JSON_AGENTS else anonymize_text(response_text)
+        _write({
+            'type': 'model',
+            'ts': time.time() - seconds, # Call start, so replay queues follow call order
+            'client': _client_tag(caller_id),
+            'request_seq': _request_at(caller_id, time.monotonic() - seconds),
+            'agent': agent,
+            'prompt_chars': len(prompt),
+            'latency_ms': round(seconds * 1000, 1),
+            'response': recorded,
+        })
+
+    research_agent.add_response_observer(capture_model_call)
+    print(f"Traffic capture: Recording to '{TRAFFIC_CAPTURE_DIR}'.")
+    return True
+
+
+# --- Replay ---
+def load_trace(path):
+    """Reads a capture file or directory of capture files, sorted by timestamp."""
+    paths = [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.jsonl')] if os.path.isdir(path) else [path]
+    events = []
+    for trace_path in paths:
+        with open(trace_path, 'r', encoding='utf-8') as f:
+            events.extend(json.loads(line) for line in f if line.strip())
+    events.sort(key=lambda e: e['ts'])
+    return events
+
+class RecordedModel:
+    """
+    Stand-in for research_agent._generate_text. Serves the responses recorded for
+    (browser, request, agent), in capture order; calls outside a replayed request
+    (or once that request's queue is empty) take the browser's background queue.
+    """
+
+    def __init__(self, model_events, speed):
+        self.queues = collections.defaultdict(collections.deque)
+        for event in model_events:
+            self.queues[(event.get('client'), event.get('request_seq'), event['agent'])].append(event)
+        self.last = {}
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.clients = {} # replay scheduler caller -> captured client tag
+        self.in_flight = {} # replay scheduler caller -> captured seq of the request being replayed
+
+    def start_request(self, caller_id, client, seq):
+        with self.lock:
+            self.clients[caller_id] = client
+            self.in_flight[caller_id] = seq
+
+    def finish_request(self, caller_id):
+        with self.lock:
+            self.in_flight.pop(caller_id, None)
+
+    def __call__(self, prompt, response_schema, agent):
+        caller_id = model_scheduler.current_caller()[0]
+        with self.lock:
+            client = self.clients.get(caller_id)
+            event = None
+            for key in ((client, self.in_flight.get(caller_id), agent), (client, None, agent)):
+                if self.queues.get(key):
+                    event = self.queues[key].popleft()
+                    break
+            event = event or self.last.get(agent) # Trace exhausted: repeat the last one
+            if event:
+                self.last[agent] = event
+        if not event:
+            return None # Agent never seen in the trace: behaves like a failed call
+        if self.speed:
+            time.sleep(event['latency_ms'] / 1000 / self.speed)
+        return event['response']
+
+class ClientRandom(threading.local):
+    """Stand-in for app's random module: each replay thread (one per browser) draws from its own seeded generator."""
+
+    def __init__(self, seed):
+        self.base_seed = seed
+        self.rng = random.Random(seed)
+
+    def seed_client(self, client):
+        self.rng = random.Random(f"{self.base_seed}:{client}")
+
+    def __getattr__(self, name):
+        return getattr(self.rng, name)
+
+def _synthetic_upload(spec):
+    """An upload of the captured size: CSV rows shaped like sample.csv."""
+    rows = ["Budget Item,Category,Estimated Cost (USD),Allocated Budget (USD),Comments"]
+    while sum(len(r) + 1 for r in rows) < spec['size']:
+        rows.append(f"Item {len(rows)},Allocation,{1000 + len(rows)},{950 + len(rows)},Replayed")
+    data = "\n".join(rows).encode('utf-8')[:spec['size']]
+    return io.BytesIO(data), f"history.{spec['ext'] or 'csv'}"
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))], 1)
+
+def replay(trace_path, speed=1.0, seed=0):
+    """
+    Re-drives a captured trace against an in-process app with the recorded model.
+    Plans and the portfolio index go to a temporary directory; random events are
+    seeded per browser, so thread interleaving doesn't change them. Returns
+    per-route stats.
+    """
+    global TRAFFIC_CAPTURE_DIR
+    TRAFFIC_CAPTURE_DIR = None # Never capture the replay itself
+    os.environ.pop('TRAFFIC_CAPTURE_DIR', None)
+    events = load_trace(trace_path)
+    requests_by_client = collections.defaultdict(list)
+    for event in events:
+        if event['type'] == 'request':
+            requests_by_client[event['client']].append(event)
+    if not requests_by_client:
+        raise ValueError(f"No requests found in '{trace_path}'.")
+
+    from flask import request
+    import blob_store
+    import plan_store
+    import portfolio
+    import research_agent
+    import app as app_module
+    from app import app
+    workdir = tempfile.mkdtemp(prefix='replay-')
+    plan_store.PLAN_STORE_DIR = os.path.join(workdir, 'plan_store')
+    blob_store.BLOB_STORE_DIR = os.path.join(workdir, 'blob_store')
+    portfolio.PORTFOLIO_DB = os.path.join(workdir, 'portfolio.sqlite3')
+    # Only the provider call is replaced: scheduling and response handling run as in production
+    recorded_model = RecordedModel([e for e in events if e['type'] == 'model'], speed)
+    research_agent._generate_text = recorded_model
+    client_random = app_module.random = ClientRandom(seed) # /trigger_random_event picks the same events on every replay
+
+    # Tells the recorded model which captured request each replayed one is (after the scheduler's hook sets the caller)
+    @app.before_request
+    def replay_request_start():
+        replayed = request.headers.get('X-Replay-Request')
+        if replayed:
+            client, seq = replayed.rsplit(':', 1)
+            recorded_model.start_request(model_scheduler.current_caller()[0], client, int(seq))
+
+    @app.after_request
+    def replay_request_finish(response):
+        recorded_model.finish_request(model_scheduler.current_caller()[0])
+        return response
+
+    origin = events[0]['ts']
+    replay_start = time.monotonic()
+    results = []
+    results_lock = threading.Lock()
+
+    def drive(client_requests):
+        client = app.test_client()
+        client_random.seed_client(client_requests[0]['client'])
+        for event in client_requests:
+            if speed:
+                delay = (event['ts'] - origin) / speed - (time.monotonic() - replay_start)
+                if delay > 0:
+                    time.sleep(delay)
+            kwargs = {'headers': {'X-Replay-Request': f"{event['client']}:{event['seq']}"}}
+            if event['json']:
+                kwargs['json'] = event['json']
+            elif event['form'] or event['files']:
+                data = dict(event['form'])
+                for field, spec in event['files'].items():
+                    data[field] = _synthetic_upload(spec)
+                kwargs['data'] = data
+            started = time.monotonic()
+            try:
+                status = client.open(event['path'], method=event['method'], **kwargs).status_code
+            except Exception as e:
+                print(f"Replay: {event['method']} {event['path']} raised {e}")
+                status = 'exception'
+            with results_lock:
+                results.append((event, status, (time.monotonic() - started) * 1000))
+
+    threads = [threading.Thread(target=drive, args=(reqs,), daemon=True) for reqs in requests_by_client.values()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    routes = collections.defaultdict(lambda: {'replayed_ms': [], 'captured_ms': [], 'status': collections.Counter(), 'status_changed': 0})
+    for event, status, elapsed_ms in results:
+        stats = routes[f"{event['method']} {event['route']}"]
+        stats['replayed_ms'].append(elapsed_ms)
+        stats['captured_ms'].append(event['duration_ms'])
+        stats['status'][str(status)] += 1
+        stats['status_changed'] += int(status != event['status'])
+    return {
+        'requests': len(results),
+        'clients': len(requests_by_client),
+        'speed': speed,
+        'wall_seconds': round(time.monotonic() - replay_start, 2),
+        'routes': {
+            route: {
+                'count': len(s['replayed_ms']),
+                'status': dict(s['status']),
+                'status_changed': s['status_changed'],
+                'replayed_p50_ms': _percentile(s['replayed_ms'], 50),
+                'replayed_p95_ms': _percentile(s['replayed_ms'], 95),
+                'replayed_max_ms': _percentile(s['replayed_ms'], 100),
+                'captured_p50_ms': _percentile(s['captured_ms'], 50),
+                'captured_p95_ms': _percentile(s['captured_ms'], 95),
+            }
+            for route, s in sorted(routes.items())
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay captured traffic against a local instance.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    replay_parser = sub.add_parser('replay', help="Re-drive a capture file or directory")
+    replay_parser.add_argument('trace', help="capture-*.jsonl file or a TRAFFIC_CAPTURE_DIR")
+    replay_parser.add_argument('--speed', type=float, default=1.0, help="Time compression: 1 = real time, 10 = 10x faster, 0 = no waiting")
+    replay_parser.add_argument('--seed', type=int, default=0, help="Seed for random events")
+    replay_parser.add_argument('--output', '-o', help="Write stats JSON here (default: stdout)")
+    args = parser.parse_args(argv)
+
+    stats = replay(args.trace, args.speed, args.seed)
+    output = json.dumps(stats, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())